@@ -1,29 +1,52 @@
 import logging
+import math
 
 import numpy as np
 import pandas as pd
 import datetime
 
 import db_handler as dbh
+from schema_plan import compile_schema, compile_plan
+
+
+def unique_key(values):
+    """ The values of a UNIQUE key as one string, compared the way the database compares them: case-insensitively
+        and ignoring surrounding whitespace. Returns None if any of them is blank, since rows with a NULL in the
+        key never collide.
+    """
+    parts = list()
+    for value in values:
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return None
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        parts.append(str(value).strip().upper())
+    return '\x1f'.join(parts)
+
 
 class AdderDataHandler:
     # The AdderDBHandler class is intended to provide a general interface to work with the database in the process
     # of adding and consolidating race information from various source types, such as results and PP files.
 
     def __init__(self, db_name, table_name, data_pack, include_horse=False, other=None,
-                 initialize_db= False, initialize_table=False, verbose_db=False, verbose=False):
+                 initialize_db= False, initialize_table=False, verbose_db=False, verbose=False,
+                 horse_name_index=None, db_handler=None):
         # Attach configuration constants
         self.constants = data_pack
         self.verbose = verbose
-        # Set up the database handler and connect to the database
-        self.db = dbh.QueryDB(db_name, initialize_db=initialize_db, verbose=verbose_db)
+        # Set up the database handler and connect to the database. A db_handler with the QueryDB interface can be
+        # passed in instead (e.g., the SQLite stand-in used by the benchmarks).
+        self.db = db_handler if db_handler is not None else \
+            dbh.QueryDB(db_name, initialize_db=initialize_db, verbose=verbose_db)
         self.db.connect()
         self.table = table_name
+        # Column mappings for this table, compiled from the constants once per run and shared by every handler
         try:
-            self.table_index = self.constants.TABLE_TO_INDEX_MAPPINGS[self.table]
+            self.plan = compile_schema(self.constants).plan(self.table)
         except KeyError:
             print(f'Table index not found for {self.table}')
-            self.table_index = 0
+            self.plan = compile_plan(self.constants, self.table, 0)
+        self.table_index = self.plan.table_index
 
         # Variable to hold the db info dataframe generated by self.build_dataframe()
         self.data = None
@@ -31,9 +54,23 @@ class AdderDataHandler:
         # Variable to control whether horse name is included in race_id construction
         self.include_horse = include_horse
 
+        # HorseNameIndex used to canonicalize horse names as the data is loaded (optional)
+        self.horse_name_index = horse_name_index
+
         # Variable to limit SQL entries retrieved during development
         self.other = other
 
+        # UNIQUE keys of the rows in the table, loaded by unique_keys() the first time something is inserted, and
+        # the number of inserts left out because their key was already there
+        self.existing_keys = None
+        self.duplicates_suppressed = 0
+
+        # ChangeJournal the writes to the table are recorded in, set by the processor for the length of a run
+        self.journal = None
+
+        # RaceConditionsStores over the table that are told about the writes to it
+        self.conditions_stores = list()
+
         # Initalize the table is specified
         if initialize_table: self.initialize_table()
 
@@ -42,39 +79,31 @@ class AdderDataHandler:
 
     def set_up_data(self):
         self.build_dataframe()
+        self.canonicalize_horse_names()
         self.add_race_ids()
 
+    def canonicalize_horse_names(self):
+        # Replace horse names with their canonical spelling so that case-only differences between sources
+        # never show up as horse_name discrepancies.
+        if self.include_horse and self.horse_name_index is not None:
+            self.data['horse_name'] = self.horse_name_index.canonicalize_column(self.data['horse_name'])
+
     def initialize_table(self):
-        unique = self.constants.UNIQUE
-        schema = {key: value[0] for key, value in self.constants.CONSOLIDATED_TABLE_STRUCTURE.items()}
-        self.db.initialize_table(self.table, schema, unique_key=unique, foreign_key=None)
+        self.db.initialize_table(self.table, self.plan.dtypes, unique_key=self.plan.unique, foreign_key=None)
 
     def build_dataframe(self):
         # get_race_data() returns a dataframe containing information from the target table that
         # will be aggregated into the consolidated table.
 
-        # It first generates a dictionary with [consolidated_field_name]: [target_table_field_name]
-        # as the key/value pair. It then splits these up into parallel lists of consolidated and target table
-        # field names. The target table fields are used to query the db, and the consolidated field names
-        # are used as column headers in the resulting data frame.
-
-        # Because python does not guarantee the order that dictionary entries will be presented,
-        # we have to extract the [consolidate]:[target] pairs together and then split them up. If order
-        # were guaranteed, we could just use dict.values() and dict.keys() to get the field lists.
+        # The table's plan has the target table fields to query, in the same order as the consolidated field
+        # names that are used as column headers in the resulting data frame.
 
         if self.table == 'horses_consolidated_races':
             source_fields = ['date', 'track', 'race_num', 'distance']
             consolidated_fields = ['date', 'track', 'race_num', 'distance']
         else:
-            table_index = self.constants.TABLE_TO_INDEX_MAPPINGS[self.table]
-            field_dict = {key: value[table_index] for key, value in self.constants.CONSOLIDATED_TABLE_STRUCTURE.items()
-                          if value[table_index]}
-            extra_fields = {key: value[table_index] for key, value in self.constants.ADDITIONAL_FIELDS.items()
-                            if value[table_index]}
-            field_dict.update(extra_fields)
-            fields = [(key, value) for key, value in field_dict.items()]
-            source_fields = [item for _, item in fields]
-            consolidated_fields = [item for item, _ in fields]
+            source_fields = list(self.plan.select)
+            consolidated_fields = list(self.plan.columns)
 
         # Query the db and return the results as a Pandas dataframe
 
@@ -104,53 +133,31 @@ class AdderDataHandler:
 
     def get_race_data(self):
         self.build_dataframe()
+        self.canonicalize_horse_names()
         self.add_race_ids()
 
     def get_trimmed_row_data(self, i, distance):
         # get_trimmed_row_data() returns a single row of race data from the dataframe with unused columns dropped,
         # and with columns renamed with field names appropriate for entry into the consolidated db.
+        #
+        # The source data provides positions and margins by call rather than by the distance of that call. In order
+        # to aggregate data that provides that info at different calls, the plan for this table renames the call
+        # columns to the distances they were taken at for a race of this distance, and drops the call columns
+        # (from ADDITIONAL_FIELDS) that don't have a distance to go to.
 
-        def generate_drop_cols():
-            # generate_drop_cols() returns a list of the columns that need to be dropped from a
-            # row of data based on the distance of the race represented by that row.
-            # The domain of columns that could be dropped is ADDITIONAL FIELDS, which contains
-            # fields that are specific to the source-data format and will not necessarily
-            # be common to all data sources.
-            #
-            # The need for this process comes is driven by the fact that the source data provides
-            # times and lengths based on the call rather than the distance of that call. In order to aggregate data
-            # that provides that info at different calls, we need to translate those calls into distances and then
-            # use those distances when aggregating the data.
-
-            additional_cols = [key for key in self.constants.ADDITIONAL_FIELDS if self.constants.ADDITIONAL_FIELDS[key][self.table_index] is not None]
-            position_cols = [key for key in get_position_mapping().keys()]
-            margin_cols = [key for key in get_margin_mapping().keys()]
-            drop_columns = [col for col in additional_cols if col not in position_cols and col not in margin_cols]
-
-            return drop_columns
-
-        def get_position_mapping():
-            mapping = {value[self.table_index]: key for key, value in self.constants.POSITION_DISTANCE_MAPPINGS[distance].items()}
-            return mapping
-
-        def get_margin_mapping():
-            mapping = {value[self.table_index]: key for key, value in self.constants.LEAD_OR_BEATEN_DISTANCE_MAPPINGS[distance].items()}
-            return mapping
-
-        # Get the list of columns that need to be dropped from the row
-        drop_columns = generate_drop_cols()
-
-        # Pull row data and set appropriate position/margin column names for distance
         row_data = self.data.iloc[i]
-        row_data = row_data.rename(get_position_mapping())
-        row_data = row_data.rename(get_margin_mapping())
+        row_data = row_data.rename(self.plan.distance_renames[distance])
+        row_data = row_data.drop(list(self.plan.distance_drops[distance]))
 
-        # Drop unused columns that conflict with consolidated table schema
-        row_data = row_data.drop(drop_columns)
-
-        # return the row data and the columns
         return row_data
 
+    def get_trimmed_rows(self, rows, distance):
+        # get_trimmed_rows() is get_trimmed_row_data() for several rows (positions in the dataframe) from races of
+        # the same distance at once. It returns them as a dataframe.
+        data = self.data.iloc[rows]
+        data = data.rename(columns=self.plan.distance_renames[distance])
+        return data.drop(columns=list(self.plan.distance_drops[distance]))
+
     def fields_blank(self,  race_id, fields, number='all'):
         data = self.data.loc[race_id, fields]
         missing_items = [self.is_blank(item) for item in data]
@@ -166,11 +173,70 @@ class AdderDataHandler:
         # a base point and a race_id to use for the WHERE portion of the SQL query.
 
         columns = ['date', 'track', 'race_num', 'horse_name'] if include_horse else ['date', 'track', 'race_num']
-        self.db.add_to_table(self.table, [*race_id], columns )
+        self.insert_rows([*race_id], columns)
+
+    def unique_keys(self):
+        """The UNIQUE keys in the table, loaded with one query and kept up to date by insert_rows()."""
+        if self.existing_keys is None:
+            sql_query = self.db.generate_query(self.table, list(self.plan.unique))
+            self.existing_keys = {unique_key(row) for row in self.db.query_db(sql_query)}
+            self.existing_keys.discard(None)
+        return self.existing_keys
+
+    def insert_rows(self, rows, columns):
+        """ Inserts rows (sequences of values for columns) into the table. Rows whose UNIQUE key is already in the
+            table are left out and counted in duplicates_suppressed rather than sent to fail on the server.
+        """
+        if not self.plan.unique or not all(column in columns for column in self.plan.unique):
+            self.db.add_to_table(self.table, rows, columns)
+            return
+
+        keys = self.unique_keys()
+        key_positions = [list(columns).index(column) for column in self.plan.unique]
+        to_insert = list()
+        for row in rows:
+            key = unique_key([row[position] for position in key_positions])
+            if key is not None and key in keys:
+                self.duplicates_suppressed += 1
+                continue
+            if key is not None: keys.add(key)
+            to_insert.append(row)
+        if to_insert:
+            self.db.add_to_table(self.table, to_insert, columns)
+            if self.journal is not None: self.journal.record_insert(self.plan.unique, list(columns), to_insert)
 
     def update_race_values(self, fields, values, race_id_sql):
+        if self.journal is not None: key, old_values = self.journal_previous_values(fields, race_id_sql)
         sql = self.db.generate_update_query(self.table, fields, values, where=race_id_sql)
         self.db.update_db(sql)
+        if self.journal is not None: self.journal.record_update(key, list(fields), old_values, list(values))
+        for store in self.conditions_stores:
+            store.written(fields, race_id_sql)
+
+    def journal_previous_values(self, fields, race_id_sql):
+        # The journal's key function gives the row being written; its values before the write are the ones last
+        # journaled for it or, failing that, the ones loaded into self.data--or read back from the table, if the
+        # journal has already written the row and no longer has its values cached.
+        key = self.journal.current_key(self.plan.unique)
+        row_fields = dict(zip(self.plan.unique, key))
+        race_id = str(row_fields.get('date')) + str(row_fields.get('track')) + str(row_fields.get('race_num'))
+        if self.include_horse: race_id += str(row_fields.get('horse_name')).upper()
+        loaded = None
+        if self.data is not None and race_id in self.data.index:
+            row = self.data.loc[race_id]
+            loaded = (row.iloc[0] if isinstance(row, pd.DataFrame) else row).to_dict()
+        read = lambda: dict(zip(fields, self.get_values(fields, race_id_sql)))
+        return key, self.journal.previous_values(key, fields, loaded, read)
+
+    def rewrite_values(self, field, value_map, batch_size=500):
+        # Rewrites every row whose field holds one of the value_map keys to the mapped value, batch_size values per
+        # query
+        old_values = list(value_map)
+        for start in range(0, len(old_values), batch_size):
+            batch = {old: value_map[old] for old in old_values[start:start + batch_size]}
+            sql = self.db.generate_case_update_query(self.table, field, batch)
+            self.db.update_db(sql)
+            if self.journal is not None: self.journal.record_rewrite(field, batch)
 
     def delete_entry(self, race_id):
         columns = ['date', 'track', 'race_num', 'horse_name'] if self.include_horse else ['date', 'track', 'race_num']
@@ -196,8 +262,7 @@ class AdderDataHandler:
         #elif type(item) !=str and not isinstance(item, datetime.date) and np.isnan(item): return True
 
     def get_table_structure(self):
-        table_structure = {key: self.constants.CONSOLIDATED_TABLE_STRUCTURE[key][self.table_index] for key in self.constants.CONSOLIDATED_TABLE_STRUCTURE.keys()}
-        return table_structure
+        return self.plan.table_structure
 
     def get_value(self, field, race_id_sql):
         sql_query = self.db.generate_query(self.table, [field], where=race_id_sql)
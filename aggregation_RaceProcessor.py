@@ -1,11 +1,17 @@
-from progress.bar import Bar
 import re
+from contextlib import ExitStack, contextmanager
+from issue_log import IssueLog
+from journal import ChangeJournal
+from review_queue import ReviewQueue
+from stage_profiler import StageProfiler
+from telemetry import TelemetrySampler
 
 class RaceProcessor:
     # The RaceProcessor class is intended to process the race or past performance data and aggregate it into
     # consolidated tables. It's primary method is add_to_consolidated_data().
 
-    def __init__(self, db_handler, db_consolidated_handler, db_consolidated_races_handler, include_horse=False, verbose=False):
+    def __init__(self, db_handler, db_consolidated_handler, db_consolidated_races_handler, include_horse=False, verbose=False,
+                 profile=False, progress_bar=False, telemetry_interval=5.0, profile_dir='logs'):
         self.db = db_handler
         self.consolidated_db = db_consolidated_handler
         self.consolidated_races_db = db_consolidated_races_handler
@@ -27,100 +33,237 @@ class RaceProcessor:
         current_horse = None
         current_distance = None
 
-        # Set up dict to track the unresolvable issues that were found
-        self.unfixed_data = {}
+        # Unresolvable issues are streamed to an IssueLog set up by add_to_consolidated_data()
+        self.unfixed_data = None
+
+        # Per-stage timings for add_to_consolidated_data(), written to profile_dir. profile=True also dumps a cProfile
+        # of each run there.
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.profiler = None
+
+        # Throughput telemetry written every telemetry_interval seconds; progress_bar=True also shows a progress bar
+        self.progress_bar = progress_bar
+        self.telemetry_interval = telemetry_interval
+        self.telemetry = None
+
+        # Writes to the consolidated table are journaled for the length of each run
+        self.journal = None
+
+        # Discrepancies that need a person are queued for review for the length of each run
+        self.review_queue = None
 
     def add_to_consolidated_data(self):
-        # Setup progress bar
         print("Consolidating data")
-        bar = Bar(f'Processing {self.table} data', max=len(self.db.data),
-                  suffix='%(percent).3f%% - %(index)d/%(max)d - %(eta)s secs.')
-
-        # Loop through each row of dataframe and process that race info
-        for i in range(len(self.db.data)):
-            # Advance progress bar
-            bar.next()
-            # Set state with current race information
-            self.set_current_info(i)
-
-            # Check that race_distance is in distances_to_process list; if not, skip the entry
-            ###############
-            # NEED TO DO SOMETHING BETTER ABOUT THIS DISTANCE CHECKING; IT REQUIRES THAT
-            # THE CONSOLIDATED TABLE BE SEEDED WITH A TABLE CONTAINING DISTANCE INFO--TIGHT COUPLING
-            #
-
-            try:
-                distance = self.consolidated_races_db.data.loc[self.get_current_race_id(include_horse=False),
-                                                               'distance']
-            except KeyError:
-                try:
-                    distance = self.db.data.loc[self.get_current_race_id(include_horse=self.include_horse), 'distance']
-                except KeyError:
-                    self.unfixed_data['distance_missing'].append(self.current_race_id)
+        with IssueLog('unfixed_data', self.table) as self.unfixed_data, self.tracked_run():
+            # Loop through each row of dataframe and process that race info
+            for i in range(len(self.db.data)):
+                self.telemetry.next_row()
+                # Set state with current race information
+                self.set_current_info(i)
+
+                # Check that race_distance is in distances_to_process list; if not, skip the entry
+                ###############
+                # NEED TO DO SOMETHING BETTER ABOUT THIS DISTANCE CHECKING; IT REQUIRES THAT
+                # THE CONSOLIDATED TABLE BE SEEDED WITH A TABLE CONTAINING DISTANCE INFO--TIGHT COUPLING
+                #
+
+                with self.profiler.stage('distance_lookup'):
+                    try:
+                        distance = self.consolidated_races_db.data.loc[self.get_current_race_id(include_horse=False),
+                                                                       'distance']
+                    except KeyError:
+                        try:
+                            distance = self.db.data.loc[self.get_current_race_id(include_horse=self.include_horse), 'distance']
+                        except KeyError:
+                            distance = None
+                if distance is None:
+                    self.unfixed_data.record(self.current_race_id, 'distance_missing')
                     print(f'No race distance info found for {self.current_race_id}')
                     continue
-            if distance not in self.db.constants.DISTANCES_TO_PROCESS: continue
-
-            # Use the dataHandler to pull the race data for the current race and generate column list
-            row_data = self.db.get_trimmed_row_data(i, distance)
-            columns = row_data.index.tolist()
-
-
-            try:    # Check if there is an entry in the consolidated db for this race; if not, add it.
-
-                # This will throw an exception if there is no entry in the consolidated table. The race info is
-                # added by the exception handler.
-                self.consolidated_db.data.loc[self.get_current_race_id(include_horse=self.include_horse)]
-                if self.verbose: print(f'Race {self.current_race_id} found--checking for discrepancies')
-
-                # If we've gotten this far, there is an entry.
-                # We'll only be checking whether the non-race_id fields are blank, so generate a list of those
-                # non-race_id columns
-                race_id_fields = ['source_file', 'date', 'track', 'race_num', 'horse_name'] if self.include_horse \
-                    else ['source_file', 'date', 'track','race_num']
-                columns_to_check = [item for item in columns if item not in race_id_fields]
-
-                # Check if the non-race_id fields are blank; if so, add our data to the entry.
-                if self.consolidated_db.fields_blank(self.current_race_id, columns_to_check, number='all'):
-                    # Add all our data (other than the race_id fields, which must already be in there)
-                    self.consolidated_db.update_race_values(columns_to_check,
-                                                            row_data[columns_to_check].tolist(),
-                                                            self.get_current_race_id(as_sql=True,
-                                                                                        include_horse=self.include_horse))
-                # If some of the non-race_id fields are not blank, we have to resolve those against our new data
-                else:   # Resolve partial data
-                        # Generate boolean masks for what data is missing in consolidated and new data
-                    new_row_data = row_data[columns_to_check]
-                    consolidated_data = self.consolidated_db.data.loc[self.get_current_race_id(include_horse=self.include_horse), columns_to_check]
-
-                    missing_row_data = [self.db.is_blank(item) for item in new_row_data]
-                    missing_consolidated_data = [self.db.is_blank(item) for item in consolidated_data]
-
-                    # Check to make sure the row sizes match, which we expect
-                    # TO-DO TAKE THIS OUT FOR PRODUCTION
-                    assert len(missing_row_data) == len(missing_consolidated_data)
-
-                    # If there's an entry that already has data in it, compare each data entry, see where
-                    # discrepancies are, resolve them, and then update the consolidated db entry.
-                    self.resolve_data(zip(missing_row_data, missing_consolidated_data),
-                                      zip(new_row_data, consolidated_data),
-                                      columns_to_check)
-
-            except KeyError:    # Add the race if there isn't already an entry in the consolidated db
-                if self.verbose: print(f'Race {self.current_race_id} not found--adding to db')
-                self.consolidated_db.add_blank_entry(self.get_current_race_id(as_tuple=True, include_horse=self.include_horse),
-                                                     include_horse=self.include_horse)
-                self.consolidated_db.update_race_values(columns,
-                                                        row_data.tolist(),
-                                                        self.get_current_race_id(as_sql=True, include_horse=self.include_horse))
-
-        with open(f'unfixed_data_{self.table}.txt', 'w') as file:
-            for key in self.unfixed_data.keys():
-                file.write(f'{key}:\t')
-                for item in self.unfixed_data[key]:
-                    file.write(f'{item}, ')
-                file.write('\n')
-        bar.finish()
+                if distance not in self.db.constants.DISTANCES_TO_PROCESS: continue
+
+                # Use the dataHandler to pull the race data for the current race and generate column list
+                row_data = self.db.get_trimmed_row_data(i, distance)
+                columns = row_data.index.tolist()
+
+
+                try:    # Check if there is an entry in the consolidated db for this race; if not, add it.
+
+                    # This will throw an exception if there is no entry in the consolidated table. The race info is
+                    # added by the exception handler.
+                    self.consolidated_db.data.loc[self.get_current_race_id(include_horse=self.include_horse)]
+                    if self.verbose: print(f'Race {self.current_race_id} found--checking for discrepancies')
+
+                    # If we've gotten this far, there is an entry.
+                    # We'll only be checking whether the non-race_id fields are blank, so generate a list of those
+                    # non-race_id columns
+                    race_id_fields = ['source_file', 'date', 'track', 'race_num', 'horse_name'] if self.include_horse \
+                        else ['source_file', 'date', 'track','race_num']
+                    columns_to_check = [item for item in columns if item not in race_id_fields]
+
+                    # Check if the non-race_id fields are blank; if so, add our data to the entry.
+                    if self.consolidated_db.fields_blank(self.current_race_id, columns_to_check, number='all'):
+                        # Add all our data (other than the race_id fields, which must already be in there)
+                        self.consolidated_db.update_race_values(columns_to_check,
+                                                                row_data[columns_to_check].tolist(),
+                                                                self.get_current_race_id(as_sql=True,
+                                                                                            include_horse=self.include_horse))
+                    # If some of the non-race_id fields are not blank, we have to resolve those against our new data
+                    else:   # Resolve partial data
+                            # Generate boolean masks for what data is missing in consolidated and new data
+                        new_row_data = row_data[columns_to_check]
+                        consolidated_data = self.consolidated_db.data.loc[self.get_current_race_id(include_horse=self.include_horse), columns_to_check]
+
+                        missing_row_data = [self.db.is_blank(item) for item in new_row_data]
+                        missing_consolidated_data = [self.db.is_blank(item) for item in consolidated_data]
+
+                        # Check to make sure the row sizes match, which we expect
+                        # TO-DO TAKE THIS OUT FOR PRODUCTION
+                        assert len(missing_row_data) == len(missing_consolidated_data)
+
+                        # If there's an entry that already has data in it, compare each data entry, see where
+                        # discrepancies are, resolve them, and then update the consolidated db entry.
+                        self.resolve_data(zip(missing_row_data, missing_consolidated_data),
+                                          zip(new_row_data, consolidated_data),
+                                          columns_to_check)
+
+                except KeyError:    # Add the race if there isn't already an entry in the consolidated db
+                    if self.verbose: print(f'Race {self.current_race_id} not found--adding to db')
+                    self.consolidated_db.add_blank_entry(self.get_current_race_id(as_tuple=True, include_horse=self.include_horse),
+                                                         include_horse=self.include_horse)
+                    self.consolidated_db.update_race_values(columns,
+                                                            row_data.tolist(),
+                                                            self.get_current_race_id(as_sql=True, include_horse=self.include_horse))
+
+        print(self.unfixed_data.summary())
+
+    def rows_to_process(self):
+        """Number of rows add_to_consolidated_data() loops over; used for the timing and telemetry reports."""
+        return len(self.db.data)
+
+    def fixer_items(self):
+        """(label, fixer) pairs for every fixer the processor uses, for timing and telemetry."""
+        return list(getattr(self, 'fixers', dict()).items())
+
+    @contextmanager
+    def tracked_run(self):
+        """ Starts the stage profiler, telemetry, change journal and review queue for a run of
+            add_to_consolidated_data(), and stops them when the run ends, whether it finished or failed: the
+            journal and review queue get flushed, and the wrappers and the sampler thread are taken out. Each one
+            that was started is stopped, even if stopping another fails.
+        """
+        with ExitStack() as stack:
+            for start, stop in [(self.start_profiler, self.stop_profiler),
+                                (self.start_telemetry, self.stop_telemetry),
+                                (self.start_journal, self.stop_journal),
+                                (self.start_review_queue, self.stop_review_queue)]:
+                start()
+                stack.callback(stop)
+            yield
+
+    def start_profiler(self):
+        """Sets up stage timing for a run of add_to_consolidated_data() and starts the clock."""
+        self.profiler = StageProfiler(self.table, log_dir=self.profile_dir, profile=self.profile)
+
+        try:
+            for method_name in ['set_current_info', 'get_race_distance', 'race_entry_exists', 'resolve_data',
+                                'insert_runners']:
+                if hasattr(self, method_name):
+                    self.profiler.instrument(self, method_name)
+            for method_name in ['get_row_data', 'get_trimmed_row_data', 'get_trimmed_rows']:
+                if hasattr(self.db, method_name):
+                    self.profiler.instrument(self.db, method_name)
+            self.profiler.instrument(self.consolidated_db, 'fields_blank')
+            for method_name in ['add_blank_entry', 'update_race_values']:
+                self.profiler.instrument(self.consolidated_db, method_name, f'db_write/{method_name}')
+            for label, fixer in self.fixer_items():
+                self.profiler.instrument(fixer, 'fix_discrepancy', f'fix_discrepancy/{label}')
+        except BaseException:
+            self.profiler.restore()
+            raise
+
+        self.profiler.start()
+
+    def stop_profiler(self):
+        """Stops the clock, removes the timing wrappers, and prints and saves the stage timings."""
+        try:
+            self.profiler.stop(self.rows_to_process())
+        finally:
+            self.profiler.restore()
+        print(self.profiler.report())
+        print(f'Stage timings written to {self.profiler.write()}')
+
+    def start_telemetry(self):
+        """ Starts the telemetry sampler for a run of add_to_consolidated_data(). Fixer invocation counts come from
+            the stage profiler, so start_profiler() has to run first.
+        """
+        self.telemetry = TelemetrySampler(self.table, self.rows_to_process(), interval=self.telemetry_interval,
+                                          progress_bar=self.progress_bar)
+
+        query_dbs = {id(handler.db): handler.db for handler in [self.db, self.consolidated_db, self.consolidated_races_db]
+                     if handler is not None}
+        for query_db in query_dbs.values():
+            self.telemetry.count_queries(query_db)
+        for metric, help_text, function in self.telemetry_gauges():
+            self.telemetry.add_gauge(metric, help_text, function)
+        fixer_stages = {label: f'fix_discrepancy/{label}' for label, _ in self.fixer_items()}
+        self.telemetry.add_counters('fixer_invocations', 'Discrepancies sent to each fixer', 'column',
+                                    lambda: {label: self.profiler.counts.get(stage, 0)
+                                             for label, stage in fixer_stages.items()})
+        self.telemetry.add_counters('duplicates_suppressed', 'Inserts left out because the row was already there',
+                                    'table', lambda: {self.consolidated_db.table:
+                                                      self.consolidated_db.duplicates_suppressed})
+
+        self.telemetry.start()
+
+    def telemetry_gauges(self):
+        """(metric, help text, function) for each gauge the telemetry samples besides the standard ones."""
+        return [('write_buffer_depth', 'Unresolved issues waiting to be written to the issue log',
+                 lambda: len(self.unfixed_data.buffer))]
+
+    def stop_telemetry(self):
+        self.telemetry.stop()
+        print(f'Telemetry written to {self.telemetry.path}')
+
+    def start_journal(self):
+        """ Journals the writes to the consolidated table for a run of add_to_consolidated_data(), crediting each one
+            to the resolver that made it: a fixer, reconcile_discrepancy(), or fill_missing when resolve_data() fills
+            in a blank consolidated value.
+        """
+        self.journal = ChangeJournal(self.consolidated_db.table, self.table, self.journal_key,
+                                     source_function=lambda: self.db.table)
+        self.journal.instrument(self, 'resolve_data', 'fill_missing')
+        self.journal.instrument(self, 'reconcile_discrepancy', 'reconcile_discrepancy')
+        for label, fixer in self.fixer_items():
+            self.journal.instrument(fixer, 'fix_discrepancy', type(fixer).__name__)
+        self.consolidated_db.journal = self.journal
+
+    def journal_key(self):
+        """The fields of the consolidated row being written."""
+        return {'date': self.current_date, 'track': self.current_track, 'race_num': self.current_race_num,
+                'horse_name': getattr(self, 'current_horse', None)}
+
+    def stop_journal(self):
+        self.consolidated_db.journal = None
+        self.journal.close()
+        print(f'{self.journal.records} changes journaled to {self.journal.path}')
+
+    def start_review_queue(self):
+        """ Sets up the queue that discrepancies needing a person go to for a run of add_to_consolidated_data(), so
+            nothing stops to wait for input, and hands it to the fixers.
+        """
+        self.review_queue = ReviewQueue(self.consolidated_db.table, self.table, self.journal_key,
+                                        race_id_function=lambda: self.current_race_id,
+                                        source_function=lambda: self.db.table)
+        for label, fixer in self.fixer_items():
+            fixer.review_queue = self.review_queue
+
+    def stop_review_queue(self):
+        for label, fixer in self.fixer_items():
+            fixer.review_queue = None
+        self.review_queue.close()
+        print(self.review_queue.summary())
 
     def set_current_info(self, i):
 
@@ -137,11 +280,8 @@ class RaceProcessor:
         self.current_race_id = self.get_current_race_id(include_horse=self.include_horse)
 
     def get_current_race_id(self, include_horse=False, as_sql=False, as_tuple=False):
-
-        def escape_and_clean(item):
-            escaped_item = re.sub(r"(['\\])", r'\\\1', str(item))  # Escape textual backslashes and tick marks
-            cleaned_item = re.sub(u"\uFFFD", "", escaped_item)  # Fix oddball <?> character
-            return cleaned_item.strip()  # Strip off any leading or trailing whitespace
+        # Escape the horse name the same way the consolidated db escapes the rest of the query
+        escape_and_clean = self.consolidated_db.db.escape_and_clean
 
         if as_sql:
             race_id = f'track=\'{self.current_track}\' ' \
@@ -0,0 +1,80 @@
+# Micro-benchmark for the off-turf trigger prefilter in race_conditions_parser.extract_changed_distance().
+#
+# Run from the repository root against the race conditions text in the source database:
+#     python -m benchmarks.bench_conditions_prefilter --database horses_test
+# or against a text file with one conditions text per line:
+#     python -m benchmarks.bench_conditions_prefilter --corpus conditions.txt
+
+import argparse
+import timeit
+
+from race_conditions_parser import extract_changed_distance, find_trigger
+
+
+def load_corpus_from_db(database, limit=''):
+    import db_handler as dbh
+    from constants.constant_aggregated_races_table_structure import CONSOLIDATED_TABLE_STRUCTURE
+    from constants.constant_aggregated_races_table_to_index_mappings import TABLE_TO_INDEX_MAPPINGS
+    from race_conditions_store import RACE_CONDITIONS_FIELDS
+
+    db = dbh.QueryDB(database)
+    db.connect()
+    texts = []
+    for table in ['race_info', 'race_general_results']:
+        fields = [CONSOLIDATED_TABLE_STRUCTURE[field][TABLE_TO_INDEX_MAPPINGS[table]] for field in RACE_CONDITIONS_FIELDS]
+        fields = [field for field in fields if field]
+        for row in db.query_db(db.generate_query(table, fields, other=limit)):
+            text = ''.join(item for item in row if item)
+            if text:
+                texts.append(text)
+    db.close()
+    return texts
+
+
+def load_corpus_from_file(path):
+    with open(path) as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time off-turf distance extraction with and without the prefilter')
+    parser.add_argument('--database', help='source database to pull race conditions from')
+    parser.add_argument('--corpus', help='text file with one race conditions text per line')
+    parser.add_argument('--limit', default='', help="SQL suffix to limit rows, e.g. 'LIMIT 50000'")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.corpus:
+        texts = load_corpus_from_file(args.corpus)
+    elif args.database:
+        texts = load_corpus_from_db(args.database, args.limit)
+    else:
+        parser.error('one of --database or --corpus is required')
+    texts = [text.lower() for text in texts]
+
+    # The prefilter must never change a result
+    for text in texts:
+        with_prefilter = extract_changed_distance(text)
+        without_prefilter = extract_changed_distance(text, prefilter=False)
+        if with_prefilter is None or without_prefilter is None:
+            assert with_prefilter is without_prefilter, text
+        else:
+            assert with_prefilter[0] == without_prefilter[0], text
+            if with_prefilter[1] is not None:
+                assert with_prefilter[1].group(0) == without_prefilter[1].group(0), text
+
+    candidates = sum(1 for text in texts if find_trigger(text) is not None)
+
+    full = min(timeit.repeat(lambda: [extract_changed_distance(text, prefilter=False) for text in texts],
+                             number=1, repeat=args.repeat))
+    prefiltered = min(timeit.repeat(lambda: [extract_changed_distance(text) for text in texts],
+                                    number=1, repeat=args.repeat))
+
+    print(f'{len(texts)} conditions texts, {candidates} ({candidates / max(len(texts), 1):.1%}) contain a trigger')
+    print(f'Full regexes:   {full:.4f} s ({full / max(len(texts), 1) * 1e6:.2f} us/text)')
+    print(f'With prefilter: {prefiltered:.4f} s ({prefiltered / max(len(texts), 1) * 1e6:.2f} us/text)')
+    print(f'Speedup:        {full / prefiltered:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
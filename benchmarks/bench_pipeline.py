@@ -0,0 +1,285 @@
+# Benchmark suite for the consolidation pipeline.
+#
+# Generates synthetic source tables in a local SQLite stand-in for the MySQL databases, runs RaceAggregator and
+# PPRaceProcessor end to end over them, and times the hot helpers on the same data. Run from the repository root:
+#     python -m benchmarks.bench_pipeline --sizes 1000 10000 --output bench_results.json
+# and compare against an earlier run, failing if anything got more than --threshold slower:
+#     python -m benchmarks.bench_pipeline --sizes 1000 10000 --baseline bench_baseline.json --threshold 0.2
+#
+# Sizes are numbers of races; the performance tables get one row per starter (5 to 12 per race).
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import db_handler as dbh
+import horse_performances_refactor as hp
+from days_since_last_race import settle_days_since_last_race
+from race_table import AggRacesDataHandler, RaceAggregator, RaceMerger
+from race_conditions_parser import parse_conditions
+from datapack import DataPack
+
+from benchmarks.sqlite_db import SQLiteQueryDB
+from synthetic_data import create_source_tables, RACE_SOURCE_TABLES, PERFORMANCE_SOURCE_TABLES
+
+SOURCE_DB = 'bench_source'
+CONSOLIDATED_DB = 'bench_consolidated'
+MERGED_DB = 'bench_merged'
+GROUPED_DB = 'bench_grouped'
+
+
+def races_data_pack():
+    from constants.constant_aggregated_races_table_structure import CONSOLIDATED_TABLE_STRUCTURE
+    from constants.constant_aggregated_races_additional_fields import ADDITIONAL_FIELDS
+    from constants.constant_aggregated_races_table_to_index_mappings import TABLE_TO_INDEX_MAPPINGS
+    from constants.constant_aggregated_races_unique import UNIQUE
+    return DataPack(CONSOLIDATED_TABLE_STRUCTURE=CONSOLIDATED_TABLE_STRUCTURE,
+                    ADDITIONAL_FIELDS=ADDITIONAL_FIELDS,
+                    TABLE_TO_INDEX_MAPPINGS=TABLE_TO_INDEX_MAPPINGS,
+                    UNIQUE=UNIQUE)
+
+
+def performances_data_pack():
+    from constants.constant_horse_performances_consolidated_table_structure import CONSOLIDATED_TABLE_STRUCTURE
+    from constants.constant_horse_performances_additional_fields import ADDITIONAL_FIELDS
+    from constants.constant_horse_performances_table_to_index_mappings import TABLE_TO_INDEX_MAPPINGS
+    from constants.constant_horse_performances_distances_to_process import DISTANCES_TO_PROCESS
+    from constants.constant_horse_performances_position_distance_mappings import POSITION_DISTANCE_MAPPINGS
+    from constants.constant_horses_performances_lead_or_beaten_distance_mappings import LEAD_OR_BEATEN_DISTANCE_MAPPINGS
+    from constants.constant_aggregated_performances_unique import UNIQUE
+    return DataPack(CONSOLIDATED_TABLE_STRUCTURE=CONSOLIDATED_TABLE_STRUCTURE,
+                    ADDITIONAL_FIELDS=ADDITIONAL_FIELDS,
+                    TABLE_TO_INDEX_MAPPINGS=TABLE_TO_INDEX_MAPPINGS,
+                    DISTANCES_TO_PROCESS=DISTANCES_TO_PROCESS,
+                    POSITION_DISTANCE_MAPPINGS=POSITION_DISTANCE_MAPPINGS,
+                    LEAD_OR_BEATEN_DISTANCE_MAPPINGS=LEAD_OR_BEATEN_DISTANCE_MAPPINGS,
+                    UNIQUE=UNIQUE)
+
+
+def time_call(function, setup=None, repeat=1):
+    """Returns the fastest of repeat timed calls to function, running setup (untimed) before each one."""
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def result(seconds, rows):
+    return {'seconds': seconds, 'rows': rows, 'rows_per_second': rows / seconds if seconds else None}
+
+
+class PipelineBenchmark:
+    # Runs one size of the benchmark in its own directory of SQLite databases. run_races() has to come before
+    # run_performances(), which needs the consolidated race distances; run_micro() uses the handlers and fixers
+    # the end-to-end runs leave behind.
+
+    def __init__(self, directory, n_races, seed=0, conflict_rate=0.05, blank_rate=0.02):
+        self.directory = directory
+        self.n_races = n_races
+        self.results = dict()
+
+        source_db = SQLiteQueryDB(SOURCE_DB, directory)
+        source_db.connect()
+        self.row_counts = create_source_tables(source_db, n_races, seed=seed, conflict_rate=conflict_rate,
+                                               blank_rate=blank_rate)
+        source_db.close()
+
+        self.races_pack = races_data_pack()
+        self.performances_pack = performances_data_pack()
+        self.race_aggregator = None
+        self.performance_processor = None
+
+    def db(self, name):
+        return SQLiteQueryDB(name, self.directory)
+
+    def record(self, name, seconds, rows):
+        self.results[f'{name}[{self.n_races}]'] = result(seconds, rows)
+        print(f'{name}[{self.n_races}]: {rows} rows in {seconds:.3f} s')
+
+    def run_races(self):
+        consolidated = AggRacesDataHandler(CONSOLIDATED_DB, 'horses_consolidated_races', self.races_pack,
+                                           include_horse=False, other='', initialize_table=True,
+                                           db_handler=self.db(CONSOLIDATED_DB))
+        total_seconds, total_rows = 0.0, 0
+        for table in RACE_SOURCE_TABLES:
+            source = AggRacesDataHandler(SOURCE_DB, table, self.races_pack, include_horse=False, other='',
+                                         db_handler=self.db(SOURCE_DB))
+            self.race_aggregator = RaceAggregator(source, consolidated, include_horse=False)
+            seconds = time_call(self.race_aggregator.add_to_consolidated_data)
+            self.record(f'races/{table}', seconds, len(source.data))
+            total_seconds += seconds
+            total_rows += len(source.data)
+            consolidated.set_up_data()
+        self.record('races/total', total_seconds, total_rows)
+
+    def run_races_merged(self):
+        """Consolidates the same race sources in a single merged pass, into a database of its own."""
+        consolidated = AggRacesDataHandler(MERGED_DB, 'horses_consolidated_races', self.races_pack,
+                                           include_horse=False, other='', initialize_table=True,
+                                           db_handler=self.db(MERGED_DB))
+        sources = {table: AggRacesDataHandler(SOURCE_DB, table, self.races_pack, include_horse=False, other='',
+                                              db_handler=self.db(SOURCE_DB))
+                   for table in RACE_SOURCE_TABLES}
+        merger = RaceMerger(sources, consolidated, include_horse=False)
+        seconds = time_call(merger.add_to_consolidated_data)
+        self.record('races/merged', seconds, sum(len(source.data) for source in sources.values()))
+
+    def run_performances(self, race_grouped=False):
+        """ Consolidates the performance sources against the consolidated races. race_grouped=True uses the
+            race-grouped mode and writes to a database of its own.
+        """
+        name = 'performances_grouped' if race_grouped else 'performances'
+        database = GROUPED_DB if race_grouped else CONSOLIDATED_DB
+        consolidated_races = hp.AdderDataHandler(CONSOLIDATED_DB, 'horses_consolidated_races',
+                                                 self.performances_pack, include_horse=False, other='',
+                                                 db_handler=self.db(CONSOLIDATED_DB))
+        consolidated = hp.AdderDataHandler(database, 'horses_consolidated_performances',
+                                           self.performances_pack, include_horse=True, other='',
+                                           initialize_table=True, db_handler=self.db(database))
+        total_seconds, total_rows = 0.0, 0
+        for table in PERFORMANCE_SOURCE_TABLES:
+            source = hp.PPAdderDataHandler(SOURCE_DB, table, self.performances_pack, include_horse=True, other='',
+                                           db_handler=self.db(SOURCE_DB))
+            processor = hp.PPRaceProcessor(source, consolidated, consolidated_races, include_horse=True,
+                                           race_grouped=race_grouped)
+            if not race_grouped: self.performance_processor = processor
+            seconds = time_call(processor.add_to_consolidated_data)
+            self.record(f'{name}/{table}', seconds, len(source.data))
+            total_seconds += seconds
+            total_rows += len(source.data)
+            consolidated.set_up_data()
+        self.record(f'{name}/total', total_seconds, total_rows)
+
+    def run_days_since_last_race(self):
+        """Derives days_since_last_race over the performances consolidated by run_performances()."""
+        db = self.db(CONSOLIDATED_DB)
+        db.connect()
+        rows = db.query_db('SELECT COUNT(*) FROM horses_consolidated_performances')[0][0]
+        seconds = time_call(lambda: settle_days_since_last_race(db))
+        self.record('performances/days_since_last_race', seconds, rows)
+
+    def run_micro(self, rows=20000, repeat=3):
+        handler = hp.PPAdderDataHandler(SOURCE_DB, 'horse_pps', self.performances_pack, include_horse=True, other='',
+                                        db_handler=self.db(SOURCE_DB))
+        raw_data = handler.data.reset_index(drop=True)
+
+        def reset_data():
+            handler.data = raw_data.copy()
+        seconds = time_call(handler.add_race_ids, setup=reset_data, repeat=repeat)
+        self.record('micro/add_race_ids', seconds, len(raw_data))
+
+        distances = handler.data['distance']
+        to_trim = [(i, distance) for i, distance in enumerate(distances[:rows])
+                   if distance in self.performances_pack.DISTANCES_TO_PROCESS]
+        seconds = time_call(lambda: [handler.get_trimmed_row_data(i, distance) for i, distance in to_trim],
+                            repeat=repeat)
+        self.record('micro/get_trimmed_row_data', seconds, len(to_trim))
+
+        values = handler.data.iloc[:rows // 20].to_numpy().ravel().tolist()
+        seconds = time_call(lambda: [handler.is_blank(value) for value in values], repeat=repeat)
+        self.record('micro/is_blank', seconds, len(values))
+
+        mysql_db = dbh.QueryDB(SOURCE_DB)       # Never connects; escape_and_clean() is pure
+        names = handler.data['horse_name'].iloc[:rows].tolist()
+        seconds = time_call(lambda: [mysql_db.escape_and_clean(name) for name in names], repeat=repeat)
+        self.record('micro/escape_and_clean', seconds, len(names))
+
+        # Fixers, on pairs drawn from the generated data
+        rng = np.random.RandomState(0)
+        margins = handler.data['lead_or_beaten_lengths_finish'].astype(float).to_numpy()[:rows]
+        batch = {'new_data': margins, 'existing_data': (margins * 4).round() / 4}
+        fixer = self.performance_processor.fixers['lead_or_beaten_0']
+        seconds = time_call(lambda: fixer.fix_discrepancies(batch), repeat=repeat)
+        self.record('micro/fixer_lead_or_beaten', seconds, len(margins))
+
+        race_types = self.race_aggregator.db.data['race_type'].dropna().to_numpy()[:rows]
+        batch = {'new_data': race_types, 'existing_data': rng.permutation(race_types)}
+        fixer = self.race_aggregator.fixers['race_type']
+        seconds = time_call(lambda: fixer.fix_discrepancies(batch), repeat=repeat)
+        self.record('micro/fixer_race_type', seconds, len(race_types))
+
+        texts = [text for text in self.race_aggregator.source_conditions.texts()][:rows]
+        seconds = time_call(lambda: [parse_conditions(text) for text in texts], repeat=repeat)
+        self.record('micro/parse_conditions', seconds, len(texts))
+
+
+def compare(results, baseline, threshold):
+    """ Prints each benchmark's time against the baseline's. Returns the names of the benchmarks that are more
+        than threshold (a fraction) slower than the baseline.
+    """
+    regressions = list()
+    print(f'\n{"benchmark":<45}{"baseline s":>12}{"current s":>12}{"change":>10}')
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['seconds']
+        change = current['seconds'] / before - 1 if before else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<45}{before:>12.3f}{current["seconds"]:>12.3f}{change:>+10.1%}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the race and performance consolidation pipeline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000], help='numbers of races to generate')
+    parser.add_argument('--conflict-rate', type=float, default=0.05, help='share of rows with a conflicting value')
+    parser.add_argument('--blank-rate', type=float, default=0.02, help='share of cells left blank')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='results file from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown before failing, e.g. 0.2')
+    args = parser.parse_args()
+
+    results = dict()
+    for n_races in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            benchmark = PipelineBenchmark(directory, n_races, seed=args.seed, conflict_rate=args.conflict_rate,
+                                          blank_rate=args.blank_rate)
+            benchmark.run_races()
+            benchmark.run_races_merged()
+            benchmark.run_performances()
+            benchmark.run_days_since_last_race()
+            benchmark.run_performances(race_grouped=True)
+            benchmark.run_micro()
+            results.update(benchmark.results)
+
+    output = {
+        'meta': {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sizes': args.sizes,
+            'seed': args.seed,
+            'conflict_rate': args.conflict_rate,
+            'blank_rate': args.blank_rate,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(output, file, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} benchmark(s) more than {args.threshold:.0%} slower than the baseline')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
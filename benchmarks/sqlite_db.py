@@ -0,0 +1,107 @@
+# SQLite stand-in for db_handler.QueryDB so the pipeline can be benchmarked without a MySQL server.
+#
+# Each database name maps to a file in a working directory. Only the MySQL-specific parts of QueryDB are
+# overridden: connecting, USE, table creation, inserts, and string escaping. Query generation and the update path
+# are inherited unchanged so the benchmarks exercise the same code the real runs do.
+
+import datetime
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+import db_handler as dbh
+
+
+# Quoted string literals, and identifiers that start with a digit (e.g., 2f_fraction), which MySQL accepts bare
+# but SQLite needs quoted
+STRING_LITERAL = re.compile(r"('(?:[^']|'')*')")
+NUMERIC_IDENTIFIER = re.compile(r'(?<![\w"])(\d+[A-Za-z_]\w*)')
+
+# Read DATE columns back as datetime.date, the way MySQLdb returns them
+sqlite3.register_adapter(datetime.date, lambda date: date.isoformat())
+sqlite3.register_converter('DATE', lambda value: datetime.date.fromisoformat(value.decode()))
+
+
+def quote_identifiers(sql):
+    """Double-quotes the digit-led identifiers in sql, leaving string literals alone."""
+    parts = STRING_LITERAL.split(sql)
+    parts[::2] = [NUMERIC_IDENTIFIER.sub(r'"\1"', part) for part in parts[::2]]
+    return ''.join(parts)
+
+
+class SQLiteQueryDB(dbh.QueryDB):
+
+    def __init__(self, db, directory, initialize_db=False, verbose=False):
+        super().__init__(db, initialize_db=initialize_db, verbose=verbose)
+        self.path = os.path.join(directory, f'{db}.sqlite3')
+
+    def connect(self):
+        if not self.connection:
+            self.connection = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+
+    def query_db(self, sql_query, return_col_names=False):
+        return super().query_db(quote_identifiers(sql_query), return_col_names)
+
+    def update_db(self, sql_query):
+        super().update_db(quote_identifiers(sql_query))
+
+    def initialize_db(self):
+        """The database file is created on connect."""
+        if not self.connection: self.connect()
+
+    def initialize_table(self, table_name, dtypes, unique_key, foreign_key):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+        if not cursor.fetchone()[0]:
+            self._create_table(self.connection, cursor, table_name, dtypes, unique_key, foreign_key)
+
+    def escape(self, item):
+        return str(item).replace("'", "''")                     # SQLite escapes tick marks by doubling them
+
+    def escape_and_clean(self, item):
+        escaped_item = self.escape(item)
+        cleaned_item = re.sub(u"\uFFFD", "", escaped_item)
+        return cleaned_item.strip()
+
+    def generate_case_update_query(self, table, field, value_map, print_query=False):
+        # SQLite string comparisons are already case-sensitive, so there's no BINARY
+        value_map = {self.escape(old): self.escape_and_clean(new) for old, new in value_map.items()}
+        cases = ' '.join(f"WHEN '{old}' THEN '{new}'" for old, new in value_map.items())
+        old_values = ', '.join(f"'{old}'" for old in value_map.keys())
+        sql = f'UPDATE {table} SET {field} = CASE {field} {cases} ELSE {field} END WHERE {field} IN ({old_values})'
+        if print_query: print(sql)
+        return sql
+
+    def _use_db(self, db, cursor):
+        pass
+
+    def _create_table(self, db, cursor, table_name, dtypes, unique_key, foreign_key):
+        columns = ', '.join(f'"{column_name}" {column_dtype}' for column_name, column_dtype in dtypes.items())
+        sql = f'CREATE TABLE {table_name} (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns}'
+        if unique_key: sql += f', UNIQUE ({", ".join(unique_key)})'
+        sql += ')'
+        if self.verbose: print(sql)
+        cursor.execute(sql)
+        db.commit()
+
+    def _insert_records(self, db, cursor, table_name, table_data, sql_col_names, print_sql=False):
+        # Duplicates are skipped, which is what the MySQL handler does after logging the IntegrityError
+        def clean(item):
+            if isinstance(item, np.generic):    # sqlite3 would store numpy scalars as blobs
+                item = item.item()
+            if item is None or (isinstance(item, float) and item != item) or item in ('NULL', 'nan', 'None'):
+                return None
+            return item.strip() if isinstance(item, str) else item
+
+        placeholders = ', '.join('?' for _ in sql_col_names)
+        columns = ', '.join(f'"{column_name}"' for column_name in sql_col_names)
+        sql = f'INSERT OR IGNORE INTO {table_name} ({columns}) VALUES ({placeholders})'
+        if self.verbose: print(sql)
+        cursor.executemany(sql, ([clean(item) for item in row] for row in table_data))
+        db.commit()
+
+    def __enter__(self):
+        self.connect()
+        return self
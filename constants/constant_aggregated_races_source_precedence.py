@@ -0,0 +1,14 @@
+SOURCE_PRECEDENCE = {
+    # Format: consolidated_col: [source tables, most trusted first]
+    #   - 'default' is the order sources are folded into a race by RaceMerger; the fixers resolve any conflicts
+    #     between them, the same as when each source is consolidated in its own pass.
+    #   - Every other column takes the first non-blank value in its list, without going to the fixers. These are
+    #     facts that change between the entries and the chart: the surface a race was run on when it comes off
+    #     the turf, the track condition, and the field size after scratches.
+    'default':                  ['race_info', 'horse_pps', 'race_general_results'],
+    'surface':                  ['race_general_results', 'horse_pps', 'race_info'],
+    'track_condition':          ['race_general_results', 'horse_pps', 'race_info'],
+    'off_turf':                 ['race_general_results', 'horse_pps'],
+    'off_turf_dist_change':     ['race_general_results', 'horse_pps'],
+    'field_size':               ['race_general_results', 'horse_pps', 'race_info'],
+}
@@ -0,0 +1,11 @@
+TABLE_STRUCTURE = {
+    # Format 'sql_col_name': ('sql_datatype',)
+    'track':            ('VARCHAR(255)',),
+    'date':             ('DATE',),
+    'race_num':         ('TINYINT',),
+    'horse_name':       ('VARCHAR(255)',),      # NULL for checks on the race itself
+    'rule':             ('VARCHAR(255)',),
+    'column_name':      ('VARCHAR(255)',),      # Column holding the offending value
+    'value':            ('FLOAT',),
+    'detail':           ('VARCHAR(255)',),
+}
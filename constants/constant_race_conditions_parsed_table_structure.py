@@ -0,0 +1,11 @@
+TABLE_STRUCTURE = {
+    # Format 'sql_col_name': ('sql_datatype',)
+    'text_hash':                ('CHAR(40)',),      # sha1 of the concatenated race conditions text
+    'off_turf_distance':        ('INT',),           # Alternate distance in yards if the race comes off the turf
+    'multipart':                ('TINYINT',),       # Off-turf clause lists more than one distance
+    'grade':                    ('TINYINT',),
+    'waiver_maiden_claiming':   ('TINYINT',),
+    'trials':                   ('TINYINT',),
+}
+
+UNIQUE = ['text_hash']
@@ -0,0 +1,73 @@
+# Derives days_since_last_race for the consolidated performances from the performances themselves.
+#
+# A horse's days since its last race is the number of days between consecutive starts: the consolidated table is
+# sorted by horse and date and the gaps come from a grouped diff over the dates. The table doesn't hold every start,
+# though. Rows at distances that aren't processed, rows missing their distance and rows cut off by a data limit never
+# make it in, and horses are told apart by name alone, so a derived gap can span a start the table doesn't have or
+# join two horses with the same name. The derived value is only used to fill in a blank; where the row already has a
+# value that disagrees with it, the disagreement is logged to an IssueLog and the value is left alone. A horse's
+# first start in the table has no gap to derive, and neither do same-day duplicates. The fills go out in batched
+# UPDATEs keyed on the row id and are recorded in the change journal under the resolver 'days_since_last_race'.
+
+import numpy as np
+import pandas as pd
+
+from constants.constant_aggregated_performances_unique import UNIQUE
+from issue_log import IssueLog
+from journal import ChangeJournal
+
+
+RESOLVER = 'days_since_last_race'
+
+
+def derive_days_since_last_race(data):
+    """ Days since each row's previous start by the same horse, from the date and horse_name columns of data.
+        NaN where there's no earlier start to measure from or the row is missing its horse or date.
+    """
+    names = data['horse_name']
+    horses = names.astype(str).str.strip().str.upper().where(names.notna())
+    starts = pd.DataFrame({'horse': horses, 'date': pd.to_datetime(data['date'], errors='coerce')},
+                          index=data.index).dropna()
+    starts = starts.sort_values(['horse', 'date'], kind='stable')
+
+    gaps = starts.groupby('horse', sort=False)['date'].diff().dt.days
+    gaps = gaps.where(gaps > 0)
+    return gaps.reindex(data.index)
+
+
+def settle_days_since_last_race(db, table='horses_consolidated_performances', batch_size=1000):
+    """ Fills in days_since_last_race for every row of table that's missing it and has an earlier start to measure
+        from, using the QueryDB db. Rows whose value disagrees with the derived one are logged, not changed.
+        Returns the number of values filled in and the number of disagreements.
+    """
+    fields = ['id', *UNIQUE, 'days_since_last_race']
+    data = pd.DataFrame(db.query_db(db.generate_query(table, fields)), columns=fields)
+    print(f'Deriving days_since_last_race for {len(data)} rows of {table}')
+
+    derived = derive_days_since_last_race(data)
+    existing = pd.to_numeric(data['days_since_last_race'], errors='coerce')
+    blank = derived.notna() & existing.isna()
+    disagreed = derived.notna() & existing.notna() & (existing != derived)
+    fills = data.loc[blank, fields].assign(derived=derived[blank].astype(np.int64))
+
+    with ChangeJournal(table, table, lambda: dict()) as journal:
+        journal.resolvers.append(RESOLVER)
+        for start in range(0, len(fills), batch_size):
+            batch = fills.iloc[start:start + batch_size]
+            db.update_db(db.generate_update_by_id_query(table, 'days_since_last_race',
+                                                        dict(zip(batch['id'], batch['derived']))))
+            for row in batch.itertuples(index=False):
+                journal.record_update([getattr(row, column) for column in UNIQUE], ['days_since_last_race'],
+                                      [None], [int(row.derived)])
+
+    with IssueLog('days_since_last_race_unfixed_data', table) as unfixed_data:
+        disagreements = data.loc[disagreed, UNIQUE].assign(derived=derived[disagreed], existing=existing[disagreed])
+        for row in disagreements.itertuples(index=False):
+            race_key = f'{row.date}{row.track}{row.race_num}{str(row.horse_name).upper()}'
+            unfixed_data.record(race_key, 'days_since_last_race', int(row.derived), int(row.existing))
+        print(unfixed_data.summary())
+
+    filled = len(fills)
+    print(f'days_since_last_race: {filled} filled in, {len(disagreements)} disagreeing values logged, '
+          f'{int(derived.isna().sum())} without an earlier start left alone')
+    return filled, len(disagreements)
@@ -1,8 +1,41 @@
 import logging
+import os
 import MySQLdb
 import re
 
-logging.basicConfig(filename='db_handler.log', filemode='w', level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+def configure_logging(filename='db_handler.log', level=logging.DEBUG):
+    """ Sends the database log to filename, starting it fresh. Entry points call this; importing the module leaves
+        logging alone.
+    """
+    if any(getattr(handler, 'baseFilename', None) == os.path.abspath(filename) for handler in logger.handlers):
+        return
+    handler = logging.FileHandler(filename, mode='w')
+    handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+
+
+def create_table_sql(table_name, dtypes, unique_key, foreign_key):
+    """The CREATE TABLE statement for table_name, with an auto-increment id as the primary key."""
+    sql = f'CREATE TABLE {table_name} ('
+    sql += 'id INT NOT NULL AUTO_INCREMENT, '
+    for column_name, column_dtype in dtypes.items():
+        sql += f'{column_name} {column_dtype}, '
+    sql += 'PRIMARY KEY (id)'
+    if unique_key:
+        sql += ', UNIQUE ('
+        for key in unique_key:
+            sql += key + ', '
+        sql = sql[:-2]  # Chop off last ', '
+        sql += ")"
+    if foreign_key:
+        for constraint in foreign_key:
+            sql += f', FOREIGN KEY({constraint[0]}) REFERENCES {constraint[1]} '
+    sql += ')'          # ... and balance parentheses before sending.
+    return sql
 
 
 class QueryDB:
@@ -42,6 +75,35 @@ class QueryDB:
         if print_query: print(sql)
         return sql
 
+    def generate_case_update_query(self, table, field, value_map, print_query=False):
+        """ Generates a single UPDATE that rewrites each old value of field in value_map to its new value. The old
+            values are matched exactly as given, so they're escaped but not cleaned.
+        """
+        value_map = {self.escape(old): self.escape_and_clean(new) for old, new in value_map.items()}
+        cases = ' '.join(f"WHEN '{old}' THEN '{new}'" for old, new in value_map.items())
+        old_values = ', '.join(f"'{old}'" for old in value_map.keys())
+        # BINARY makes the match case-sensitive so only the listed spellings are touched
+        sql = f'UPDATE {table} SET {field} = CASE BINARY {field} {cases} ELSE {field} END '
+        sql += f'WHERE BINARY {field} IN ({old_values})'
+        if print_query: print(sql)
+        return sql
+
+    def generate_update_by_id_query(self, table, field, values_by_id, print_query=False):
+        """Generates a single UPDATE that sets field in each row of values_by_id ({id: value}) to that row's value."""
+        cases = ' '.join(f"WHEN {int(row_id)} THEN '{self.escape_and_clean(value)}'"
+                         for row_id, value in values_by_id.items())
+        ids = ', '.join(str(int(row_id)) for row_id in values_by_id)
+        sql = f'UPDATE {table} SET {field} = CASE id {cases} ELSE {field} END WHERE id IN ({ids})'
+        if print_query: print(sql)
+        return sql
+
+    def generate_insert_query(self, table, field_list, rows, print_query=False):
+        """Generates a single INSERT that adds every row in rows (each a list of values in field_list order)."""
+        values = ', '.join('(' + ', '.join(f"'{self.escape_and_clean(item)}'" for item in row) + ')' for row in rows)
+        sql = f'INSERT INTO {table} ({", ".join(field_list)}) VALUES {values}'
+        if print_query: print(sql)
+        return sql
+
     def update_db(self, sql_query):
         cursor = self.connection.cursor()
         self._use_db(self.connection, cursor)
@@ -56,8 +118,11 @@ class QueryDB:
         pairs = [f'{field} = \'{value}\'' for field, value in zip(field_list, value_list)]
         return separator.join(pairs)
 
+    def escape(self, item):
+        return re.sub(r"(['\\])", r'\\\1', str(item))   # Escape textual backslashes and tick marks
+
     def escape_and_clean(self, item):
-        escaped_item = re.sub(r"(['\\])", r'\\\1', str(item))   # Escape textual backslashes and tick marks
+        escaped_item = self.escape(item)
         cleaned_item = re.sub(u"\uFFFD", "", escaped_item)      # Fix oddball <?> character
         return cleaned_item.strip()                             # Strip off any leading or trailing whitespace
 
@@ -105,7 +170,7 @@ class QueryDB:
         cursor.execute(sql)
         table_exists = [item for item in cursor][0][0]
         if table_exists:
-            logging.info(f'Table {table_name} already exists--skipping creation step.')
+            logger.info(f'Table {table_name} already exists--skipping creation step.')
         elif table_exists == 0:
             self._create_table(self.connection, cursor, table_name, dtypes, unique_key, foreign_key)
         else:
@@ -120,28 +185,14 @@ class QueryDB:
         db.commit()
 
     def _create_table(self, db, cursor, table_name, dtypes, unique_key, foreign_key):
-        logging.info(f'Creating table {table_name}')
-        sql = f'CREATE TABLE {table_name} ('
-        sql += 'id INT NOT NULL AUTO_INCREMENT, '
-        for column_name, column_dtype in dtypes.items():
-            sql += f'{column_name} {column_dtype}, '
-        sql += 'PRIMARY KEY (id)'
-        if unique_key:
-            sql += ', UNIQUE ('
-            for key in unique_key:
-                sql += key + ', '
-            sql = sql[:-2]  # Chop off last ', '
-            sql += ")"
-        if foreign_key:
-            for constraint in foreign_key:
-                sql += f', FOREIGN KEY({constraint[0]}) REFERENCES {constraint[1]} '
-        sql += ')'          # ... and balance parentheses before sending.
-        logging.info(f'Creating table {table_name}:\n\t{sql}')
+        logger.info(f'Creating table {table_name}')
+        sql = create_table_sql(table_name, dtypes, unique_key, foreign_key)
+        logger.info(f'Creating table {table_name}:\n\t{sql}')
         try:
             cursor.execute(sql)
         except MySQLdb.ProgrammingError as e:
             print(f'Error creating table {table_name}:\n\t{sql}\n\t{e}')
-            logging.info(f'Error creating table{table_name}:\n\t{sql}')
+            logger.info(f'Error creating table{table_name}:\n\t{sql}')
         db.commit()
 
     def _insert_records(self, db, cursor, table_name, table_data, sql_col_names, print_sql=False):
@@ -159,11 +210,11 @@ class QueryDB:
                 cursor.execute(sql)
             except (MySQLdb.ProgrammingError, MySQLdb.IntegrityError) as e:
                 if re.search(r'Duplicate entry', repr(e)):
-                    logging.debug(f'Duplicate entry: \n\t{e}')
-                    logging.debug(f'\t{i+1} of {len(table_data)}: {sql}')
+                    logger.debug(f'Duplicate entry: \n\t{e}')
+                    logger.debug(f'\t{i+1} of {len(table_data)}: {sql}')
                 else:
-                    logging.info(f'Error adding entry: \n\t{e}')
-                    logging.info(f'\t{i+1} of {len(table_data)}: {sql}')
+                    logger.info(f'Error adding entry: \n\t{e}')
+                    logger.info(f'\t{i+1} of {len(table_data)}: {sql}')
         db.commit()
 
     def _send_query_and_commit(self, query):
@@ -1,6 +1,10 @@
+from race_conditions_parser import ParsedConditionsTable
+
+
 class Fixer:
 
-    def __init__(self, column_name, source_data_handler, consolidated_db_handler, verbose=False):
+    def __init__(self, column_name, source_data_handler, consolidated_db_handler, source_conditions=None,
+                 consolidated_conditions=None, parsed_conditions=None, verbose=False):
         self.column_name = column_name
         self.source_db = source_data_handler
         self.consolidated_db = consolidated_db_handler
@@ -9,11 +13,19 @@ class Fixer:
         self.new_data = None
         self.existing_data = None
         self.current_race_id = None
+        self.current_race_key = None            # Race key without horse name; used to look up race conditions
 
         self.source_table_structure = self.source_db.get_table_structure()
 
-        self.current_source_race_conditions = None          # Set by set_race_conditions()
-        self.current_consolidated_race_conditions = None    # Set by set_race_conditions()
+        # Shared RaceConditionsStores; the conditions text is only read when a fixer asks for it
+        self.source_conditions = source_conditions
+        self.consolidated_conditions = consolidated_conditions
+
+        # Shared ParsedConditionsTable holding the structured facts pulled out of the conditions text
+        self.parsed_conditions = parsed_conditions if parsed_conditions is not None else ParsedConditionsTable()
+
+        # Discrepancies that need a person go to the processor's ReviewQueue instead of stopping for input
+        self.review_queue = None
 
     def fix_discrepancy(self, new_data, existing_data, race_id=None):
         """ Primary function of class. Attempts to fix a discrepancy in the data for its assigned column.
@@ -28,26 +40,36 @@ class Fixer:
     def update_value(self, field, value):
         raise NotImplementedError()
 
-    def set_race_conditions(self):
-        race_condition_fields = ['race_conditions_text_1', 'race_conditions_text_2', 'race_conditions_text_3',
-                                 'race_conditions_text_4', 'race_conditions_text_5', 'race_conditions_text_6']
-        source_race_condition_fields = [self.source_table_structure[key] for key in race_condition_fields if self.source_table_structure[key]]
-        if not any(source_race_condition_fields):
-            source_race_conditions = None
-        else:
-            source_race_conditions = self.source_db.get_values(source_race_condition_fields, self.current_race_id_sql)
-            text = ''
-            for item in source_race_conditions:
-                text += item if item else ''
-            source_race_conditions = text
-
-        consolidated_race_conditions = ''
-        for item in self.consolidated_db.get_values(race_condition_fields, self.current_race_id_sql):
-            if item:
-                consolidated_race_conditions += item
-
-        self.current_source_race_conditions = source_race_conditions
-        self.current_consolidated_race_conditions = consolidated_race_conditions
+    def request_review(self, reason, proposed=None, current=None, **context):
+        """ Queues the current discrepancy for a person to settle later rather than asking now. proposed ({field:
+            value}) is what the fixer recommends writing, if anything, and current the values those fields have now.
+        """
+        if self.review_queue is None:
+            return
+        context = dict({'source_race_conditions': self.current_source_race_conditions,
+                        'consolidated_race_conditions': self.current_consolidated_race_conditions}, **context)
+        self.review_queue.submit(self.column_name, self.new_data, self.existing_data, reason, type(self).__name__,
+                                 proposed, current, context)
+
+    @property
+    def current_source_race_conditions(self):
+        if self.source_conditions is None:
+            return None
+        return self.source_conditions.get(self.current_race_key)
+
+    @property
+    def current_consolidated_race_conditions(self):
+        if self.consolidated_conditions is None:
+            return None
+        return self.consolidated_conditions.get(self.current_race_key)
+
+    @property
+    def current_source_conditions_facts(self):
+        return self.parsed_conditions.get(self.current_source_race_conditions)
+
+    @property
+    def current_consolidated_conditions_facts(self):
+        return self.parsed_conditions.get(self.current_consolidated_race_conditions)
 
     def print_race_info(self):
         raise NotImplementedError()
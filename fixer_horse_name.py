@@ -1,6 +1,5 @@
 
 from FixerPerformancesGeneric import FixerPerformancesGeneric
-from titlecase import titlecase
 
 
 class FixerHorseName(FixerPerformancesGeneric):
@@ -16,43 +15,39 @@ class FixerHorseName(FixerPerformancesGeneric):
         self.current_race_id = race_id
         self.current_race_id_sql = None             # Passed in via kwargs
         self.current_race_id_sql_horse = None       # Passed in via kwargs
-
-        self.current_consolidated_race_conditions = None
-        self.current_source_race_conditions = None
+        self.current_race_key = None                # Passed in via kwargs
 
         for key, arg in kwargs.items():
             setattr(self, key, arg)
 
-        self.set_race_conditions()
-
         self.best_name = self.get_best_name()
 
         if self.verbose:
             self.print_race_info()
-            input('Press enter to continue')
 
             if self.best_name:
                 print(f'Recommend using {self.best_name}')
-                response = input(f'Update data to use {self.best_name}? Y/n ').lower()
-                if response != 'n' and self.best_name != self.existing_data:
-                    self.update_value(self.column_name, self.best_name)
-                    print('Existing data updated')
+                if self.best_name != self.existing_data:
+                    self.request_review('recommended_update', {self.column_name: self.best_name})
             else:
                 print(f'No name suggestions found')
+                self.request_review('no_recommendation')
         else:
             if self.best_name is not None and self.best_name != self.existing_data:
                 self.update_value(self.column_name, self.best_name)
             elif self.best_name is None:
                 self.print_race_info()
-                # input('Press enter to continue')
+                # self.request_review('no_recommendation')
 
         return self.discrepancy_resolved()
 
     def get_best_name(self):
+        from titlecase import titlecase
         if self.title_cases_match:
             return titlecase(self.existing_data)
 
     def title_cases_match(self):
+        from titlecase import titlecase
         if titlecase(self.new_data) == titlecase(self.existing_data):
             return True
         else:
@@ -1,7 +1,6 @@
 from FixerPerformancesGeneric import FixerPerformancesGeneric
 import math
 import numpy as np
-from prettytable import PrettyTable
 
 
 class FixerLeadOrBeaten(FixerPerformancesGeneric):
@@ -16,35 +15,28 @@ class FixerLeadOrBeaten(FixerPerformancesGeneric):
         self.current_race_id = race_id
         self.current_race_id_sql = None         # Passed in via kwargs
         self.current_race_id_sql_horse = None   # Passed in via kwargs
-
-        self.current_consolidated_race_conditions = None
-        self.current_source_race_conditions = None
+        self.current_race_key = None            # Passed in via kwargs
 
         for key, arg in kwargs.items():
             setattr(self, key, arg)
 
-        self.set_race_conditions()
-
         self.best_value = self.find_best_value()
 
         if self.verbose:
             self.print_race_info()
             if self.best_value:
                 print(f'\nRecommended value to use: {self.best_value}')
-                response = input(f'Use recommended value ({self.best_value})? Y/n ').lower()
-                if response != 'n' and self.best_value != self.existing_data:
-                    self.update_value(self.column_name, self.best_value)
-                    print(f'Value updated.')
+                if self.best_value != self.existing_data:
+                    self.request_review('recommended_update', {self.column_name: self.best_value})
             else:
                 print(f'\nCould not resolved discrepancy--no change recommendation')
-            input('Press enter to continue')
+                self.request_review('no_recommendation')
         else:
             if self.best_value and self.best_value != self.existing_data:
                 self.update_value(self.column_name, self.best_value)
             elif self.best_value is None and abs(self.new_data - self.existing_data) > 0.11:
                 # Not reviewing very minor discrepancies at this point...
-                # self.print_race_info()
-                # input('Press enter to continue')
+                # self.request_review('no_recommendation')
                 pass
 
         return self.discrepancy_resolved()
@@ -56,6 +48,7 @@ class FixerLeadOrBeaten(FixerPerformancesGeneric):
             return True
 
     def print_discrepancy_table(self):
+        from prettytable import PrettyTable     # Only needed for interactive review
 
         def not_empty(value):
             if value is None or np.isnan(value):
@@ -118,6 +111,67 @@ class FixerLeadOrBeaten(FixerPerformancesGeneric):
         # error and no resolution is found.
         return None
 
+    def fix_discrepancies(self, batch):
+        """ Batch version of find_best_value() for a whole lead_or_beaten column.
+
+            batch holds parallel arrays under the keys 'new_data' and 'existing_data' (a dict of arrays or a
+            DataFrame both work). Returns a tuple of (best_values, resolved), where best_values holds the chosen
+            margin for each row (NaN where no resolution was found) and resolved is a boolean mask. The choices
+            match what find_best_value() would return for each row; nothing is written to the database.
+
+        """
+        new_data = np.asarray(batch['new_data'], dtype=float)
+        existing_data = np.asarray(batch['existing_data'], dtype=float)
+        best_values = np.full(new_data.shape, np.nan)
+
+        # Rows with a blank value never reach the scalar fixer, so leave them unresolved here too.
+        candidates = ~(np.isnan(new_data) | np.isnan(existing_data))
+
+        # Mirrors the check in find_best_value(), which only rejects when existing_data exceeds new_data by
+        # more than one.
+        candidates &= ~(existing_data - new_data > 1)
+
+        new_precision = self.get_precisions(np.where(candidates, new_data, 0))
+        existing_precision = self.get_precisions(np.where(candidates, existing_data, 0))
+        new_round = self.are_round(new_data)
+        existing_round = self.are_round(existing_data)
+
+        use_new = candidates & (new_precision > existing_precision)
+        use_existing = candidates & (existing_precision > new_precision)
+        same_precision = candidates & (new_precision == existing_precision)
+        use_existing |= same_precision & new_round & ~existing_round
+        use_new |= same_precision & existing_round & ~new_round
+
+        best_values[use_new] = new_data[use_new]
+        best_values[use_existing] = existing_data[use_existing]
+        resolved = use_new | use_existing
+
+        return best_values, resolved
+
+    def get_precisions(self, nums):
+        """Vectorized get_precision() for an array of finite values."""
+        max_digits = 14
+        nums = np.abs(np.asarray(nums, dtype=float))
+        int_part = np.trunc(nums).astype(np.int64)
+        magnitude = np.ones(nums.shape, dtype=np.int64)
+        nonzero = int_part != 0
+        magnitude[nonzero] = (np.log10(int_part[nonzero]) + 1).astype(np.int64)
+        fractional_part = nums - int_part
+        multiplier = np.power(10, max_digits - magnitude, dtype=np.int64)
+        fractional_digits = multiplier + np.trunc(multiplier * fractional_part + 0.5).astype(np.int64)
+
+        # Strip trailing zeros; there are never more than max_digits of them.
+        trailing_zero = fractional_digits % 10 == 0
+        while trailing_zero.any():
+            fractional_digits[trailing_zero] //= 10
+            trailing_zero = fractional_digits % 10 == 0
+        return np.log10(fractional_digits).astype(np.int64)
+
+    def are_round(self, nums):
+        """Vectorized is_round()."""
+        nums = np.asarray(nums, dtype=float)
+        return np.mod(np.mod(nums, 1), 0.5) == 0
+
     def get_precision(self, num):
         max_digits = 14
         int_part = int(abs(num))
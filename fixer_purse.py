@@ -10,19 +10,15 @@ class FixerPurse(FixerRacesGeneric):
         self.new_data = new_data
         self.existing_data = existing_data
         self.current_race_id = race_id
+        self.current_race_key = race_id
         self.current_race_id_sql = None
 
-        self.current_consolidated_race_conditions = None
-        self.current_source_race_conditions = None
-
         for key, arg in kwargs.items():
             setattr(self, key, arg)
 
-        self.set_race_conditions()
-
         if self.verbose:
             self.print_race_info()
-            input('Press enter to continue')
+            self.request_review('no_recommendation')
 
         return self.discrepancy_resolved()
 
@@ -1,49 +1,100 @@
 from FixerRacesGeneric import FixerRacesGeneric
-from prettytable import PrettyTable
-import re
+import numpy as np
+import pandas as pd
+
+
+RACE_TYPES = {
+    # 'N' is almost always on results_bris
+    # Format: best_descriptor: [weaker, descriptors]
+    'N': ['FNL', 'SPI'],            # other_stakes
+    'G1': ['STK', 'N'],             # grade_1_stakes
+    'G2': ['STK', 'CHM', 'N'],      # grade_2_stakes
+    'G3': ['STK', 'N'],             # grade_3_stakes
+    'STK': ['N'],                   # nongraded_stakes
+    'HCP': ['A', 'N'],              # handicap
+    'SHP': ['T', 'N'],              # starter handicap
+    'ALW': ['A'],                   # allowance
+    'AOC': ['AO'],                  # allowance_optional_claiming
+    'STR': ['R', 'STA'],            # starter_allowance
+    'SOC': ['CO', 'N', 'OCL'],      # starter_optional_claiming
+    'CLM': ['C'],                   # claiming
+    'WCL': ['C', 'N'],              # waiver_claiming
+    'MSW': ['S', 'MDN', 'N'],       # maiden_special_weight
+    'MOC': ['MO'],                  # maiden_optional_claiming
+    'MCL': ['M'],                   # maiden_claiming
+    'WMC': ['WMC'],                 # waiver maiden claiming
+    'FUT': ['N'],                   # Futurity
+    'DTR': ['N'],                   # Derby Trial
+    'TRL': ['STR', 'N', 'SPT'],            # Trials
+    'DBY': ['N'],                   # QH Derby
+    'OTH': ['FTR', 'FCN', 'INS', 'HDS', 'SST', 'MAT', 'N'],   # Misc others
+    # todo: FIX DUPE 'STR': ['N'],                   # Trials
+    # 'FTR': ['N'],                   # Futurity Trials
+    # 'FCN': ['N'],                   # Futurity Consolation
+    # 'INS': ['N'],                   # Invitational Stakes
+    # 'HDS': ['N'],                   # Handicap Stakes
+    # 'TRL': ['N'],                   # Trials?
+    # 'SST': ['N'],                   # Starter Stakes
+    # 'MAT': ['N'],                   # Hialeah Maturity?
+    # 'MTR': [],                      # Maturity Trials?
+    # 'MDT': ['N'],                   # Maiden Trials?
+
+    # SPI--Speed Index Race
+    # FNL--Final
+}
+
+# Codes that secondary_race_types() lumps together as 'OTH' without looking at the race conditions
+OTHER_RACE_TYPES = ['FTR', 'FCN', 'INS', 'HDS', 'TRL', 'SST', 'MAT']
+
+
+def resolve_race_type_pair(new_data, existing_data):
+    """ The part of FixerRaceType.get_best_race_type() that only depends on the two codes.
+
+        Returns the best descriptor, or None if resolving the pair needs the race conditions or other race info.
+    """
+    # If the best race descriptor is the new_data, use that
+    if new_data in RACE_TYPES and existing_data in RACE_TYPES[new_data]:
+        return new_data
+    # If the best race_descriptor is the existing_data, use that.
+    elif existing_data in RACE_TYPES and new_data in RACE_TYPES[existing_data]:
+        return existing_data
+    else:
+        # Search through each value set to see if only second-best values are in the test data
+        # 'N', 'STR', etc. are excluded because it spans multiple best-descriptor listings
+        excluded_list = ['N', 'STR']
+        for key, value in RACE_TYPES.items():
+            if new_data in value and new_data.upper() not in excluded_list:
+                return key
+            elif existing_data in value and existing_data.upper() not in excluded_list:
+                return key
+        # Misc. other types that are not being separately treated at this time.
+        if existing_data.upper() in OTHER_RACE_TYPES or new_data.upper() in OTHER_RACE_TYPES:
+            return 'OTH'
+        return None
+
+
+def build_race_type_lookup():
+    """ Compiles every (new, existing) pair of known race type codes that resolves without the race conditions
+        into a {(new_data, existing_data): best_descriptor} table.
+    """
+    codes = set(RACE_TYPES) | {code for value in RACE_TYPES.values() for code in value} | set(OTHER_RACE_TYPES)
+    lookup = dict()
+    for new_data in codes:
+        for existing_data in codes:
+            best_descriptor = resolve_race_type_pair(new_data, existing_data)
+            if new_data != existing_data and best_descriptor is not None:
+                lookup[(new_data, existing_data)] = best_descriptor
+    return lookup
+
+
+RACE_TYPE_LOOKUP = build_race_type_lookup()
+RACE_TYPE_LOOKUP_SERIES = pd.Series(list(RACE_TYPE_LOOKUP.values()),
+                                    index=pd.MultiIndex.from_tuples(list(RACE_TYPE_LOOKUP.keys())))
 
 
 class FixerRaceType(FixerRacesGeneric):
 
-    race_types = {
-        # 'N' is almost always on results_bris
-        # Format: best_descriptor: [weaker, descriptors]
-        'N': ['FNL', 'SPI'],            # other_stakes
-        'G1': ['STK', 'N'],             # grade_1_stakes
-        'G2': ['STK', 'CHM', 'N'],      # grade_2_stakes
-        'G3': ['STK', 'N'],             # grade_3_stakes
-        'STK': ['N'],                   # nongraded_stakes
-        'HCP': ['A', 'N'],              # handicap
-        'SHP': ['T', 'N'],              # starter handicap
-        'ALW': ['A'],                   # allowance
-        'AOC': ['AO'],                  # allowance_optional_claiming
-        'STR': ['R', 'STA'],            # starter_allowance
-        'SOC': ['CO', 'N', 'OCL'],      # starter_optional_claiming
-        'CLM': ['C'],                   # claiming
-        'WCL': ['C', 'N'],              # waiver_claiming
-        'MSW': ['S', 'MDN', 'N'],       # maiden_special_weight
-        'MOC': ['MO'],                  # maiden_optional_claiming
-        'MCL': ['M'],                   # maiden_claiming
-        'WMC': ['WMC'],                 # waiver maiden claiming
-        'FUT': ['N'],                   # Futurity
-        'DTR': ['N'],                   # Derby Trial
-        'TRL': ['STR', 'N', 'SPT'],            # Trials
-        'DBY': ['N'],                   # QH Derby
-        'OTH': ['FTR', 'FCN', 'INS', 'HDS', 'SST', 'MAT', 'N'],   # Misc others
-        # todo: FIX DUPE 'STR': ['N'],                   # Trials
-        # 'FTR': ['N'],                   # Futurity Trials
-        # 'FCN': ['N'],                   # Futurity Consolation
-        # 'INS': ['N'],                   # Invitational Stakes
-        # 'HDS': ['N'],                   # Handicap Stakes
-        # 'TRL': ['N'],                   # Trials?
-        # 'SST': ['N'],                   # Starter Stakes
-        # 'MAT': ['N'],                   # Hialeah Maturity?
-        # 'MTR': [],                      # Maturity Trials?
-        # 'MDT': ['N'],                   # Maiden Trials?
-
-        # SPI--Speed Index Race
-        # FNL--Final
-    }
+    race_types = RACE_TYPES
 
     def fix_discrepancy(self, new_data, existing_data, race_id=None, full_info=None, **kwargs):
 
@@ -53,28 +104,22 @@ class FixerRaceType(FixerRacesGeneric):
         self.new_data = new_data
         self.existing_data = existing_data
         self.current_race_id = race_id
+        self.current_race_key = race_id
         self.current_race_id_sql = None
 
-        self.current_consolidated_race_conditions = None
-        self.current_source_race_conditions = None
-
         for key, arg in kwargs.items():
             setattr(self, key, arg)
 
-        self.set_race_conditions()
-
         self.best_race_descriptor = self.get_best_race_type()
 
         if self.verbose:
             self.print_race_info()
-            if self.best_race_descriptor is not None:
+            if self.best_race_descriptor is None:
+                self.request_review('no_recommendation')
+            else:
                 print(f'\nRecommended race descriptor: {self.best_race_descriptor}')
-                if self.best_race_descriptor is not self.existing_data:
-                    response = input(f'Update data to {self.best_race_descriptor}? Y/n ').lower()
-                    if response != 'n':
-                        self.update_value(self.column_name, self.best_race_descriptor)
-                        print(f'Data updated')
-            input('Press enter to continue')
+                if self.best_race_descriptor != self.existing_data:
+                    self.request_review('recommended_update', {self.column_name: self.best_race_descriptor})
         else:
             if self.best_race_descriptor is not None and self.best_race_descriptor is not self.existing_data:
                 self.update_value(self.column_name, self.best_race_descriptor)
@@ -89,49 +134,58 @@ class FixerRaceType(FixerRacesGeneric):
         else:
             return True
 
+    def fix_discrepancies(self, batch):
+        """ Batch race_type resolution for a whole column using the precompiled lookup table.
+
+            batch holds parallel arrays under the keys 'new_data' and 'existing_data' (a dict of arrays or a
+            DataFrame both work). Returns a tuple of (best_descriptors, resolved). Pairs that need the race
+            conditions to resolve come back with resolved False and a descriptor of None; those should go through
+            fix_discrepancy() one at a time. Nothing is written to the database.
+        """
+        pairs = pd.MultiIndex.from_arrays([np.asarray(batch['new_data'], dtype=object),
+                                           np.asarray(batch['existing_data'], dtype=object)])
+        best_descriptors = RACE_TYPE_LOOKUP_SERIES.reindex(pairs).values
+        resolved = pd.notna(best_descriptors)
+        best_descriptors = np.where(resolved, best_descriptors, None)
+        return best_descriptors, resolved
+
     def get_best_race_type(self):
-        # If the best race descriptor is the new_data, use that
-        if self.new_data in self.race_types and self.existing_data in self.race_types[self.new_data]:
-            return self.new_data
-        # If the best race_descriptor is the existing_data, use that.
-        elif self.existing_data in self.race_types and self.new_data in self.race_types[self.existing_data]:
-            return self.existing_data
+        # Most pairs of codes are in the precompiled table
+        best_descriptor = RACE_TYPE_LOOKUP.get((self.new_data, self.existing_data))
+        if best_descriptor is not None:
+            return best_descriptor
+
+        # Codes outside the table's domain can still resolve on their own; otherwise check the race conditions
+        best_descriptor = resolve_race_type_pair(self.new_data, self.existing_data)
+        if best_descriptor is not None:
+            return best_descriptor
+        last_chance = self.secondary_race_types()
+        if last_chance != None:
+            return last_chance
         else:
-            # Search through each value set to see if only second-best values are in the test data
-            # 'N', 'STR', etc. are excluded because it spans multiple best-descriptor listings
-            excluded_list = ['N', 'STR']
-            for key, value in self.race_types.items():
-                if self.new_data in value and self.new_data.upper() not in excluded_list:
-                    return key
-                elif self.existing_data in value and self.existing_data.upper() not in excluded_list:
-                    return key
-            last_chance = self.secondary_race_types()
-            if last_chance != None:
-                return last_chance
-            else:
-                print(
-                    f'\nCould not find known race type in new data ({self.new_data}) or existing data ({self.existing_data})')
-                self.print_race_info()
-                return None
+            print(
+                f'\nCould not find known race type in new data ({self.new_data}) or existing data ({self.existing_data})')
+            self.print_race_info()
+            return None
 
     def secondary_race_types(self):
         """ Looks through other miscellaneous possible race type markers to try to determine a race type"""
+        conditions_facts = self.conditions_facts()
+
         # Misc. other types that are not being separately treated at this time.
-        if self.new_or_existing_data_in_group(['FTR', 'FCN', 'INS', 'HDS', 'TRL', 'SST', 'MAT']):
+        if self.new_or_existing_data_in_group(OTHER_RACE_TYPES):
             return 'OTH'
-        elif self.new_or_existing_data_in_group(['WMC', 'MCL']) and self.conditions_start_with_string('WAIVER MAIDEN CLAIMING'):
+        elif self.new_or_existing_data_in_group(['WMC', 'MCL']) and \
+                any(facts.waiver_maiden_claiming for facts in conditions_facts):
             return 'WMC'
-        elif self.new_or_existing_data_in_group(['STR']) and self.conditions_start_with_string('TRIALS'):
+        elif self.new_or_existing_data_in_group(['STR']) and any(facts.trials for facts in conditions_facts):
             return 'TRL'
-        elif self.conditions_start_with_string('TRIALS.'):
+        elif any(facts.trials for facts in conditions_facts):
             return 'TRL'
         elif self.new_or_existing_data_in_group(['G1', 'G2', 'G3']):
-            if self.conditions_contain_string('Grade I.'):
-                return 'G1'
-            if self.conditions_contain_string('Grade II.'):
-                return 'G2'
-            if self.conditions_contain_string('Grade III.'):
-                return 'G3'
+            for grade, descriptor in [(1, 'G1'), (2, 'G2'), (3, 'G3')]:
+                if any(facts.grade == grade for facts in conditions_facts):
+                    return descriptor
         elif self.existing_data.upper() == 'SHP' and (self.pps_bris_race_type == 'T' or self.results_bris_race_type == 'T'):
             return 'SHP'
 
@@ -139,6 +193,7 @@ class FixerRaceType(FixerRacesGeneric):
             return None
 
     def print_discrepancy_table(self):
+        from prettytable import PrettyTable     # Only needed for interactive review
         self.results_bris_race_type = self.consolidated_db.get_value('results_bris_race_type', self.current_race_id_sql)
         self.results_equibase_race_type = self.consolidated_db.get_value('results_equibase_race_type', self.current_race_id_sql)
         self.pps_bris_race_type = self.consolidated_db.get_value('pps_bris_race_type', self.current_race_id_sql)
@@ -151,21 +206,10 @@ class FixerRaceType(FixerRacesGeneric):
         table.add_row(['', self.results_bris_race_type, self.pps_bris_race_type, self.results_equibase_race_type])
         print(f'\n{table}')
 
-    def conditions_contain_string(self, string):
-        if self.current_source_race_conditions is not None and re.search(r'{}'.format(string), self.current_source_race_conditions):
-            return True
-        elif self.current_consolidated_race_conditions is not None and re.search(r'{}'.format(string), self.current_consolidated_race_conditions):
-            return True
-        else:
-            return False
-
-    def conditions_start_with_string(self, string):
-        if self.current_source_race_conditions is not None and re.match(r'{}'.format(string), self.current_source_race_conditions):
-            return True
-        elif self.current_consolidated_race_conditions is not None and re.match(r'{}'.format(string), self.current_consolidated_race_conditions):
-            return True
-        else:
-            return False
+    def conditions_facts(self):
+        """Returns the parsed ConditionsFacts for whichever of the source and consolidated conditions exist."""
+        facts = [self.current_source_conditions_facts, self.current_consolidated_conditions_facts]
+        return [item for item in facts if item is not None]
 
     def new_or_existing_data_in_group(self, group):
         if (self.existing_data.upper() in group or self.new_data.upper() in group):
@@ -0,0 +1,326 @@
+# Per-horse history index over horses_consolidated_performances, for looking up a horse's previous starts.
+#
+# Every start is kept in one set of column arrays sorted by horse and then date, so each horse's history is a
+# contiguous, date-sorted segment; offsets.npy holds where each horse's segment starts. The arrays are saved as .npy
+# files and memory-mapped when the index is opened, so opening it costs nothing and lookups only touch the pages they
+# read. last_starts() answers "the last n starts before date D" for a whole batch of horses with a few vectorized
+# searches over a sorted (horse, date) key array.
+#
+# Each save is a new generation directory under the index directory; CURRENT names the live one, so readers never
+# see a half-written index. update() adds the rows inserted since the last save (by id) and re-reads the rows the
+# change journal (journal.py) shows were updated in place since then, e.g. by the days_since_last_race stage; the
+# new starts are merged into the sorted arrays rather than sorting the whole index again. Writes that weren't
+# journaled, or a rewrite of horse names, need a rebuild. Run from the repository root:
+#     python horse_history.py             # add the performances consolidated since the last update
+#     python horse_history.py --rebuild   # index the whole table again
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import db_handler as dbh
+import journal
+from constants.constant_aggregated_performances_unique import UNIQUE
+from constants.constant_horse_performances_consolidated_table_structure import CONSOLIDATED_TABLE_STRUCTURE
+
+
+HISTORY_DIR = os.path.join('logs', 'horse_history')
+HISTORY_TABLE = 'horses_consolidated_performances'
+
+# Columns kept for every start besides the horse and date. Text columns are stored as codes into a vocabulary.
+HISTORY_COLUMNS = {column: value[0] for column, value in CONSOLIDATED_TABLE_STRUCTURE.items()
+                   if column not in ['horse_name', 'date', 'source_file']}
+
+DATE_BIAS = 2**31       # Keeps days before 1970 positive in the (horse, date) keys
+
+
+def array_dtype(sql_dtype):
+    """The numpy dtype a column of sql_dtype is stored as; None for text columns, which are stored as codes."""
+    sql_dtype = sql_dtype.upper()
+    if sql_dtype.startswith('VARCHAR'):
+        return None
+    if sql_dtype == 'DATE':
+        return np.dtype('datetime64[D]')
+    if sql_dtype == 'INT':
+        return np.dtype('float64')          # Integers are floats so missing values can be NaN
+    return np.dtype('float32')
+
+
+def horse_key(names):
+    """Horse names as they're matched in the index: stripped and upper-cased, the way the race_ids compare them."""
+    names = pd.Series(names)
+    return names.astype(str).str.strip().str.upper().where(names.notna())
+
+
+def history_keys(horse_codes, dates):
+    """Sort keys ordering starts by horse, then date."""
+    return (horse_codes.astype(np.int64) << 32) | (dates.astype(np.int64) + DATE_BIAS)
+
+
+class HorseHistoryIndex:
+    # The HorseHistoryIndex class is a read-only view of one saved generation of the index. The arrays are
+    # memory-mapped; horses and the text vocabularies are loaded from the generation's meta.json.
+
+    def __init__(self, directory=HISTORY_DIR):
+        with open(os.path.join(directory, 'CURRENT')) as file:
+            self.generation = file.read().strip()
+        self.path = os.path.join(directory, self.generation)
+        with open(os.path.join(self.path, 'meta.json')) as file:
+            self.meta = json.load(file)
+
+        self.horses = self.meta['horses']
+        self.horse_codes = {horse: code for code, horse in enumerate(self.horses)}
+        self.vocabularies = self.meta['vocabularies']
+        self.last_id = self.meta['last_id']
+        self.journal_seen = self.meta.get('journal', dict())    # Format: run: {process: last journal seq indexed}
+
+        self.offsets = self.load('offsets')
+        self.keys = self.load('keys')
+        self.dates = self.load('date')
+        self.ids = self.load('id') if os.path.exists(os.path.join(self.path, 'id.npy')) else None
+        self.columns = {column: self.load(column) for column in self.meta['columns']}
+
+    def load(self, name):
+        return np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def last_starts(self, horses, before=None, n=5, columns=None):
+        """ The last n starts before the date in before (one date for every horse, or one each) for each of horses,
+            most recent first. before=None takes the latest starts. Returns a dataframe with a row per start: query
+            (position in horses), horse_name, start (1 for the most recent), date, and columns (default: all).
+        """
+        horses = list(horses)
+        columns = list(columns if columns is not None else self.columns)
+        codes = np.array([self.horse_codes.get(key, -1) if isinstance(key, str) else -1
+                          for key in horse_key(horses)], dtype=np.int64)
+        if before is None:
+            days = np.full(len(horses), np.iinfo(np.int32).max, dtype=np.int64)
+        else:
+            dates = pd.to_datetime(pd.Series(np.broadcast_to(np.asarray(before, dtype=object), len(horses))))
+            days = dates.values.astype('datetime64[D]').astype(np.int64)
+
+        # Each horse's starts before its date end where its (horse, date) key would be inserted. A missing date
+        # (NaT) has no starts before it.
+        known = codes >= 0
+        if before is not None: known &= dates.notna().values
+        ends = np.where(known, np.searchsorted(self.keys, history_keys(np.maximum(codes, 0), days)), 0)
+        starts = np.where(known, np.maximum(self.offsets[np.maximum(codes, 0)], ends - n), 0)
+        counts = ends - starts
+
+        query = np.repeat(np.arange(len(horses)), counts)
+        start = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+        positions = np.repeat(ends, counts) - start
+
+        history = pd.DataFrame({'query': query, 'horse_name': np.asarray(horses, dtype=object)[query],
+                                'start': start, 'date': self.dates[positions]})
+        for column in columns:
+            values = self.columns[column][positions]
+            if column in self.vocabularies:
+                vocabulary = np.asarray(self.vocabularies[column] + [None], dtype=object)
+                values = vocabulary[values]         # Code -1 (missing) picks the trailing None
+            history[column] = values
+        return history
+
+
+def read_performances(db, after_id=0, table=HISTORY_TABLE, chunk_size=100000):
+    """Yields the rows of table with an id above after_id as dataframes of up to chunk_size rows, in id order."""
+    fields = ['id', 'horse_name', 'date', *HISTORY_COLUMNS]
+    while True:
+        rows = db.query_db(db.generate_query(table, fields, where=f'id > {after_id}',
+                                             other=f'ORDER BY id LIMIT {chunk_size}'))
+        if not rows:
+            return
+        yield pd.DataFrame(rows, columns=fields)
+        after_id = rows[-1][0]
+
+
+def read_keys(db, keys, table=HISTORY_TABLE, batch_size=500):
+    """Yields the rows of table with the given UNIQUE keys as dataframes, batch_size keys per query."""
+    fields = ['id', 'horse_name', 'date', *HISTORY_COLUMNS]
+    keys = list(keys)
+    for start in range(0, len(keys), batch_size):
+        where = ' OR '.join('(' + db.concatenate_field_value_pairs(UNIQUE, key, separator=' AND ') + ')'
+                            for key in keys[start:start + batch_size])
+        rows = db.query_db(db.generate_query(table, fields, where=where))
+        if rows:
+            yield pd.DataFrame(rows, columns=fields)
+
+
+def journal_changes(table, seen, journal_dir=journal.JOURNAL_DIR):
+    """ The UNIQUE keys of the rows of table the change journal shows were updated in place since seen ({run:
+        {process: last seq indexed}}), whether a rewrite (which can change any row's key) was journaled, and the new
+        seen. seq only orders one process's records, so there's a mark for each process that wrote to a run. Runs
+        already seen are skipped, except the latest, which may have been written to since.
+    """
+    runs = [run for run in journal.list_runs(journal_dir) if run not in seen or run == max(seen)]
+    # Indexes saved before records had a process kept a single mark per run, which applies to those records
+    keys, rewritten = set(), False
+    seen = {run: dict(marks) if isinstance(marks, dict) else {'': marks} for run, marks in seen.items()}
+    if not runs:
+        return keys, rewritten, seen
+    for record in journal.read_records(table, runs, journal_dir):
+        marks = seen.setdefault(record['run'], dict())
+        process = record.get('process', '')
+        if record['seq'] <= marks.get(process, -1): continue
+        marks[process] = record['seq']
+        if record['op'] == 'update' and None not in record['key']:
+            keys.add(tuple(record['key']))
+        elif record['op'] == 'rewrite':
+            rewritten = True
+    return keys, rewritten, seen
+
+
+def encode(chunk, horse_codes, vocabularies):
+    """ The arrays for a chunk of performances, adding new horses and text values to horse_codes and vocabularies
+        as they turn up. Rows without a horse or a date are left out, since they have no place in a history.
+    """
+    keys = horse_key(chunk['horse_name'].values)
+    dates = pd.to_datetime(chunk['date'], errors='coerce')
+    keep = (keys.notna() & dates.notna()).values
+    keys, chunk = keys[keep], chunk[keep]
+
+    arrays = {'horse': np.array([horse_codes.setdefault(key, len(horse_codes)) for key in keys], dtype=np.int64),
+              'date': dates[keep].values.astype('datetime64[D]'),
+              'id': chunk['id'].to_numpy(dtype=np.int64)}
+    for column, sql_dtype in HISTORY_COLUMNS.items():
+        dtype = array_dtype(sql_dtype)
+        if dtype is None:
+            codes = vocabularies.setdefault(column, dict())
+            arrays[column] = np.array([-1 if value is None or value != value else codes.setdefault(value, len(codes))
+                                       for value in chunk[column]], dtype=np.int32)
+        elif dtype.kind == 'M':
+            arrays[column] = pd.to_datetime(chunk[column], errors='coerce').values.astype(dtype)
+        else:
+            arrays[column] = pd.to_numeric(chunk[column], errors='coerce').to_numpy(dtype=dtype, na_value=np.nan)
+    return arrays
+
+
+def sort(arrays):
+    """Sorts arrays (horse, date, and the columns) by horse and then date."""
+    order = np.lexsort((arrays['date'], arrays['horse']))
+    return {name: values[order] for name, values in arrays.items()}
+
+
+def merge(arrays, new_arrays):
+    """ Merges new_arrays into arrays, both already sorted by horse and date, without sorting them again. New starts
+        go after any existing starts with the same horse and date.
+    """
+    new_arrays = sort(new_arrays)
+    positions = np.searchsorted(history_keys(arrays['horse'], arrays['date'].astype(np.int64)),
+                                history_keys(new_arrays['horse'], new_arrays['date'].astype(np.int64)), side='right')
+    return {name: np.insert(values, positions, new_arrays[name]) for name, values in arrays.items()}
+
+
+def save(directory, arrays, horses, vocabularies, last_id, journal_seen):
+    """Writes arrays, sorted by horse and date, as a new generation of the index in directory and makes it live."""
+    horse_codes = arrays['horse']
+
+    generation = f'{last_id:012d}-{datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")}'
+    path = os.path.join(directory, generation)
+    os.makedirs(path)
+    np.save(os.path.join(path, 'offsets.npy'),
+            np.concatenate([[0], np.cumsum(np.bincount(horse_codes, minlength=len(horses)))]).astype(np.int64))
+    np.save(os.path.join(path, 'keys.npy'), history_keys(horse_codes, arrays['date'].astype(np.int64)))
+    for name, values in arrays.items():
+        if name != 'horse':
+            np.save(os.path.join(path, f'{name}.npy'), values)
+    with open(os.path.join(path, 'meta.json'), 'w') as file:
+        json.dump({'horses': horses, 'columns': list(HISTORY_COLUMNS), 'last_id': last_id, 'journal': journal_seen,
+                   'vocabularies': {column: list(codes) for column, codes in vocabularies.items()}}, file)
+
+    with open(os.path.join(directory, 'CURRENT.tmp'), 'w') as file:
+        file.write(generation)
+    os.replace(os.path.join(directory, 'CURRENT.tmp'), os.path.join(directory, 'CURRENT'))
+    for other in os.listdir(directory):
+        if other != generation and os.path.isdir(os.path.join(directory, other)):
+            shutil.rmtree(os.path.join(directory, other), ignore_errors=True)
+
+
+def update(db, directory=HISTORY_DIR, rebuild=False, table=HISTORY_TABLE, chunk_size=100000,
+           journal_dir=journal.JOURNAL_DIR):
+    """ Brings the index up to date with table: adds the performances inserted since it was last saved and
+        re-reads the ones the change journal shows were updated in place. Indexes the whole table if there's no
+        index yet, rebuild=True, or the journal can't say which rows changed. Returns the updated HorseHistoryIndex.
+    """
+    os.makedirs(directory, exist_ok=True)
+    current = None if rebuild or not os.path.exists(os.path.join(directory, 'CURRENT')) \
+        else HorseHistoryIndex(directory)
+
+    # The journal is read before the table, so anything written in between is picked up next time
+    changed_keys, rewritten, journal_seen = journal_changes(table, current.journal_seen if current else dict(),
+                                                            journal_dir)
+    if current is not None and (current.ids is None or rewritten):
+        print('Horse names were rewritten or the index predates row ids; rebuilding the horse history index')
+        current = None
+
+    if current is None:
+        horse_codes, vocabularies, parts, last_id = dict(), dict(), list(), 0
+        for chunk in read_performances(db, 0, table, chunk_size):
+            last_id = int(chunk['id'].iloc[-1])
+            parts.append(encode(chunk, horse_codes, vocabularies))
+        if not parts:
+            print(f'No performances in {table} to index')
+            return None
+        arrays = sort({name: np.concatenate([part[name] for part in parts]) for name in parts[0]})
+        save(directory, arrays, list(horse_codes), vocabularies, last_id, journal_seen)
+        print(f'Indexed {len(arrays["horse"])} starts for {len(horse_codes)} horses')
+        return HorseHistoryIndex(directory)
+
+    horse_codes = dict(current.horse_codes)
+    vocabularies = {column: {value: code for code, value in enumerate(values)}
+                    for column, values in current.vocabularies.items()}
+    last_id = current.last_id
+
+    # Rows updated in place replace their old starts; rows inserted since the last save are added
+    parts, changed = list(), list()
+    for chunk in read_keys(db, changed_keys, table):
+        chunk = chunk[chunk['id'] <= current.last_id]
+        changed.extend(chunk['id'])
+        parts.append(encode(chunk, horse_codes, vocabularies))
+    added = 0
+    for chunk in read_performances(db, last_id, table, chunk_size):
+        last_id = int(chunk['id'].iloc[-1])
+        parts.append(encode(chunk, horse_codes, vocabularies))
+        added += len(parts[-1]['horse'])
+    if not changed and not added:
+        print(f'Horse history index is up to date ({len(current)} starts)')
+        return current
+
+    arrays = dict({'horse': np.repeat(np.arange(len(current.horses)), np.diff(current.offsets)),
+                   'date': np.asarray(current.dates), 'id': np.asarray(current.ids)},
+                  **{column: np.asarray(values) for column, values in current.columns.items()})
+    if len(changed):
+        keep = ~np.isin(arrays['id'], np.array(changed, dtype=np.int64))
+        arrays = {name: values[keep] for name, values in arrays.items()}
+    arrays = merge(arrays, {name: np.concatenate([part[name] for part in parts]) for name in arrays})
+    save(directory, arrays, list(horse_codes), vocabularies, last_id, journal_seen)
+    print(f'Indexed {added} new and {len(changed)} changed starts; horse history index has {len(arrays["horse"])} '
+          f'starts for {len(horse_codes)} horses')
+    return HorseHistoryIndex(directory)
+
+
+def main():
+    import horse_performances_master
+    parser = argparse.ArgumentParser(description='Update the per-horse history index of consolidated performances')
+    parser.add_argument('--database', default=horse_performances_master.consolidated_database)
+    parser.add_argument('--directory', default=HISTORY_DIR)
+    parser.add_argument('--rebuild', action='store_true', help='index the whole table again')
+    args = parser.parse_args()
+
+    db = dbh.QueryDB(args.database)
+    db.connect()
+    try:
+        update(db, args.directory, rebuild=args.rebuild)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import re
+from difflib import SequenceMatcher
+
+import pandas as pd
+
+
+# Candidates are only ever compared within the same race and post position
+BLOCK_FIELDS = ['track', 'date', 'race_num', 'post_position']
+
+COUNTRY_SUFFIX = re.compile(r'\s*\([A-Z]{2,3}\)\s*$')      # e.g., 'Sea The Stars (IRE)'
+NON_ALPHANUMERIC = re.compile(r'[^A-Z0-9]')
+
+
+def normalize_horse_name(name):
+    """Uppercases a horse name and drops any country suffix, apostrophes, punctuation, and spaces."""
+    if not isinstance(name, str):
+        return ''
+    name = COUNTRY_SUFFIX.sub('', name.upper())
+    return NON_ALPHANUMERIC.sub('', name)
+
+
+def name_similarity(source_name, consolidated_name, min_prefix=6):
+    """ Scores how likely two normalized horse names are the same horse, from 0 to 1.
+
+        One name being a prefix of the other counts as a truncation and scores 0.95 as long as the shorter name
+        is at least min_prefix characters long; otherwise the score is the difflib similarity ratio.
+    """
+    if not source_name or not consolidated_name:
+        return 0.0
+    if source_name == consolidated_name:
+        return 1.0
+    shorter, longer = sorted([source_name, consolidated_name], key=len)
+    if len(shorter) >= min_prefix and longer.startswith(shorter):
+        return 0.95
+    return SequenceMatcher(None, source_name, consolidated_name).ratio()
+
+
+def block_keys(data):
+    """Returns the blocking columns of a data handler's dataframe in types that compare equal across sources."""
+    keys = pd.DataFrame(index=data.index)
+    keys['track'] = data['track'].astype(str)
+    keys['date'] = data['date'].astype(str)
+    keys['race_num'] = pd.to_numeric(data['race_num'], errors='coerce')
+    keys['post_position'] = pd.to_numeric(data['post_position'], errors='coerce')
+    keys['horse_name'] = data['horse_name']
+    return keys.dropna(subset=['race_num', 'post_position'])
+
+
+def resolve_horse_identities(source_data, consolidated_data, threshold=0.85):
+    """ Matches source performance rows whose race_id has no exact match in the consolidated data to the
+        consolidated row for the same horse under a different spelling.
+
+        Both arguments are race_id-indexed dataframes from AdderDataHandler (include_horse=True). Candidates
+        are blocked by (track, date, race_num, post_position), so only horses that started from the same post in
+        the same race are ever compared. Returns a dict of {source race_id: consolidated race_id}.
+    """
+    unmatched = source_data[~source_data.index.isin(consolidated_data.index)]
+    unclaimed = consolidated_data[~consolidated_data.index.isin(source_data.index)]
+    if len(unmatched) == 0 or len(unclaimed) == 0:
+        return dict()
+
+    source_keys = block_keys(unmatched).rename_axis('source_race_id').reset_index()
+    consolidated_keys = block_keys(unclaimed).rename_axis('consolidated_race_id').reset_index()
+    pairs = source_keys.merge(consolidated_keys, on=BLOCK_FIELDS, suffixes=('_source', '_consolidated'))
+    if len(pairs) == 0:
+        return dict()
+
+    # Normalize each distinct name once rather than once per pair
+    names = pd.unique(pd.concat([pairs['horse_name_source'], pairs['horse_name_consolidated']]))
+    normalized = {name: normalize_horse_name(name) for name in names}
+    source_names = pairs['horse_name_source'].map(normalized)
+    consolidated_names = pairs['horse_name_consolidated'].map(normalized)
+
+    # Exact matches after normalization are settled in bulk; only the rest need a string comparison
+    exact = (source_names == consolidated_names) & (source_names != '')
+    pairs['score'] = 0.0
+    pairs.loc[exact, 'score'] = 1.0
+    fuzzy = ~exact
+    pairs.loc[fuzzy, 'score'] = [name_similarity(source_name, consolidated_name) for source_name, consolidated_name
+                                 in zip(source_names[fuzzy], consolidated_names[fuzzy])]
+
+    # Keep the best candidate for each source row, and never map two source rows onto the same consolidated row
+    matches = pairs[pairs['score'] >= threshold].sort_values('score', ascending=False)
+    matches = matches.drop_duplicates('source_race_id').drop_duplicates('consolidated_race_id')
+    return dict(zip(matches['source_race_id'], matches['consolidated_race_id']))
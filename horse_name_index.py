@@ -0,0 +1,96 @@
+from collections import Counter
+
+import db_handler as dbh
+from journal import ChangeJournal
+
+
+HORSE_NAME_SOURCES = [
+    # Format: (source_table, horse_name_col)
+    ('race_horse_info', 'horse_name'),
+    ('horse_pps', 'horse_name'),
+]
+
+# Resolver the rewrites to canonical names are journaled under
+RESOLVER = 'horse_name_index'
+
+# Indexes already built this run, keyed by (db_name, sources)
+_indexes = dict()
+
+
+def get_horse_name_index(db_name, sources=None, verbose_db=False):
+    """Returns the HorseNameIndex for db_name, building it the first time it's asked for in a run."""
+    sources = tuple(sources if sources is not None else HORSE_NAME_SOURCES)
+    if (db_name, sources) not in _indexes:
+        db = dbh.QueryDB(db_name, verbose=verbose_db)
+        db.connect()
+        _indexes[(db_name, sources)] = HorseNameIndex(db, sources)
+    return _indexes[(db_name, sources)]
+
+
+class HorseNameIndex:
+    # The HorseNameIndex class maps every raw horse name seen in the source tables to one canonical spelling.
+    # Names are grouped the same way the race_ids group them (str(name).upper()), and each group's canonical form
+    # is the titlecased version of its most common spelling--the same rule FixerHorseName applies after the fact.
+    # Canonicalizing names when the data is loaded keeps case-only differences out of the conflict path.
+
+    def __init__(self, db_handler, sources=None):
+        self.db = db_handler
+        self.sources = list(sources if sources is not None else HORSE_NAME_SOURCES)
+        self.canonical = dict()         # upper-cased name: canonical name
+
+        self.build()
+
+    def build(self):
+        from titlecase import titlecase
+
+        print('Building horse name index')
+        spellings = Counter()
+        for table, field in self.sources:
+            # Counted here rather than with GROUP BY, which would fold spellings together under a
+            # case-insensitive collation.
+            spellings.update(row[0] for row in self.db.query_db(self.db.generate_query(table, [field])) if row[0])
+
+        most_common = dict()
+        for name, count in spellings.most_common():
+            most_common.setdefault(str(name).upper(), name)
+        self.canonical = {key: titlecase(name) for key, name in most_common.items()}
+
+    def canonicalize(self, name):
+        """Returns the canonical form of name, or name unchanged if it was never seen or is blank."""
+        if not isinstance(name, str) or not name:
+            return name
+        return self.canonical.get(name.upper(), name)
+
+    def canonicalize_column(self, names):
+        """Canonicalizes a pandas Series of horse names."""
+        return names.map(self.canonicalize)
+
+    def rewrite_table(self, data_handler, field='horse_name'):
+        """ Rewrites the names in data_handler's table that are a case-only variant of their canonical form, in
+            batched UPDATEs. Names that differ from it in anything but case (or were never seen) are left alone. The
+            rewrite goes in data_handler's change journal, or one of its own if it isn't being journaled.
+
+            Returns the number of distinct spellings rewritten.
+        """
+        sql_query = data_handler.db.generate_query(data_handler.table, [field])
+        names = {row[0] for row in data_handler.db.query_db(sql_query) if row[0]}
+        rewrites = dict()
+        for name in names:
+            canonical = self.canonicalize(name)
+            if canonical != name and canonical.upper() == name.upper():
+                rewrites[name] = canonical
+        if not rewrites:
+            return 0
+
+        print(f'Rewriting {len(rewrites)} horse names in {data_handler.table} to their canonical form')
+        if data_handler.journal is not None:
+            data_handler.rewrite_values(field, rewrites)
+            return len(rewrites)
+        with ChangeJournal(data_handler.table, RESOLVER, lambda: dict()) as journal:
+            journal.resolvers.append(RESOLVER)
+            data_handler.journal = journal
+            try:
+                data_handler.rewrite_values(field, rewrites)
+            finally:
+                data_handler.journal = None
+        return len(rewrites)
@@ -1,4 +1,9 @@
+import db_handler as dbh
 import horse_performances_refactor as hp
+import horse_history
+from integrity_checks import check_consolidated_tables
+from days_since_last_race import settle_days_since_last_race
+from horse_name_index import get_horse_name_index
 
 # Import configuration constants and encapsulate them into a data pack
 from datapack import DataPack
@@ -22,33 +27,95 @@ data_pack = DataPack(CONSOLIDATED_TABLE_STRUCTURE=CONSOLIDATED_TABLE_STRUCTURE,
 # todo REMOVE FOR PRODUCTION
 data_limit = ''
 source_database = 'horses_test'
+consolidated_database = 'horses_consolidated_races'
 
-# Generate the data handler for the consolidated races aggregated db
-consolidated_races_db_handler= hp.AdderDataHandler('horses_consolidated_races', 'horses_consolidated_races',
-                                                   data_pack, include_horse=False, other='', verbose_db=False)
+# Set to True to dump a cProfile of each aggregation run to profile_dir alongside the stage timings
+profile = False
+profile_dir = 'logs'
 
-# Generate the data handler for the consolidated performances aggregated db
-consolidated_performances_db_handler = hp.AdderDataHandler('horses_consolidated_races', 'horses_consolidated_performances',
-                                                           data_pack, include_horse=True, initialize_table=True,
-                                                           other='', verbose_db=False)
+# Telemetry goes to logs/telemetry_<table>.prom either way; set to True to also show a progress bar when run by hand
+progress_bar = False
 
+# Set to True to process the source rows a race at a time, doing the per-race lookups once for the whole field
+race_grouped = False
 
-# Build up data handlers for the data sources, spin up the aggregators, and fire them up.
-race_results_db_handler = hp.PPAdderDataHandler(source_database, 'race_horse_info', data_pack,
-                                                include_horse=True, other=data_limit)
-race_results_adder = hp.PPRaceProcessor(race_results_db_handler, consolidated_performances_db_handler,
-                                        consolidated_races_db_handler, include_horse=True, verbose=False)
-race_results_adder.add_to_consolidated_data()
+# Source tables in the order they're consolidated. Later sources are checked against what the earlier ones added.
+PERFORMANCE_SOURCE_TABLES = ['race_horse_info', 'horse_pps']
 
-# Reset consolidated data handler to reflect the just-added data
-consolidated_performances_db_handler.set_up_data()
 
-past_performances_db_handler = hp.PPAdderDataHandler(source_database, 'horse_pps', data_pack,
-                                                   include_horse=True, other=data_limit)
-past_performances_adder = hp.PPRaceProcessor(past_performances_db_handler, consolidated_performances_db_handler,
-                                             consolidated_races_db_handler, include_horse=True, verbose=False)
-past_performances_adder.add_to_consolidated_data()
+def consolidate_performances(table, horse_name_index=None, source_database=source_database, data_limit=data_limit,
+                             profile=profile, progress_bar=progress_bar, race_grouped=race_grouped,
+                             profile_dir=profile_dir):
+    """ Adds one source table's performances to the consolidated performances table. Build the horse name index
+        once with get_horse_name_index() and pass it to every call so all the handlers use the same spellings.
+    """
+    if horse_name_index is None:
+        horse_name_index = get_horse_name_index(source_database)
+
+    # Generate the data handler for the consolidated races aggregated db
+    consolidated_races_db_handler = hp.AdderDataHandler(consolidated_database, 'horses_consolidated_races',
+                                                        data_pack, include_horse=False, other='', verbose_db=False)
+
+    # Generate the data handler for the consolidated performances aggregated db
+    consolidated_performances_db_handler = hp.AdderDataHandler(consolidated_database,
+                                                               'horses_consolidated_performances',
+                                                               data_pack, include_horse=True, initialize_table=True,
+                                                               other='', verbose_db=False,
+                                                               horse_name_index=horse_name_index)
+
+    # Bring any existing consolidated names in line with the index before comparing against them
+    horse_name_index.rewrite_table(consolidated_performances_db_handler)
+
+    # Build up the data handler for the data source, spin up the aggregator, and fire it up.
+    source_db_handler = hp.PPAdderDataHandler(source_database, table, data_pack, include_horse=True, other=data_limit,
+                                              horse_name_index=horse_name_index)
+    adder = hp.PPRaceProcessor(source_db_handler, consolidated_performances_db_handler, consolidated_races_db_handler,
+                               include_horse=True, verbose=False, profile=profile, progress_bar=progress_bar,
+                               race_grouped=race_grouped, profile_dir=profile_dir)
+    adder.add_to_consolidated_data()
+
+def derive_days_since_last_race():
+    """Settles days_since_last_race across the consolidated performances once every source has been added."""
+    db = dbh.QueryDB(consolidated_database)
+    db.connect()
+    try:
+        settle_days_since_last_race(db)
+    finally:
+        db.close()
+
+
+def update_horse_history(rebuild=False):
+    """Adds the newly consolidated performances to the per-horse history index (horse_history.py)."""
+    db = dbh.QueryDB(consolidated_database)
+    db.connect()
+    try:
+        horse_history.update(db, rebuild=rebuild)
+    finally:
+        db.close()
+
+
+def check_integrity(max_violations=None):
+    """Runs the integrity checks (integrity_checks.py) over the consolidated races and performances."""
+    db = dbh.QueryDB(consolidated_database)
+    db.connect()
+    try:
+        check_consolidated_tables(db, max_violations=max_violations)
+    finally:
+        db.close()
 
 # todo Set up system to give warning if the program is generating too many DB integrity errors--it's doing something wrong if that happens
 
 
+def main():
+    dbh.configure_logging()
+    # Build the horse name index once for the run so every handler loads the same canonical spellings
+    horse_name_index = get_horse_name_index(source_database)
+    for table in PERFORMANCE_SOURCE_TABLES:
+        consolidate_performances(table, horse_name_index)
+    derive_days_since_last_race()
+    update_horse_history()
+    check_integrity()
+
+
+if __name__ == '__main__':
+    main()
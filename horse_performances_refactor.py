@@ -1,8 +1,10 @@
 import logging
 from aggregation_RaceProcessor import RaceProcessor
 from AdderDataHandler import AdderDataHandler
+from race_conditions_store import RaceConditionsStore, RACE_CONDITIONS_FIELDS
+from horse_identity import resolve_horse_identities
+from issue_log import IssueLog
 
-from progress.bar import Bar
 import numpy as np
 import pandas as pd
 import datetime
@@ -10,7 +12,6 @@ import math
 
 from fixer_horse_name import FixerHorseName
 from fixer_lead_or_beaten import FixerLeadOrBeaten
-from fixer_days_since_last import FixerDaysSinceLastRace
 
 
 
@@ -21,7 +22,12 @@ class PPAdderDataHandler(AdderDataHandler):
 
 class PPRaceProcessor(RaceProcessor):
 
-    def __init__(self, db_handler, db_consolidated_handler, db_consolidated_races_handler, include_horse=False, verbose=False):
+    def __init__(self, db_handler, db_consolidated_handler, db_consolidated_races_handler, include_horse=False, verbose=False,
+                 profile=False, progress_bar=False, telemetry_interval=5.0, race_grouped=False, profile_dir='logs'):
+        """ race_grouped=True processes the source rows a race at a time: the race's distance and call mappings are
+            looked up once for the whole field, and the runners that are new to the consolidated table are inserted
+            together.
+        """
         self.db = db_handler
         self.consolidated_db = db_consolidated_handler
         self.consolidated_races_db = db_consolidated_races_handler
@@ -43,54 +49,81 @@ class PPRaceProcessor(RaceProcessor):
         current_horse = None
         current_distance = None
 
-        # Set up dict to track the unresolvable issues that were found
-        self.unfixed_data = {}
+        # Unresolvable issues are streamed to an IssueLog set up by add_to_consolidated_data()
+        self.unfixed_data = None
+
+        # Per-stage timings for add_to_consolidated_data(), written to profile_dir. profile=True also dumps a cProfile
+        # of each run there.
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.profiler = None
+
+        # Throughput telemetry written every telemetry_interval seconds; progress_bar=True also shows a progress bar
+        self.progress_bar = progress_bar
+        self.telemetry_interval = telemetry_interval
+        self.telemetry = None
+
+        # Writes to the consolidated table are journaled for the length of each run
+        self.journal = None
+
+        # Discrepancies that need a person are queued for review for the length of each run
+        self.review_queue = None
+
+        self.race_grouped = race_grouped
+
+        # Map of source race_ids to the consolidated race_id for the same horse under a different spelling.
+        # Set by add_to_consolidated_data().
+        self.identity_map = dict()
+
+        # The consolidated races table is the only source of race conditions text for performances. It is shared
+        # by all the fixers and only loaded if one of them reads the conditions.
+        self.consolidated_conditions = RaceConditionsStore(self.consolidated_races_db, fields=RACE_CONDITIONS_FIELDS)
+        conditions = {'consolidated_conditions': self.consolidated_conditions}
 
         # Set up discrepancy resolvers:
         # todo use
         self.fixers = {
-            'horse_name': FixerHorseName('horse_name', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_0': FixerLeadOrBeaten('lead_or_beaten_0', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_330': FixerLeadOrBeaten('lead_or_beaten_330', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_440': FixerLeadOrBeaten('lead_or_beaten_440', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_660': FixerLeadOrBeaten('lead_or_beaten_660', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_880': FixerLeadOrBeaten('lead_or_beaten_880', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_990': FixerLeadOrBeaten('lead_or_beaten_990', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1100': FixerLeadOrBeaten('lead_or_beaten_1100', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1210': FixerLeadOrBeaten('lead_or_beaten_1210', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1320': FixerLeadOrBeaten('lead_or_beaten_1320', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1430': FixerLeadOrBeaten('lead_or_beaten_1430', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1540': FixerLeadOrBeaten('lead_or_beaten_1540', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1610': FixerLeadOrBeaten('lead_or_beaten_1610', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1650': FixerLeadOrBeaten('lead_or_beaten_1650', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1760': FixerLeadOrBeaten('lead_or_beaten_1760', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1830': FixerLeadOrBeaten('lead_or_beaten_1830', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1870': FixerLeadOrBeaten('lead_or_beaten_1870', self.db, self.consolidated_db, self.consolidated_races_db),
-            'lead_or_beaten_1980': FixerLeadOrBeaten('lead_or_beaten_1980', self.db, self.consolidated_db, self.consolidated_races_db),
-            'days_since_last_race': FixerDaysSinceLastRace('days_since_last_race', self.db, self.consolidated_db, self.consolidated_races_db)
+            'horse_name': FixerHorseName('horse_name', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_0': FixerLeadOrBeaten('lead_or_beaten_0', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_330': FixerLeadOrBeaten('lead_or_beaten_330', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_440': FixerLeadOrBeaten('lead_or_beaten_440', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_660': FixerLeadOrBeaten('lead_or_beaten_660', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_880': FixerLeadOrBeaten('lead_or_beaten_880', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_990': FixerLeadOrBeaten('lead_or_beaten_990', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1100': FixerLeadOrBeaten('lead_or_beaten_1100', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1210': FixerLeadOrBeaten('lead_or_beaten_1210', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1320': FixerLeadOrBeaten('lead_or_beaten_1320', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1430': FixerLeadOrBeaten('lead_or_beaten_1430', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1540': FixerLeadOrBeaten('lead_or_beaten_1540', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1610': FixerLeadOrBeaten('lead_or_beaten_1610', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1650': FixerLeadOrBeaten('lead_or_beaten_1650', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1760': FixerLeadOrBeaten('lead_or_beaten_1760', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1830': FixerLeadOrBeaten('lead_or_beaten_1830', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1870': FixerLeadOrBeaten('lead_or_beaten_1870', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
+            'lead_or_beaten_1980': FixerLeadOrBeaten('lead_or_beaten_1980', self.db, self.consolidated_db, self.consolidated_races_db, **conditions),
         }
 
     def add_to_consolidated_data(self):
-        # Setup progress bar
         print(f'Consolidating data from {self.table}')
-        bar = Bar(f'Processing {self.table} data', max=len(self.db.data),
-                  suffix='%(percent).3f%% - %(index)d/%(max)d - %(eta)s secs.')
 
-        # Generate a list of the columns to check by pulling a row from the dataframe and extracting the
-        # column names (this will be a pandas index since the resulting row is returned as a pandas series
-        # with the column names serving as the index). Then we strip off the non-race_id columns from that list
-        # and set up the issue-tracking dictionary.
+        # Match up horses whose names differ between sources by more than case before adding any new rows
+        self.identity_map = resolve_horse_identities(self.db.data, self.consolidated_db.data)
+        if self.identity_map:
+            print(f'Matched {len(self.identity_map)} {self.table} performances to differently spelled consolidated horses')
 
         # Set up log for unresolved discrepancies
-        columns = self.consolidated_db.constants.CONSOLIDATED_TABLE_STRUCTURE.keys()
-        race_id_fields = ['date', 'track', 'race_num']
-        columns_to_check = [item for item in columns if item not in race_id_fields]
-        self.set_up_issue_log(columns_to_check)
+        with IssueLog('performances_unfixed_data', self.table) as self.unfixed_data, self.tracked_run():
+            if self.race_grouped:
+                self.process_races()
+            else:
+                self.process_rows()
+
+        print(self.unfixed_data.summary())
 
+    def process_rows(self):
         # Loop through each row of dataframe and process that race info
         for i in range(len(self.db.data)):
-            # Advance progress bar
-            bar.next()
+            self.telemetry.next_row()
             # Set state with current race information
             self.set_current_info(i)
 
@@ -110,60 +143,109 @@ class PPRaceProcessor(RaceProcessor):
                 continue
 
             # Use the dataHandler to pull the race data for the current race and generate column list
-            # todo Seems like there has to be a better way to do this rather than generate a new distance-specific
-            # todo list for each row of the dataframe
             row_data = self.db.get_trimmed_row_data(i, distance)
             columns = row_data.index.tolist()
 
-            # Check if there is an entry in the consolidated db for this race; if not, add it.
-            if self.race_entry_exists(self.get_current_race_id(include_horse=self.include_horse)):
-
-                self.verbose_print(f'Race {self.current_race_id} found--checking for discrepancies')
-
-                # Check if all the non-race_id fields are blank; if so, add our data to the entry.
-                if self.consolidated_db.fields_blank(self.current_race_id, columns, number='all'):
-                    self.verbose_print('All consolidated fields found blank; adding data')
-                    self.consolidated_db.update_race_values(columns,
-                                                            row_data[columns].tolist(),
-                                                            self.get_current_race_id(as_sql=True, include_horse=self.include_horse))
-
-                # If some of the non-race_id fields are not blank, we have to resolve those against our new data
-                else:   # Resolve partial data
-                        # Generate boolean masks for what data is missing in consolidated and new data
-                    self.new_row_data = row_data[columns]
-                    self.consolidated_row_data = self.consolidated_db.data.loc[self.get_current_race_id(include_horse=self.include_horse), columns]
-
-                    missing_row_data = [self.db.is_blank(item) for item in self.new_row_data]
-                    missing_consolidated_data = [self.db.is_blank(item) for item in self.consolidated_row_data]
-
-                    # Check to make sure the row sizes match, which we expect
-                    # todo TAKE THIS OUT FOR PRODUCTION
-                    assert len(missing_row_data) == len(missing_consolidated_data)
-
-                    # If there's an entry that already has data in it, compare each data entry, see where
-                    # discrepancies are, resolve them, and then update the consolidated db entry.
-                    self.resolve_data(zip(missing_row_data, missing_consolidated_data),
-                                      zip(self.new_row_data, self.consolidated_row_data),
-                                      columns)
-
-            else:    # Add the race if there isn't already an entry in the consolidated db
-                # todo Figure out a race-adding mechanism that doesn't use update. Will overwrite entries if the
-                # todo reference dataframe isn't updated after adding new entries.
-                self.verbose_print(f'Race {self.current_race_id} not found--adding to db')
+            # If this horse is already in the consolidated table under another spelling, reconcile against that row
+            self.apply_identity_map(row_data)
+
+            self.reconcile_runner(row_data, columns)
+
+    def process_races(self):
+        # Race-grouped version of process_rows(). The source rows are grouped by race, and everything that's the
+        # same for every runner in the race--the blank-entry check, the race distance, and the call-to-distance
+        # column mappings--is done once for the group. The runners are then reconciled one after another, and the
+        # ones new to the consolidated table are inserted in a single batch at the end of the race.
+        #
+        # If the consolidated races table doesn't have the race, the distance comes from the first runner's row
+        # rather than each runner's own.
+        horse_names = self.db.data['horse_name'].tolist() if self.include_horse else None
+        races = self.db.data.groupby(['date', 'track', 'race_num'], sort=False, dropna=False).indices
+
+        for rows in races.values():
+            self.set_current_info(rows[0])
+            distance = None if self.race_entry_blank() else self.get_race_distance()
+            if distance is None or distance not in self.db.constants.DISTANCES_TO_PROCESS:
+                for _ in rows: self.telemetry.next_row()
+                continue
 
-                self.consolidated_db.add_blank_entry(self.get_current_race_id(as_tuple=True, include_horse=self.include_horse),
-                                                     include_horse=self.include_horse)
+            trimmed_rows = self.db.get_trimmed_rows(rows, distance)
+            columns = trimmed_rows.columns.tolist()
+            new_runners = dict()        # Format: race_id: row_data
+            for i, (_, row_data) in zip(rows, trimmed_rows.iterrows()):
+                self.telemetry.next_row()
+                if self.include_horse:
+                    self.current_horse = horse_names[i]
+                    self.current_race_id = self.get_current_race_id(include_horse=True)
+                self.apply_identity_map(row_data)
+                self.reconcile_runner(row_data, columns, new_runners)
+            self.insert_runners(new_runners, columns)
+
+    def reconcile_runner(self, row_data, columns, new_runners=None):
+        """ Adds the current runner's row_data to the consolidated table or reconciles it with the entry already
+            there. If new_runners is given, a runner that isn't in the table yet is put in it (by race_id) for
+            insert_runners() instead of being added right away.
+        """
+        # Check if there is an entry in the consolidated db for this race; if not, add it.
+        if self.race_entry_exists(self.get_current_race_id(include_horse=self.include_horse)):
+
+            self.verbose_print(f'Race {self.current_race_id} found--checking for discrepancies')
+
+            # Check if all the non-race_id fields are blank; if so, add our data to the entry.
+            if self.consolidated_db.fields_blank(self.current_race_id, columns, number='all'):
+                self.verbose_print('All consolidated fields found blank; adding data')
                 self.consolidated_db.update_race_values(columns,
-                                                        row_data.tolist(),
+                                                        row_data[columns].tolist(),
                                                         self.get_current_race_id(as_sql=True, include_horse=self.include_horse))
 
-        with open(f'logs/performances_unfixed_data_{self.table} {datetime.datetime.now().strftime("%Y-%m-%d %H:%M")}.txt', 'w') as file:
-            for key in self.unfixed_data.keys():
-                file.write(f'\n**********\n{key} ({len(self.unfixed_data[key])}):\t')
-                for item in self.unfixed_data[key]:
-                    file.write(f'{item}, ')
-                file.write('\n')
-        bar.finish()
+            # If some of the non-race_id fields are not blank, we have to resolve those against our new data
+            else:   # Resolve partial data
+                    # Generate boolean masks for what data is missing in consolidated and new data
+                self.new_row_data = row_data[columns]
+                self.consolidated_row_data = self.consolidated_db.data.loc[self.get_current_race_id(include_horse=self.include_horse), columns]
+
+                missing_row_data = [self.db.is_blank(item) for item in self.new_row_data]
+                missing_consolidated_data = [self.db.is_blank(item) for item in self.consolidated_row_data]
+
+                # Check to make sure the row sizes match, which we expect
+                # todo TAKE THIS OUT FOR PRODUCTION
+                assert len(missing_row_data) == len(missing_consolidated_data)
+
+                # If there's an entry that already has data in it, compare each data entry, see where
+                # discrepancies are, resolve them, and then update the consolidated db entry.
+                self.resolve_data(zip(missing_row_data, missing_consolidated_data),
+                                  zip(self.new_row_data, self.consolidated_row_data),
+                                  columns)
+
+        elif new_runners is not None:
+            # A runner that shows up twice ends up with its last row, the same as adding it and then updating it
+            self.verbose_print(f'Race {self.current_race_id} not found--adding to db with the rest of the race')
+            new_runners[self.current_race_id] = row_data
+
+        else:    # Add the race if there isn't already an entry in the consolidated db
+            # todo Figure out a race-adding mechanism that doesn't use update. Will overwrite entries if the
+            # todo reference dataframe isn't updated after adding new entries.
+            self.verbose_print(f'Race {self.current_race_id} not found--adding to db')
+
+            self.consolidated_db.add_blank_entry(self.get_current_race_id(as_tuple=True, include_horse=self.include_horse),
+                                                 include_horse=self.include_horse)
+            self.consolidated_db.update_race_values(columns,
+                                                    row_data.tolist(),
+                                                    self.get_current_race_id(as_sql=True, include_horse=self.include_horse))
+
+    def insert_runners(self, new_runners, columns):
+        """Inserts the runners collected by reconcile_runner() for a race in one batch."""
+        if new_runners:
+            self.consolidated_db.insert_rows([row_data.tolist() for row_data in new_runners.values()], columns)
+
+    def apply_identity_map(self, row_data):
+        """Points the current state and row_data at the consolidated horse matched by resolve_horse_identities()."""
+        consolidated_race_id = self.identity_map.get(self.current_race_id)
+        if consolidated_race_id is None:
+            return
+        self.current_horse = self.consolidated_db.data.loc[consolidated_race_id, 'horse_name']
+        self.current_race_id = self.get_current_race_id(include_horse=self.include_horse)
+        row_data['horse_name'] = self.current_horse
 
     def race_entry_exists(self, race_id):
         """Checks whether the consolidated dataframe has an entry for a given race"""
@@ -195,24 +277,13 @@ class PPRaceProcessor(RaceProcessor):
                 self.verbose_print(f'No race distance info found for {self.current_race_id}')
                 return None
 
-    def set_up_issue_log(self, columns):
-        # Create dict keys for the conflict-tracking dictionary
-        for column in columns:
-            self.unfixed_data[column] = list()
-        self.unfixed_data['other'] = list()
-        try: # Clean up unused variable
-            del column
-        except Exception as e:
-            print(f'Issue deleting column variable: {e}')
-
-
     def reconcile_discrepancy(self, new_data, existing_data, column):
         # Skip any columns that we want to ignore discrepancies for
         keys_to_ignore = []
         if column in keys_to_ignore: return
 
         def add_to_unfixed_data():
-            self.unfixed_data[column].append(self.current_race_id)
+            self.unfixed_data.record(self.current_race_id, column, new_data, existing_data)
 
         def distances():
             # If we find a discrepancy in the distances, delete the race and note the race_id in the tracking
@@ -221,9 +292,8 @@ class PPRaceProcessor(RaceProcessor):
             # discrepancies that we can code a solution to.
             pass
 
-        def print_mismatch(pause=False):
+        def print_mismatch():
             print(f'\nData mismatch{self.current_race_id}: {column}. New data: {new_data}. Consolidated data: {existing_data}')
-            if pause: input("Press enter to continue")
 
 
 
@@ -244,6 +314,7 @@ class PPRaceProcessor(RaceProcessor):
             fixer_kwargs = {
                 'current_race_id_sql' : self.get_current_race_id(as_sql=True),
                 'current_race_id_sql_horse': self.get_current_race_id(as_sql=True, include_horse=True),
+                'current_race_key': self.get_current_race_id(include_horse=False),
                 'source_row_data': self.new_row_data,
                 'consolidated_row_data': self.consolidated_row_data,
             }
@@ -251,7 +322,7 @@ class PPRaceProcessor(RaceProcessor):
             # Run the appropriate discrepancy resolver depending on the column involved.
             if column == 'distance':
                 # print(f'Discrepancy is in {column} column.');
-                self.unfixed_data['distance'].append(self.current_race_id)
+                self.unfixed_data.record(self.current_race_id, 'distance', new_data, existing_data)
             elif column == 'horse_name':
                 discrepancy_resolved = self.fixers[column].fix_discrepancy(new_data, existing_data,
                                                                            race_id=self.current_race_id,
@@ -261,13 +332,7 @@ class PPRaceProcessor(RaceProcessor):
 
             elif column == 'source_file': add_to_unfixed_data()
             elif column == 'race_type': add_to_unfixed_data()
-            elif column == 'days_since_last_race':
-                discrepancy_resolved = self.fixers[column].fix_discrepancy(new_data, existing_data,
-                                                                           race_id=self.current_race_id,
-                                                                           **fixer_kwargs)
-                if not discrepancy_resolved:
-                    add_to_unfixed_data()
-
+            elif column == 'days_since_last_race': add_to_unfixed_data()
             elif column == 'favorite': add_to_unfixed_data()
             elif column == 'horse_id': add_to_unfixed_data()
             elif column == 'weight': add_to_unfixed_data()
@@ -288,9 +353,8 @@ class PPRaceProcessor(RaceProcessor):
                 # print_mismatch()
                 # fix_jockey_name()
             elif column in ['jockey_id', 'trainer_id']:
-                self.unfixed_data['dead_heat_finish'].append(self.current_race_id)
+                add_to_unfixed_data()
                 # print_mismatch()
-                # self.unfixed_data[column].append(self.current_race_id)
             ##########
             # Lead or beaten fields
             ##########
@@ -305,7 +369,7 @@ class PPRaceProcessor(RaceProcessor):
                 if not discrepancy_resolved:
                     add_to_unfixed_data()
             else:
-                self.unfixed_data['other'].append(f'{column}/{self.current_race_id}')
+                self.unfixed_data.record(self.current_race_id, column, new_data, existing_data)
                 print('Other type of discrepancy')
                 print(f'\nData mismatch: {column}. New data: {new_data}. Consolidated data: {existing_data}')
                 print('')
@@ -0,0 +1,218 @@
+# Integrity checks on the consolidated races and performances.
+#
+# Each check is a function over a partition of the races and their performances that compares whole columns at once
+# and returns its violations: race key, horse (for checks on a performance), rule, the offending column and value,
+# and a note on what it was checked against. The races are split into partitions by track and the partitions are
+# checked across a process pool. The violations replace the contents of the integrity_violations table in the
+# consolidated database. Run from the repository root:
+#     python integrity_checks.py
+#     python integrity_checks.py --max-violations 0     # exit with an error if anything turns up
+
+import argparse
+import re
+import sys
+import zlib
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import db_handler as dbh
+from constants.constant_aggregated_races_table_structure import CONSOLIDATED_TABLE_STRUCTURE as RACES_STRUCTURE
+from constants.constant_horse_performances_consolidated_table_structure import \
+    CONSOLIDATED_TABLE_STRUCTURE as PERFORMANCES_STRUCTURE
+from constants.constant_integrity_violations_table_structure import TABLE_STRUCTURE
+
+
+RACES_TABLE = 'horses_consolidated_races'
+PERFORMANCES_TABLE = 'horses_consolidated_performances'
+VIOLATIONS_TABLE = 'integrity_violations'
+RACE_KEY = ['track', 'date', 'race_num']
+
+
+def distance_columns(structure, prefix):
+    """The columns named prefix + distance in structure, in order of distance, as {distance: column}."""
+    columns = {int(match.group(1)): column for column in structure
+               for match in [re.fullmatch(f'{prefix}(\\d+)', column)] if match}
+    return dict(sorted(columns.items()))
+
+
+TIME_COLUMNS = distance_columns(RACES_STRUCTURE, 'time_')
+POSITION_COLUMNS = distance_columns(PERFORMANCES_STRUCTURE, 'position_')
+LEAD_OR_BEATEN_COLUMNS = distance_columns(PERFORMANCES_STRUCTURE, 'lead_or_beaten_')
+
+RACE_FIELDS = [*RACE_KEY, 'distance', 'field_size', *TIME_COLUMNS.values()]
+PERFORMANCE_FIELDS = [*RACE_KEY, 'horse_name', 'distance', *POSITION_COLUMNS.values(),
+                      *LEAD_OR_BEATEN_COLUMNS.values()]
+
+
+def cell_violations(data, columns, mask, rule, values, detail, against=None):
+    """ The violations for the cells of data[columns] where mask (rows x columns) is set. values (and against, the
+        values they were checked against, if given) are rows x columns arrays; the detail is detail followed by the
+        value the cell was checked against.
+    """
+    rows, cells = np.nonzero(mask)
+    if against is not None:
+        detail = [f'{detail} {value:g}' for value in against[rows, cells]]
+    return pd.DataFrame({
+        'track': data['track'].values[rows],
+        'date': data['date'].values[rows],
+        'race_num': data['race_num'].values[rows],
+        'horse_name': data['horse_name'].values[rows] if 'horse_name' in data else None,
+        'rule': rule,
+        'column_name': np.asarray(columns, dtype=object)[cells],
+        'value': values[rows, cells],
+        'detail': detail,
+    }, columns=list(TABLE_STRUCTURE))
+
+
+def numbers(data, columns):
+    return data[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+
+def check_position_exceeds_field_size(races, performances):
+    """Positions at any call greater than the number of starters in the race."""
+    runners = performances.merge(races[[*RACE_KEY, 'field_size']], on=RACE_KEY, how='inner')
+    columns = list(POSITION_COLUMNS.values())
+    positions = numbers(runners, columns)
+    field_size = pd.to_numeric(runners['field_size'], errors='coerce').to_numpy(dtype=float)
+    field_size = np.broadcast_to(field_size[:, None], positions.shape)
+    return cell_violations(runners, columns, positions > field_size, 'position_exceeds_field_size', positions,
+                           'field_size', field_size)
+
+
+def check_times_increase_with_distance(races, performances):
+    """Fractional and final times that aren't later than the time at every shorter distance in the race."""
+    columns = list(TIME_COLUMNS.values())
+    times = numbers(races, columns)
+    earlier = np.fmax.accumulate(times, axis=1)     # Latest time at this distance or before, ignoring blanks
+    earlier = np.concatenate([np.full((len(times), 1), np.nan), earlier[:, :-1]], axis=1)
+    return cell_violations(races, columns, times <= earlier, 'time_not_increasing', times, 'earlier time', earlier)
+
+
+def runner_distances(races, performances):
+    """Each performance's distance, taking the race's distance where the performance doesn't have one."""
+    runners = performances.merge(races[[*RACE_KEY, 'distance']].rename(columns={'distance': 'race_distance'}),
+                                 on=RACE_KEY, how='left')
+    distance = pd.to_numeric(runners['distance'], errors='coerce')
+    return runners, distance.fillna(pd.to_numeric(runners['race_distance'], errors='coerce')).to_numpy(dtype=float)
+
+
+def check_lead_or_beaten_beyond_distance(races, performances):
+    """Margins recorded at calls past the finish of the race."""
+    runners, distance = runner_distances(races, performances)
+    columns = list(LEAD_OR_BEATEN_COLUMNS.values())
+    margins = numbers(runners, columns)
+    distance = np.broadcast_to(distance[:, None], margins.shape)
+    beyond = ~np.isnan(margins) & (np.array(list(LEAD_OR_BEATEN_COLUMNS))[None, :] > distance)
+    return cell_violations(runners, columns, beyond, 'lead_or_beaten_beyond_distance', margins, 'distance', distance)
+
+
+def check_finish_position_missing(races, performances):
+    """Performances with positions at earlier calls but none at the finish (position_<distance>)."""
+    runners, distance = runner_distances(races, performances)
+    columns = list(POSITION_COLUMNS.values())
+    positions = numbers(runners, columns)
+    finish_columns = {call: index for index, call in enumerate(POSITION_COLUMNS)}
+    finish_index = pd.Series(distance).map(finish_columns).fillna(-1).to_numpy(dtype=int)
+
+    has_finish_column = finish_index >= 0
+    finish = np.where(has_finish_column, positions[np.arange(len(positions)), np.maximum(finish_index, 0)], np.nan)
+    calls = np.array(list(POSITION_COLUMNS))
+    earlier_calls = (~np.isnan(positions) & (calls[None, :] < distance[:, None])).any(axis=1)
+
+    mask = np.zeros(positions.shape, dtype=bool)
+    missing = has_finish_column & earlier_calls & np.isnan(finish)
+    mask[np.nonzero(missing)[0], finish_index[missing]] = True
+    return cell_violations(runners, columns, mask, 'finish_position_missing', positions, 'positions at earlier calls')
+
+
+CHECKS = [
+    check_position_exceeds_field_size,
+    check_times_increase_with_distance,
+    check_lead_or_beaten_beyond_distance,
+    check_finish_position_missing,
+]
+
+
+def run_checks(races, performances):
+    """Runs every check on one partition and returns the violations together."""
+    return pd.concat([check(races, performances) for check in CHECKS], ignore_index=True)
+
+
+def partitions(races, performances, count):
+    """Splits the races and their performances into count partitions by track."""
+    def bucket(data):
+        return data['track'].astype(str).map(lambda track: zlib.crc32(track.encode()) % count)
+    race_buckets, performance_buckets = bucket(races), bucket(performances)
+    return [(races[race_buckets == i], performances[performance_buckets == i]) for i in range(count)]
+
+
+def check_tables(db, processes=None, partition_count=16):
+    """ Loads the columns the checks need from the consolidated tables and runs the checks across a process pool.
+        Returns the violations as a dataframe.
+    """
+    races = pd.DataFrame(db.query_db(db.generate_query(RACES_TABLE, RACE_FIELDS)), columns=RACE_FIELDS)
+    performances = pd.DataFrame(db.query_db(db.generate_query(PERFORMANCES_TABLE, PERFORMANCE_FIELDS)),
+                                columns=PERFORMANCE_FIELDS)
+    for data in [races, performances]:
+        data['date'] = pd.to_datetime(data['date']).dt.date
+        data['race_num'] = pd.to_numeric(data['race_num'], errors='coerce')
+    print(f'Checking {len(races)} races and {len(performances)} performances')
+
+    parts = partitions(races, performances, partition_count)
+    if len(performances) < 50000:     # Not worth spinning up the pool
+        results = [run_checks(*part) for part in parts]
+    else:
+        # Spawned rather than forked: the pipeline calls this from a worker thread while other stages and the
+        # telemetry sampler may be running, and a fork can copy a lock one of them holds
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            results = pool.starmap(run_checks, parts)
+    return pd.concat(results, ignore_index=True).sort_values([*RACE_KEY, 'rule'], kind='stable')
+
+
+def write_violations(db, violations, batch_size=1000):
+    """Replaces the contents of the violations table with violations, batch_size rows per INSERT."""
+    db.initialize_table(VIOLATIONS_TABLE, {key: value[0] for key, value in TABLE_STRUCTURE.items()},
+                        unique_key=None, foreign_key=None)
+    db.update_db(f'DELETE FROM {VIOLATIONS_TABLE}')
+    rows = violations.to_numpy(dtype=object).tolist()
+    for start in range(0, len(rows), batch_size):
+        db.update_db(db.generate_insert_query(VIOLATIONS_TABLE, list(TABLE_STRUCTURE), rows[start:start + batch_size]))
+
+
+def check_consolidated_tables(db, processes=None, max_violations=None):
+    """ Runs the checks, writes the violations table, and prints the counts by rule. Raises ValueError if there are
+        more than max_violations violations.
+    """
+    violations = check_tables(db, processes)
+    write_violations(db, violations)
+    counts = violations['rule'].value_counts()
+    print(f'{len(violations)} integrity violations written to {VIOLATIONS_TABLE}' +
+          ''.join(f'\n\t{rule}: {count}' for rule, count in counts.items()))
+    if max_violations is not None and len(violations) > max_violations:
+        raise ValueError(f'{len(violations)} integrity violations (at most {max_violations} allowed)')
+    return violations
+
+
+def main():
+    import horse_performances_master
+    parser = argparse.ArgumentParser(description='Check the consolidated races and performances for bad data')
+    parser.add_argument('--database', default=horse_performances_master.consolidated_database)
+    parser.add_argument('--processes', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--max-violations', type=int, help='exit with an error if there are more violations')
+    args = parser.parse_args()
+
+    db = dbh.QueryDB(args.database)
+    db.connect()
+    try:
+        check_consolidated_tables(db, args.processes, args.max_violations)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import datetime
+import json
+import os
+from collections import Counter
+
+
+def to_json_value(value):
+    """json.dumps() fallback for values it can't serialize: numpy scalars become Python scalars, anything else a string."""
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+class IssueLog:
+    # The IssueLog class streams unresolved discrepancies to an append-only JSON lines file as they're found,
+    # one record per issue with the race key, column, source table, and the new and existing values. Records are
+    # buffered and flushed every buffer_size issues, so memory stays flat no matter how long the run is. Only the
+    # per-column counts are kept in memory. Use it as a context manager so the log is flushed and closed however
+    # the run ends.
+
+    def __init__(self, name, source_table, log_dir='logs', buffer_size=1000):
+        self.source_table = source_table
+        self.buffer_size = buffer_size
+
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%dT%H%M%S')
+        os.makedirs(log_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, f'{name}_{source_table}_{timestamp}.jsonl')
+        self.file = open(self.path, 'a')
+
+        self.buffer = list()
+        self.counts = Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, race_key, column, new_value=None, existing_value=None):
+        self.buffer.append(json.dumps({
+            'race_key': race_key,
+            'column': column,
+            'source_table': self.source_table,
+            'new_value': new_value,
+            'existing_value': existing_value,
+        }, default=to_json_value))
+        self.counts[column] += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.file.flush()
+            self.buffer = list()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+    def summary(self):
+        lines = [f'Unresolved issues for {self.source_table} ({sum(self.counts.values())}), logged to {self.path}:']
+        lines += [f'\t{column}: {count}' for column, count in self.counts.most_common()]
+        return '\n'.join(lines)
+
+
+def read_issues(path):
+    """Yields the issue records in an IssueLog file one at a time."""
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def column_counts(*paths):
+    """Returns a Counter of unresolved issues per column across one or more IssueLog files."""
+    counts = Counter()
+    for path in paths:
+        counts.update(issue['column'] for issue in read_issues(path))
+    return counts
@@ -0,0 +1,368 @@
+# Change journal for the consolidated tables.
+#
+# Every write to a consolidated table is appended to a JSON lines journal as it's made: which row (by the table's
+# UNIQUE key), which columns, the values before and after, the source table being consolidated, and the resolver
+# that made the change (e.g., FixerRaceType, or fill_missing when a blank consolidated value is filled in). Each
+# run writes its own directory under logs/journal/, one file per consolidated table and source.
+#
+# The journal can be folded back into table contents without going back to the sources. Run from the repository
+# root:
+#     python journal.py list
+#     python journal.py rebuild horses_consolidated_races --into horses_consolidated_races_rebuilt
+#     python journal.py rebuild horses_consolidated_races --into races_no_race_type --exclude-resolver FixerRaceType
+#     python journal.py revert horses_consolidated_races FixerRaceType --runs 2026-10-19T120000-4242
+#
+# rebuild writes the folded rows to a new table; it's only complete if the journal goes back to when the table
+# was created. revert puts back, in place, every value a resolver wrote that nothing has written over since.
+
+import argparse
+import datetime
+import functools
+import glob
+import heapq
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict, defaultdict
+
+from AdderDataHandler import unique_key
+from issue_log import to_json_value
+
+
+JOURNAL_DIR = os.path.join('logs', 'journal')
+
+# Resolver for writes made outside any instrumented resolver: adding a new entry or filling in a blank one
+DEFAULT_RESOLVER = 'consolidate'
+
+_run_id = None
+_process_id = None                  # Format: (pid, id) for the process that made it
+_sequence = itertools.count()       # Orders this process's records across journals (and threads)
+
+
+def run_id():
+    """ The id of this run's journal partition. Taken from RACE_AGGREGATOR_RUN_ID if it's set (so several
+        processes can share a run), otherwise the time the first journal was opened and the process id.
+    """
+    global _run_id
+    if _run_id is None:
+        _run_id = os.environ.get('RACE_AGGREGATOR_RUN_ID') or \
+                  f'{datetime.datetime.now().strftime("%Y-%m-%dT%H%M%S")}-{os.getpid()}'
+    return _run_id
+
+
+def process_id():
+    """ Tells this process's journal records apart from those of other processes sharing the run: its process id
+        and the time it first wrote to the journal, so a process id the OS hands out again gets a new one.
+    """
+    global _process_id
+    if _process_id is None or _process_id[0] != os.getpid():
+        _process_id = (os.getpid(), f'{os.getpid()}-{datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")}')
+    return _process_id[1]
+
+
+class ChangeJournal:
+    # The ChangeJournal class appends the writes to one consolidated table from one source table to this run's
+    # journal. key_function() returns the fields of the row currently being written ({'date': ..., 'track': ...,
+    # 'race_num': ..., 'horse_name': ...}) for updates, which only get a WHERE clause. The resolver is whatever
+    # instrumented method is running when the write is made. source_function, if given, returns the source table of
+    # each write, for processors that fold several sources in together.
+    #
+    # The values a row had before each update are looked up in a cache of the rows written recently, falling back to
+    # the values the data handler loaded. Those are stale for a row written earlier in the run whose cached values
+    # have since been evicted, so for those rows the handler reads them back from the table instead. Use it as a
+    # context manager (or call close()) so the journal is flushed and the instrumented methods are restored.
+
+    def __init__(self, table, source_table, key_function, source_function=None, journal_dir=JOURNAL_DIR,
+                 buffer_size=1000, cache_size=10000):
+        self.table = table
+        self.source_table = source_table
+        self.key_function = key_function
+        self.source_function = source_function or (lambda: source_table)
+        self.buffer_size = buffer_size
+        self.cache_size = cache_size
+
+        directory = os.path.join(journal_dir, run_id())
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{table}.{source_table}.jsonl')
+        self.file = open(self.path, 'a')
+
+        self.buffer = list()
+        self.records = 0
+        self.resolvers = [DEFAULT_RESOLVER]
+        self.recent = OrderedDict()     # Format: unique key: {column: value} for the rows written most recently
+        self.evicted = set()            # Unique keys of rows written this run that have dropped out of recent
+        self.instrumented = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def resolver(self):
+        return self.resolvers[-1]
+
+    def instrument(self, obj, method_name, resolver):
+        """Makes writes made while obj.method_name runs count as resolver's. restore() takes the wrapper out."""
+        method = getattr(obj, method_name)
+        resolvers = self.resolvers
+
+        @functools.wraps(method)
+        def resolving(*args, **kwargs):
+            resolvers.append(resolver)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                resolvers.pop()
+
+        self.instrumented.append((obj, method_name, obj.__dict__.get(method_name)))
+        setattr(obj, method_name, resolving)
+
+    def restore(self):
+        for obj, method_name, previous in reversed(self.instrumented):
+            if previous is not None:
+                setattr(obj, method_name, previous)
+            else:
+                try:
+                    delattr(obj, method_name)
+                except AttributeError:
+                    pass
+        self.instrumented = list()
+
+    def current_key(self, unique_columns):
+        fields = self.key_function()
+        return [fields.get(column) for column in unique_columns]
+
+    def previous_values(self, key, columns, loaded=None, read=None):
+        """ The values columns had in the row with key before the write being recorded: the last ones this journal
+            wrote, or failing that the ones in loaded ({column: value}, e.g. from the handler's dataframe). If the
+            row was written this run but has been evicted from the cache, loaded may predate that write, so read()
+            is called for the values in the table instead, when it's given.
+        """
+        row_key = unique_key(key)
+        written = self.recent.get(row_key, dict())
+        if read is not None and row_key in self.evicted and any(column not in written for column in columns):
+            loaded = read()
+        loaded = loaded or dict()
+        return [written[column] if column in written else loaded.get(column) for column in columns]
+
+    def record_update(self, key, columns, old_values, new_values):
+        self.remember(key, columns, new_values)
+        self.write({'op': 'update', 'key': key, 'columns': columns, 'old': old_values, 'new': new_values})
+
+    def record_insert(self, unique_columns, columns, rows):
+        key_positions = [columns.index(column) for column in unique_columns]
+        for row in rows:
+            self.remember([row[position] for position in key_positions], columns, row)
+        self.write({'op': 'insert', 'columns': columns, 'rows': rows})
+
+    def record_rewrite(self, column, value_map):
+        self.evicted.update(self.recent)
+        self.recent.clear()
+        self.write({'op': 'rewrite', 'column': column, 'map': value_map})
+
+    def remember(self, key, columns, values):
+        row_key = unique_key(key)
+        if row_key is None:
+            return
+        self.recent.setdefault(row_key, dict()).update(zip(columns, values))
+        self.recent.move_to_end(row_key)
+        if len(self.recent) > self.cache_size:
+            self.evicted.add(self.recent.popitem(last=False)[0])
+
+    def write(self, record):
+        record.update({'seq': next(_sequence), 'process': process_id(), 'time': time.time(), 'table': self.table,
+                       'source': self.source_function(), 'resolver': self.resolver})
+        self.buffer.append(json.dumps(record, default=to_json_value))
+        self.records += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.file.flush()
+            self.buffer = list()
+
+    def close(self):
+        self.restore()
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+
+def list_runs(journal_dir=JOURNAL_DIR):
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(journal_dir, '*')) if os.path.isdir(path))
+
+
+def read_records(table, runs=None, journal_dir=JOURNAL_DIR):
+    """ The journal records for table from runs (default: all of them), in the order the writes were made. seq only
+        orders the records of one process, so when several processes share a run their records are merged by the
+        time they were written, keeping each process's own records in seq order.
+    """
+    for run in runs or list_runs(journal_dir):
+        processes = defaultdict(list)
+        for path in glob.glob(os.path.join(journal_dir, run, f'{table}.*.jsonl')):
+            with open(path) as file:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        processes[record.get('process', '')].append(record)
+        for records in processes.values():
+            records.sort(key=lambda record: record['seq'])
+        for record in heapq.merge(*processes.values(), key=lambda record: record.get('time', 0)):
+            record['run'] = run
+            yield record
+
+
+def fold(records, unique_columns, skip=lambda record: False):
+    """ Replays records into {unique key: {column: value}}. Records for which skip(record) is true are left out;
+        a row they would have been the first to write starts from the values they replaced instead.
+    """
+    rows = dict()
+    for record in records:
+        if record['op'] == 'rewrite':
+            if skip(record): continue
+            value_map = record['map']
+            for values in rows.values():
+                if values.get(record['column']) in value_map:
+                    values[record['column']] = value_map[values[record['column']]]
+            continue
+
+        if record['op'] == 'insert':
+            columns = record['columns']
+            key_positions = [columns.index(column) for column in unique_columns]
+            changes = [([row[position] for position in key_positions], columns, None, row) for row in record['rows']]
+        else:
+            changes = [(record['key'], record['columns'], record['old'], record['new'])]
+
+        for key, columns, old_values, new_values in changes:
+            row_key = unique_key(key)
+            if row_key is None: continue
+            values = rows.setdefault(row_key, dict(zip(unique_columns, key)))
+            if skip(record):
+                for column, old_value in zip(columns, old_values or [None] * len(columns)):
+                    values.setdefault(column, old_value)
+            else:
+                values.update(zip(columns, new_values))
+    return rows
+
+
+def data_pack_for(table):
+    """The masters' DataPack for a consolidated table, for its UNIQUE key and dtypes."""
+    if table == 'horses_consolidated_races':
+        import race_table_master
+        return race_table_master.data_pack
+    import horse_performances_master
+    return horse_performances_master.data_pack
+
+
+def rebuild(table, into, database, runs=None, exclude_resolvers=(), journal_dir=JOURNAL_DIR, query_db=None):
+    """ Folds the journal for table into a new table, leaving out the writes of exclude_resolvers. Returns the
+        number of rows written.
+    """
+    import db_handler as dbh
+    from schema_plan import compile_schema
+
+    plan = compile_schema(data_pack_for(table)).plan(table)
+    rows = fold(read_records(table, runs, journal_dir), plan.unique,
+                skip=lambda record: record['resolver'] in exclude_resolvers)
+
+    db = query_db or dbh.QueryDB(database)
+    db.connect()
+    db.initialize_table(into, plan.dtypes, unique_key=plan.unique, foreign_key=None)
+    columns = [column for column in plan.dtypes if any(column in values for values in rows.values())]
+    db.add_to_table(into, [[values.get(column) for column in columns] for values in rows.values()], columns)
+    return len(rows)
+
+
+def revert(table, resolver, database, runs=None, journal_dir=JOURNAL_DIR, query_db=None):
+    """ Puts back the values resolver wrote to table in runs (default: every run), as they'd be if it had never
+        written them. Values another resolver has written over since are left alone. The reverting writes are
+        journaled too, under 'revert <resolver>'. Returns (cells reverted, cells left alone).
+    """
+    import db_handler as dbh
+    from schema_plan import compile_schema
+
+    plan_unique = list(compile_schema(data_pack_for(table)).plan(table).unique)
+    records = list(read_records(table, None, journal_dir))
+    reverted_runs = set(runs or list_runs(journal_dir))
+
+    def reverted(record):
+        return record['resolver'] == resolver and record['run'] in reverted_runs
+
+    # Cells whose last write was one of the reverted ones, and how many were written over later
+    last_writer = dict()
+    for record in records:
+        if record['op'] == 'update':
+            for column in record['columns']:
+                last_writer[(unique_key(record['key']), column)] = reverted(record)
+    cells = defaultdict(list)
+    for (row_key, column), is_reverted in last_writer.items():
+        if is_reverted: cells[row_key].append(column)
+    left_alone = sum(1 for record in records if reverted(record) and record['op'] == 'update'
+                     for column in record['columns'] if not last_writer[(unique_key(record['key']), column)])
+
+    current = fold(records, plan_unique)
+    rows = fold(records, plan_unique, skip=reverted)
+    db = query_db or dbh.QueryDB(database)
+    db.connect()
+    with ChangeJournal(table, 'journal', lambda: dict(), journal_dir=journal_dir) as journal:
+        journal.resolvers.append(f'revert {resolver}')
+        for row_key, columns in cells.items():
+            values = rows[row_key]
+            key = [values[column] for column in plan_unique]
+            where = db.concatenate_field_value_pairs(plan_unique, key, separator=' AND ')
+            db.update_db(db.generate_update_query(table, columns, [values.get(column) for column in columns],
+                                                  where=where))
+            journal.record_update(key, columns, [current[row_key].get(column) for column in columns],
+                                  [values.get(column) for column in columns])
+    return sum(len(columns) for columns in cells.values()), left_alone
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild or revert consolidated tables from the change journal')
+    parser.add_argument('--journal-dir', default=JOURNAL_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('list', help='list the runs in the journal and what each one wrote')
+
+    rebuild_parser = commands.add_parser('rebuild', help='fold the journal for a table into a new table')
+    rebuild_parser.add_argument('table')
+    rebuild_parser.add_argument('--into', required=True, help='table to create and fill')
+    rebuild_parser.add_argument('--database', default='horses_consolidated_races')
+    rebuild_parser.add_argument('--runs', nargs='+', help='runs to replay (default: all of them)')
+    rebuild_parser.add_argument('--exclude-resolver', nargs='+', default=[], help="leave out these resolvers' writes")
+
+    revert_parser = commands.add_parser('revert', help="put back the values a resolver wrote, in place")
+    revert_parser.add_argument('table')
+    revert_parser.add_argument('resolver')
+    revert_parser.add_argument('--database', default='horses_consolidated_races')
+    revert_parser.add_argument('--runs', nargs='+', help='only revert what it wrote in these runs')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for run in list_runs(args.journal_dir):
+            counts = defaultdict(int)
+            for path in glob.glob(os.path.join(args.journal_dir, run, '*.jsonl')):
+                with open(path) as file:
+                    for line in file:
+                        record = json.loads(line)
+                        counts[(record['table'], record['resolver'])] += 1
+            print(run)
+            for (table, resolver), count in sorted(counts.items()):
+                print(f'    {table:<40}{resolver:<30}{count:>10}')
+    elif args.command == 'rebuild':
+        count = rebuild(args.table, args.into, args.database, args.runs, args.exclude_resolver, args.journal_dir)
+        print(f'Rebuilt {count} rows of {args.table} into {args.into}')
+    elif args.command == 'revert':
+        count, left_alone = revert(args.table, args.resolver, args.database, args.runs, args.journal_dir)
+        print(f'Reverted {count} values {args.resolver} wrote to {args.table}; '
+              f'{left_alone} written over since were left alone')
+
+
+if __name__ == '__main__':
+    main()
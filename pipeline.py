@@ -0,0 +1,376 @@
+# Runs the consolidation pipeline as a graph of stages:
+#
+#   races/horse_pps -> races/race_general_results --+
+#                                                   +--> performances/race_horse_info
+#   horse_name_index -------------------------------+        -> performances/horse_pps
+#                                                                               -> performances/days_since_last_race
+#                                                                               -> performances/horse_history
+#                                                                               -> integrity_checks
+#
+# The race stages write the same consolidated table and each checks its source against what the earlier ones added,
+# so they depend on each other in the order the masters always ran them; the same goes for the two performance
+# stages. The horse name index doesn't touch the consolidated tables and builds while the races run. With
+# --merge-races the race stages become a single races/merged stage that consolidates them in one pass.
+# days_since_last_race is derived from the consolidated performances once they're all in, and then the new
+# performances are added to the per-horse history index and the consolidated tables are checked for bad data.
+#
+# Every stage that writes to the database is skipped when it's up to date: its fingerprint (the row count and
+# checksum of each source table, the settings that change its output, and the fingerprints of the stages it depends
+# on) matches the one recorded the last time it finished, and the tables it writes still have the row count and
+# checksum they were left with. A consolidated table that was truncated, dropped or edited outside the pipeline puts
+# every stage that writes it out of date. Run from the repository root:
+#     python pipeline.py                                  # everything that's out of date
+#     python pipeline.py performances/horse_pps --force   # just the one stage, whether or not it's up to date
+#     python pipeline.py --list
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import db_handler as dbh
+
+
+class Stage:
+    # A unit of pipeline work. function(context) does the work; anything it returns is stored in context under
+    # the stage name for the stages that depend on it. sources are (database, table) pairs whose signatures go into
+    # the fingerprint, and targets the (database, table) pairs the stage writes. Stages with persistent=False only
+    # produce something in memory, so they're never skipped as up to date and only run when a stage that needs them
+    # runs.
+
+    def __init__(self, name, function, depends_on=(), sources=(), targets=(), settings=None, persistent=True):
+        self.name = name
+        self.function = function
+        self.depends_on = list(depends_on)
+        self.sources = list(sources)
+        self.targets = list(targets)
+        self.settings = settings or dict()
+        self.persistent = persistent
+
+
+def build_stages(source_database, races_data_limit=None, performances_data_limit=None, profile=False,
+                 progress_bar=False, merge_races=False, race_grouped=None, max_violations=None, profile_dir=None):
+    """ The race and performance stages, with the masters' settings unless overridden. merge_races=True replaces
+        the race stages with a single races/merged stage that consolidates them in one pass. race_grouped
+        sets whether the performance stages process their rows a race at a time. The integrity_checks stage fails
+        if it finds more than max_violations violations (default: it only reports them). The stage timings (and the
+        cProfile dumps, with profile=True) go to profile_dir.
+    """
+    import race_table_master
+    import horse_performances_master
+    from horse_name_index import get_horse_name_index
+    from schema_plan import compile_schema
+
+    # Check the constants before anything runs; a stage shouldn't be the first to find out they don't line up
+    compile_schema(race_table_master.data_pack)
+    compile_schema(horse_performances_master.data_pack)
+
+    if races_data_limit is None: races_data_limit = race_table_master.data_limit
+    if performances_data_limit is None: performances_data_limit = horse_performances_master.data_limit
+    if race_grouped is None: race_grouped = horse_performances_master.race_grouped
+    if profile_dir is None: profile_dir = horse_performances_master.profile_dir
+    races_table = (race_table_master.consolidated_database, 'horses_consolidated_races')
+    performances_table = (horse_performances_master.consolidated_database, 'horses_consolidated_performances')
+    violations_table = (horse_performances_master.consolidated_database, 'integrity_violations')
+    stages = list()
+
+    previous = list()
+    if merge_races:
+        def merge(context):
+            race_table_master.merge_races(race_table_master.RACE_SOURCE_TABLES, source_database, races_data_limit,
+                                          profile, progress_bar, profile_dir)
+        stages.append(Stage('races/merged', merge,
+                            sources=[(source_database, table) for table in race_table_master.RACE_SOURCE_TABLES],
+                            targets=[races_table], settings={'data_limit': races_data_limit}))
+        previous = ['races/merged']
+    else:
+        for table in race_table_master.RACE_SOURCE_TABLES:
+            def consolidate_races(context, table=table):
+                race_table_master.consolidate_races(table, source_database, races_data_limit, profile, progress_bar,
+                                                    profile_dir)
+            stages.append(Stage(f'races/{table}', consolidate_races, depends_on=previous,
+                                sources=[(source_database, table)], targets=[races_table],
+                                settings={'data_limit': races_data_limit}))
+            previous = [f'races/{table}']
+
+    stages.append(Stage('horse_name_index', lambda context: get_horse_name_index(source_database), persistent=False))
+
+    previous += ['horse_name_index']
+    for table in horse_performances_master.PERFORMANCE_SOURCE_TABLES:
+        def consolidate_performances(context, table=table):
+            horse_performances_master.consolidate_performances(table, context['horse_name_index'], source_database,
+                                                               performances_data_limit, profile, progress_bar,
+                                                               race_grouped, profile_dir)
+        stages.append(Stage(f'performances/{table}', consolidate_performances, depends_on=previous,
+                            sources=[(source_database, table)], targets=[performances_table],
+                            settings={'data_limit': performances_data_limit}))
+        previous = [f'performances/{table}', 'horse_name_index']
+
+    stages.append(Stage('performances/days_since_last_race',
+                        lambda context: horse_performances_master.derive_days_since_last_race(),
+                        depends_on=previous[:1], targets=[performances_table]))
+    stages.append(Stage('performances/horse_history', lambda context: horse_performances_master.update_horse_history(),
+                        depends_on=['performances/days_since_last_race']))
+    stages.append(Stage('integrity_checks',
+                        lambda context: horse_performances_master.check_integrity(max_violations),
+                        depends_on=['performances/days_since_last_race'], targets=[violations_table],
+                        settings={'max_violations': max_violations}))
+
+    return stages
+
+
+def table_signature(database, table):
+    """ Row count and CHECKSUM TABLE checksum for a table, so edits in place show up as well as added or deleted
+        rows. None if the table can't be read (so the stages that use it always run).
+    """
+    db = dbh.QueryDB(database)
+    try:
+        db.connect()
+        rows = db.query_db(f'SELECT COUNT(*) FROM {table}')[0][0]
+        checksum = db.query_db(f'CHECKSUM TABLE {table}')[0][1]
+        return {'rows': rows, 'checksum': checksum}
+    except Exception as e:
+        print(f'Unable to read the signature of {database}.{table}: {e}')
+        return None
+    finally:
+        db.close()
+
+
+class PipelineRunner:
+    # The PipelineRunner class runs a set of stages, as many at a time as jobs allows, starting each one as soon
+    # as everything it depends on has finished. A stage that fails stops the stages downstream of it but not the
+    # rest. Fingerprints and timings for finished stages are kept in the state file, along with the signature each
+    # target table was left with by the last stage that wrote it.
+
+    def __init__(self, stages, jobs=2, state_path=os.path.join('logs', 'pipeline_state.json'), force=False,
+                 signature=table_signature):
+        self.stages = {stage.name: stage for stage in stages}
+        self.jobs = jobs
+        self.state_path = state_path
+        self.force = force
+        self.signature = signature
+
+        self.state = self.load_state()
+        self.state_lock = threading.Lock()
+        self.context = dict()
+        self.timings = dict()       # Format: stage name: (status, seconds)
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return dict()
+
+    def save_state(self, stage, fingerprint, seconds):
+        # Read outside the lock; nothing else writes a stage's targets while it's being recorded
+        targets = {f'{database}.{table}': self.signature(database, table) for database, table in stage.targets}
+        with self.state_lock:
+            self.state[stage.name] = {
+                'fingerprint': fingerprint,
+                'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+                'seconds': round(seconds, 3),
+            }
+            self.state.setdefault('tables', dict()).update(targets)
+            os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+            temp_path = self.state_path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(self.state, file, indent=2)
+            os.replace(temp_path, self.state_path)
+
+    def upstream(self, names):
+        """names plus every stage they depend on, directly or not."""
+        found = set()
+        to_visit = list(names)
+        while to_visit:
+            name = to_visit.pop()
+            if name not in found:
+                found.add(name)
+                to_visit.extend(self.stages[name].depends_on)
+        return found
+
+    def ordered(self, names):
+        """names in an order where every stage comes after the stages it depends on."""
+        order = list()
+        visiting = set()
+
+        def visit(name):
+            if name in order: return
+            if name in visiting: raise ValueError(f'Dependency cycle through stage {name}')
+            visiting.add(name)
+            for dependency in self.stages[name].depends_on:
+                visit(dependency)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return [name for name in order if name in names]
+
+    def fingerprints(self):
+        """ Fingerprint for every stage, computed from its inputs before anything runs. A stage whose fingerprint
+            is None (e.g., a source couldn't be read) is never up to date.
+        """
+        fingerprints = dict()
+        for name in self.ordered(self.stages):
+            stage = self.stages[name]
+            if not stage.persistent:
+                continue
+            sources = {f'{database}.{table}': self.signature(database, table) for database, table in stage.sources}
+            upstream = {dependency: fingerprints.get(dependency) for dependency in stage.depends_on
+                        if self.stages[dependency].persistent}
+            if None in sources.values() or None in upstream.values():
+                fingerprints[name] = None
+                continue
+            inputs = json.dumps({'stage': name, 'sources': sources, 'settings': stage.settings,
+                                 'upstream': upstream}, sort_keys=True, default=str)
+            fingerprints[name] = hashlib.sha1(inputs.encode()).hexdigest()
+        return fingerprints
+
+    def changed_targets(self):
+        """ The target tables that don't have the signature the last stage to write them left them with: changed or
+            emptied outside the pipeline, never written, or unreadable.
+        """
+        recorded = self.state.get('tables', dict())
+        targets = {target for stage in self.stages.values() for target in stage.targets}
+        return {target for target in targets
+                if recorded.get('.'.join(target)) is None or self.signature(*target) != recorded['.'.join(target)]}
+
+    def plan(self, selected=None, with_upstream=False):
+        """ Returns (stages to run, stages skipped as up to date), in dependency order. Stages outside selected are
+            taken as done unless with_upstream is set.
+        """
+        selected = set(selected or self.stages)
+        if with_upstream: selected = self.upstream(selected)
+        fingerprints = self.fingerprints()
+        changed_targets = self.changed_targets()
+
+        to_run, skipped = set(), set()
+        for name in self.ordered(selected):
+            stage = self.stages[name]
+            if not stage.persistent:
+                continue
+            recorded = self.state.get(name, dict()).get('fingerprint')
+            upstream_rerun = any(dependency in to_run for dependency in stage.depends_on)
+            target_changed = any(target in changed_targets for target in stage.targets)
+            if self.force or upstream_rerun or target_changed or fingerprints[name] is None \
+                    or recorded != fingerprints[name]:
+                to_run.add(name)
+            else:
+                skipped.add(name)
+
+        # In-memory stages run whenever something that needs them does, selected or not
+        to_visit = list(to_run)
+        while to_visit:
+            for dependency in self.stages[to_visit.pop()].depends_on:
+                if not self.stages[dependency].persistent and dependency not in to_run:
+                    to_run.add(dependency)
+                    to_visit.append(dependency)
+        return self.ordered(to_run), self.ordered(skipped), fingerprints
+
+    def run(self, selected=None, with_upstream=False):
+        """Runs the planned stages. Returns True if every one of them finished."""
+        to_run, skipped, fingerprints = self.plan(selected, with_upstream)
+        for name in skipped:
+            print(f'Skipping {name}: up to date')
+            self.timings[name] = ('up to date', 0.0)
+
+        pending = list(to_run)
+        running = dict()        # Format: future: stage name
+        done, failed = set(), set()
+
+        def ready(name):
+            return all(dependency in done or dependency not in to_run for dependency in self.stages[name].depends_on)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while pending or running:
+                for name in [name for name in pending if ready(name)]:
+                    pending.remove(name)
+                    print(f'Starting {name}')
+                    running[executor.submit(self.run_stage, self.stages[name], fingerprints.get(name))] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                    except Exception as e:
+                        print(f'Stage {name} failed: {e}')
+                        failed.add(name)
+                        self.timings[name] = ('failed', self.timings.get(name, ('', 0.0))[1])
+                        # Anything downstream of a failed stage can't run
+                        blocked = [other for other in pending if name in self.upstream([other])]
+                        for other in blocked:
+                            pending.remove(other)
+                            self.timings[other] = ('blocked', 0.0)
+
+        print(self.report())
+        return not failed and not pending
+
+    def run_stage(self, stage, fingerprint):
+        start = time.perf_counter()
+        try:
+            self.context[stage.name] = stage.function(self.context)
+        finally:
+            self.timings[stage.name] = ('done', time.perf_counter() - start)
+        if stage.persistent and fingerprint is not None:
+            self.save_state(stage, fingerprint, self.timings[stage.name][1])
+
+    def report(self):
+        lines = [f'{"stage":<35}{"status":>12}{"seconds":>12}']
+        for name in self.ordered(self.timings):
+            status, seconds = self.timings[name]
+            lines.append(f'{name:<35}{status:>12}{seconds:>12.2f}')
+        return '\n'.join(lines)
+
+
+def main():
+    import race_table_master
+    parser = argparse.ArgumentParser(description='Run the race and performance consolidation stages')
+    parser.add_argument('stages', nargs='*', help='stages to run (default: all of them)')
+    parser.add_argument('--list', action='store_true', help='list the stages and their dependencies and exit')
+    parser.add_argument('--with-upstream', action='store_true', help='also run the stages the selected ones need')
+    parser.add_argument('--force', action='store_true', help='run stages even if they are up to date')
+    parser.add_argument('--jobs', type=int, default=2, help='stages to run at the same time')
+    parser.add_argument('--source-database', default=race_table_master.source_database)
+    parser.add_argument('--state-file', default=os.path.join('logs', 'pipeline_state.json'))
+    parser.add_argument('--merge-races', action='store_true',
+                        help='consolidate the race sources in a single merged pass (one races/merged stage)')
+    parser.add_argument('--race-grouped', action='store_true',
+                        help='process the performance rows a race at a time')
+    parser.add_argument('--max-violations', type=int,
+                        help='fail the integrity_checks stage if it finds more integrity violations than this')
+    parser.add_argument('--profile', action='store_true', help='dump a cProfile of each stage to --profile-dir')
+    parser.add_argument('--profile-dir', help='directory for the stage timings and cProfile dumps (default: logs)')
+    parser.add_argument('--progress-bar', action='store_true')
+    args = parser.parse_args()
+    dbh.configure_logging()
+
+    stages = build_stages(args.source_database, profile=args.profile, progress_bar=args.progress_bar,
+                          merge_races=args.merge_races, race_grouped=args.race_grouped or None,
+                          max_violations=args.max_violations, profile_dir=args.profile_dir)
+    runner = PipelineRunner(stages, jobs=args.jobs, state_path=args.state_file, force=args.force)
+
+    if args.list:
+        for stage in stages:
+            dependencies = ', '.join(stage.depends_on) or '-'
+            print(f'{stage.name:<35} after: {dependencies}')
+        return
+
+    unknown = [name for name in args.stages if name not in runner.stages]
+    if unknown:
+        parser.error(f'unknown stage(s): {", ".join(unknown)}')
+
+    if not runner.run(args.stages or None, args.with_upstream):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
-# Runs the race aggregation/consolidation functions in the correct order
-# todo This is probably not the most pythonic way of doing this--consider updating.
+# Runs the race aggregation/consolidation stages in dependency order. See pipeline.py for the stages and options.
 
-import race_table_master
-import horse_performances_master
+from pipeline import main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import hashlib
+import re
+from collections import namedtuple
+from multiprocessing import Pool
+
+from constants.constant_race_conditions_parsed_table_structure import TABLE_STRUCTURE, UNIQUE
+
+
+# Structured facts pulled out of a race's conditions text. off_turf_distance is the alternate distance (in yards)
+# the race will be run at if taken off the turf; multipart is set when the off-turf clause names more than one
+# distance, in which case off_turf_distance is left blank.
+ConditionsFacts = namedtuple('ConditionsFacts', ['off_turf_distance', 'multipart', 'grade',
+                                                 'waiver_maiden_claiming', 'trials'])
+
+TRIGGERS_STRING = r'(if ?deemed ?inadvisable|if ?necessary|if ?deemed ?inadvisable|' \
+                  r'if ?management ?deems ?it|if ?the ?stewards ?consider ?it|if ?stewards ?consider ?it|' \
+                  r'if ?the ?management ?considers ?it|if ?management ?considers ?it|if ?transferred ?to|' \
+                  r'if ?this ?race ?is ?taken|if ?the ?race ?is ?taken|in ?the ?event ?this ?race|' \
+                  r'in ?the ?event ?that ?this ?race|if ?this ?race ?is ?taken|if ?this ?race ?comes ?off)'
+
+# Prefilter for find_trigger(): the trigger alternation on its own, without the backtracking tails
+TRIGGER_SEARCH = re.compile(TRIGGERS_STRING)
+
+MULTIPART_STRING = r'(miles?|furlongs).+?(miles?|furlongs)'
+MULTIPART_SEARCH = re.compile(r'{}.+{}'.format(TRIGGERS_STRING, MULTIPART_STRING))
+
+NUMBERS_STRING = r'([1-9]|one|two|three|four|five|six|seven|eight|nine|ten)'
+FRACTIONS_STRING = r'(one half|onehalf|a half|1/2)'
+FULL_FURLONG_STRING = r'{}( ?and {})? furlongs?'.format(NUMBERS_STRING, FRACTIONS_STRING)
+FURLONG_SEARCH = re.compile(r'{}.+?{}'.format(TRIGGERS_STRING, FULL_FURLONG_STRING))
+
+MILE_STRING = r'(one mile|onemile|1mile|1 mile)'
+FRACTIONAL_MILE_STRING = r'(one sixteenth|1 sixteenth|1/16|one eighth|1 eighth|1/8|' \
+                         r'seventy yards|70 yards|forty yards|40 yards)'
+FULL_MILE_STRING = r'{}( ?and {})?'.format(MILE_STRING, FRACTIONAL_MILE_STRING)
+MILE_SEARCH = re.compile(r'{}.+?{}'.format(TRIGGERS_STRING, FULL_MILE_STRING))
+
+NUM_CONVERSIONS = {
+    'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10,
+    '1': 1, '2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, '10': 10,
+}
+
+# Checked from most to least specific so that 'Grade II.' isn't read as 'Grade I.'
+GRADES = [(3, 'Grade III.'), (2, 'Grade II.'), (1, 'Grade I.')]
+
+# Folded into the text hashes the parsed facts are stored under. Bump it whenever parse_conditions() changes what
+# it pulls out of a text, so the facts parsed by the old version aren't looked up any more and get parsed again.
+PARSER_VERSION = 1
+
+
+def hash_text(text):
+    return hashlib.sha1(f'{PARSER_VERSION}:{text}'.encode('utf-8')).hexdigest()
+
+
+def find_trigger(race_conditions):
+    """ Single linear scan for the first off-turf trigger phrase in lowercased race conditions text.
+
+        Returns the position of the first trigger, or None. Every full regex below starts with a trigger, so a
+        text without one can't match any of them, and a match can't start before the first trigger. Most
+        conditions text has no trigger at all.
+    """
+    trigger = TRIGGER_SEARCH.search(race_conditions)
+    return trigger.start() if trigger else None
+
+
+def extract_changed_distance(race_conditions, prefilter=True):
+    """ Looks for an off-turf distance change in lowercased race conditions text.
+
+        Returns ('multipart', None) if the off-turf clause names more than one distance, ('furlong', match) or
+        ('mile', match) if a single distance was found, and None otherwise. prefilter=False skips the
+        find_trigger() check and runs the full regexes over the whole text.
+    """
+    start = 0
+    if prefilter:
+        start = find_trigger(race_conditions)
+        if start is None:
+            return None
+
+    if MULTIPART_SEARCH.search(race_conditions, start):
+        return ('multipart', None)
+
+    furlong_result = FURLONG_SEARCH.search(race_conditions, start)
+    if furlong_result:
+        return ('furlong', furlong_result)
+
+    mile_result = MILE_SEARCH.search(race_conditions, start)
+    if mile_result:
+        return ('mile', mile_result)
+
+    # Multipart phrases
+    #   "If Deemed inadvisable by management to run this race over the turf course; it will be run on the main track at One Mile. If the race is for two year olds; it will be run at Seven Furlongs",
+    #   'If the Stewards consider it inadvisable to run this race on the turf course; Two - Year - Old races will be run at Seven Furlongs and races for Three - Year - Olds and Up will be run at One Mileand One Eighth on the main track.',
+
+    # todo chute-related phrases:
+    # 'One mile out of the chute.'
+
+    return None
+
+
+def convert_to_int_distance(unit_type, distance_match):
+    """Converts a match from extract_changed_distance() to yards. Raises ValueError for unknown fractions."""
+    if distance_match is None: return None
+
+    if unit_type == 'mile':
+        mile_dist_in_yards = 1760 if re.search(r'1|one', distance_match.group(2)) else 3520
+        fractional_part = distance_match.group(3)
+        if fractional_part is None:
+            fractional_dist_in_yards = 0
+        elif re.search(r'70|seventy', fractional_part):
+            fractional_dist_in_yards = 70
+        elif re.search(r'40|forty', fractional_part):
+            fractional_dist_in_yards = 40
+        elif re.search(r'sixteenth|16', fractional_part):
+            fractional_dist_in_yards = 110
+        elif re.search(r'eighth|8', fractional_part):
+            fractional_dist_in_yards = 220
+        elif re.search(r'half|1/2', fractional_part):
+            fractional_dist_in_yards = 880
+        else:
+            raise ValueError(f'Error finding fractional mile distance for {fractional_part}')
+        return mile_dist_in_yards + fractional_dist_in_yards
+
+    if unit_type == 'furlong':
+        number_of_furlongs = NUM_CONVERSIONS[distance_match.group(2)]
+        furlong_dist_in_yards = number_of_furlongs * 220
+        fractional_part = distance_match.group(3)
+        if fractional_part is None:
+            fractional_dist_in_yards = 0
+        elif re.search(r'one half|onehalf|a half|1/2', fractional_part):
+            fractional_dist_in_yards = 110
+        else:
+            raise ValueError(f'Error finding fractional furlong distance for {fractional_part}')
+        return furlong_dist_in_yards + fractional_dist_in_yards
+
+
+def unconverted_distance(race_conditions):
+    """ The off-turf distance phrase in race_conditions that convert_to_int_distance() can't convert to yards (an
+        unknown fraction), or None if there isn't one.
+    """
+    if not race_conditions: return None
+    result = extract_changed_distance(race_conditions.lower())
+    if result is None or result[0] == 'multipart':
+        return None
+    try:
+        convert_to_int_distance(*result)
+    except ValueError:
+        return result[1].group(0)
+    return None
+
+
+def parse_conditions(race_conditions):
+    """ Parses one race's conditions text into a ConditionsFacts tuple. Runs in the build() pool workers, so it
+        doesn't print; an off-turf distance it can't convert is left blank, and FixerDistance reports it for review
+        through unconverted_distance().
+    """
+    lowered = race_conditions.lower()
+
+    off_turf_distance = None
+    multipart = False
+    result = extract_changed_distance(lowered)
+    if result is not None:
+        unit_type, distance_match = result
+        multipart = unit_type == 'multipart'
+        try:
+            off_turf_distance = convert_to_int_distance(unit_type, distance_match)
+        except ValueError:
+            pass
+
+    grade = None
+    for grade_number, marker in GRADES:
+        if marker in race_conditions:
+            grade = grade_number
+            break
+
+    return ConditionsFacts(off_turf_distance=off_turf_distance,
+                           multipart=multipart,
+                           grade=grade,
+                           waiver_maiden_claiming=race_conditions.startswith('WAIVER MAIDEN CLAIMING'),
+                           trials=race_conditions.startswith('TRIALS'))
+
+
+class ParsedConditionsTable:
+    # The ParsedConditionsTable class keeps the parsed facts for every distinct race conditions text, keyed by a
+    # hash of the text (and the parser version), in a table in the consolidated database. build() looks up the
+    # texts it's given, parses only the ones that aren't in the table yet (across a process pool), and writes them
+    # back, so the same text is never parsed twice across runs or source tables. get() is what the fixers consult.
+    # build_later() puts the build off until the first get(), so the conditions stores are only read if a fixer
+    # actually needs the parsed facts.
+
+    def __init__(self, db_handler=None, table_name='race_conditions_parsed', processes=None, verbose=False):
+        """ db_handler is a db_handler.QueryDB for the database that holds the parsed table. If it is None, parsed
+            facts are only kept in memory for the life of the object.
+        """
+        self.db = db_handler
+        self.table = table_name
+        self.processes = processes
+        self.verbose = verbose
+
+        self.facts = dict()         # text hash: ConditionsFacts
+        self.pending = None         # Function returning the texts to build, set by build_later()
+
+        if self.db is not None:
+            schema = {key: value[0] for key, value in TABLE_STRUCTURE.items()}
+            self.db.initialize_table(self.table, schema, unique_key=UNIQUE, foreign_key=None)
+
+    def load(self, hashes, batch_size=1000):
+        """Loads the previously parsed facts for hashes from the database, batch_size hashes per query."""
+        if self.db is None:
+            return
+        fields = list(TABLE_STRUCTURE.keys())
+        hashes = list(hashes)
+        for start in range(0, len(hashes), batch_size):
+            in_list = ', '.join(f"'{text_hash}'" for text_hash in hashes[start:start + batch_size])
+            sql_query = self.db.generate_query(self.table, fields, where=f'{UNIQUE[0]} IN ({in_list})')
+            for text_hash, *values in self.db.query_db(sql_query):
+                off_turf_distance, multipart, grade, waiver_maiden_claiming, trials = values
+                self.facts[text_hash] = ConditionsFacts(off_turf_distance=off_turf_distance,
+                                                        multipart=bool(multipart),
+                                                        grade=grade,
+                                                        waiver_maiden_claiming=bool(waiver_maiden_claiming),
+                                                        trials=bool(trials))
+
+    def build_later(self, texts_function):
+        """Builds the texts texts_function() returns the first time get() is called."""
+        self.pending = texts_function
+
+    def build(self, texts, chunksize=500):
+        """Parses all the texts not already in the table and writes the results to the database."""
+        missing = {hash_text(text): text for text in texts if text}
+        self.load([text_hash for text_hash in missing if text_hash not in self.facts])
+        missing = {text_hash: text for text_hash, text in missing.items() if text_hash not in self.facts}
+        if not missing:
+            return
+        print(f'Parsing {len(missing)} new race conditions texts')
+
+        hashes = list(missing.keys())
+        texts = [missing[text_hash] for text_hash in hashes]
+        if len(texts) < chunksize:     # Not worth spinning up the pool
+            parsed = [parse_conditions(text) for text in texts]
+        else:
+            with Pool(self.processes) as pool:
+                parsed = pool.map(parse_conditions, texts, chunksize=chunksize)
+        self.facts.update(zip(hashes, parsed))
+
+        if self.db is not None:
+            rows = [[text_hash, facts.off_turf_distance, int(facts.multipart), facts.grade,
+                     int(facts.waiver_maiden_claiming), int(facts.trials)]
+                    for text_hash, facts in zip(hashes, parsed)]
+            self.db.add_to_table(self.table, rows, list(TABLE_STRUCTURE.keys()))
+
+    def get(self, race_conditions):
+        """Returns the ConditionsFacts for a conditions text, parsing it on the spot if build() didn't see it."""
+        if not race_conditions:
+            return None
+        if self.pending is not None:
+            texts_function, self.pending = self.pending, None
+            self.build(texts_function())
+        text_hash = hash_text(race_conditions)
+        if text_hash not in self.facts:
+            self.facts[text_hash] = parse_conditions(race_conditions)
+        return self.facts[text_hash]
@@ -0,0 +1,73 @@
+RACE_CONDITIONS_FIELDS = ['race_conditions_text_1', 'race_conditions_text_2', 'race_conditions_text_3',
+                          'race_conditions_text_4', 'race_conditions_text_5', 'race_conditions_text_6']
+
+
+class RaceConditionsStore:
+    # The RaceConditionsStore class holds the concatenated race conditions text for every race in a table, keyed
+    # by race key (date + track + race_num, built the same way as AdderDataHandler.add_race_ids()). The text for
+    # all races in scope is pulled in a single query the first time any of it is asked for, so fixers that never
+    # read the conditions never cost a query. One store per table is shared by all the fixers of a processor. A
+    # store over a table that's written during the run follows the writes, re-reading a race whose conditions
+    # change once it's been loaded.
+
+    def __init__(self, data_handler, fields=None, follow_writes=False):
+        """ data_handler is the AdderDataHandler for the table holding the conditions.
+
+            fields is the list of conditions columns in that table. If not given, the columns are looked up
+            from the consolidated race_conditions_text_N fields through the handler's table structure.
+
+            follow_writes=True has data_handler report its writes to the store (see written()).
+        """
+        self.db = data_handler
+        table_structure = data_handler.get_table_structure()
+
+        if fields is None:
+            fields = [table_structure.get(field) for field in RACE_CONDITIONS_FIELDS]
+        self.fields = [field for field in fields if field]
+        self.key_fields = [table_structure['date'], table_structure['track'], table_structure['race_num']]
+
+        self.conditions = None          # Set by load()
+
+        if follow_writes:
+            data_handler.conditions_stores.append(self)
+
+    def load(self):
+        """Pulls the conditions text for every race in scope in one query and concatenates it per race."""
+        self.conditions = dict()
+        if not self.fields:
+            return
+
+        sql_query = self.db.db.generate_query(self.db.table, self.key_fields + self.fields, other=self.db.other)
+        for date, track, race_num, *texts in self.db.db.query_db(sql_query):
+            race_key = str(date) + str(track) + str(race_num)
+            # Tables with one row per horse repeat the race conditions on every row; keep the first one seen.
+            if race_key not in self.conditions:
+                self.conditions[race_key] = ''.join(item for item in texts if item)
+
+    def written(self, fields, race_id_sql):
+        """ Called by the data handler after it writes fields to the race(s) matching race_id_sql. If any of them
+            is a conditions column and the store has been loaded, the race's text is read again.
+        """
+        if self.conditions is None or not any(field in self.fields for field in fields):
+            return
+        sql_query = self.db.db.generate_query(self.db.table, self.key_fields + self.fields, where=race_id_sql)
+        for date, track, race_num, *texts in self.db.db.query_db(sql_query):
+            self.conditions[str(date) + str(track) + str(race_num)] = ''.join(item for item in texts if item)
+
+    def get(self, race_key):
+        """ Returns the concatenated conditions text for race_key. Returns None if the table has no conditions
+            columns and an empty string if the race has no conditions text.
+        """
+        if not self.fields:
+            return None
+        if self.conditions is None:
+            self.load()
+        return self.conditions.get(race_key, '')
+
+    def texts(self):
+        """Returns the set of distinct conditions texts in the store."""
+        if not self.fields:
+            return set()
+        if self.conditions is None:
+            self.load()
+        return set(self.conditions.values())
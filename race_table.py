@@ -5,14 +5,24 @@ import numpy as np
 import pandas as pd
 import datetime
 import re
-from progress.bar import Bar
 
 from AdderDataHandler import AdderDataHandler
 from aggregation_RaceProcessor import RaceProcessor
+from race_conditions_store import RaceConditionsStore, RACE_CONDITIONS_FIELDS
+from race_conditions_parser import ParsedConditionsTable
+from issue_log import IssueLog
 
 from fixer_distance import FixerDistance
 from fixer_purse import FixerPurse
 from fixer_race_type import FixerRaceType
+from constants.constant_aggregated_races_source_precedence import SOURCE_PRECEDENCE
+
+# Race distances (in yards) that are consolidated; races at any other distance are skipped
+RACE_DISTANCES_TO_PROCESS = [440, 660, 880, 990, 1100, 1210, 1320, 1430, 1540, 1650, 1760,
+                             1800, 1830, 1870, 1980, 2310, 2640, 3080, 3520]
+
+# Numbered fractions that race_general_results gives a time_<fraction> and distance_<fraction> for
+TIME_FRACTIONS = ['fraction_1', 'fraction_2', 'fraction_3', 'fraction_4', 'fraction_5']
 
 
 class AggRacesDataHandler(AdderDataHandler):
@@ -20,24 +30,11 @@ class AggRacesDataHandler(AdderDataHandler):
         # get_race_data() returns a dataframe containing information from the target table that
         # will be aggregated into the consolidated table.
 
-        # It first generates a dictionary with [consolidated_field_name]: [target_table_field_name]
-        # as the key/value pair. It then splits these up into parallel lists of consolidated and target table
-        # field names. The target table fields are used to query the db, and the consolidated field names
-        # are used as column headers in the resulting data frame.
-
-        # Because python does not guarantee the order that dictionary entries will be presented,
-        # we have to extract the [consolidate]:[target] pairs together and then split them up. If order
-        # were guaranteed, we could just use dict.values() and dict.keys() to get the field lists.
-
-        table_index = self.constants.TABLE_TO_INDEX_MAPPINGS[self.table]
-        field_dict = {key: value[table_index] for key, value in self.constants.CONSOLIDATED_TABLE_STRUCTURE.items()
-                      if value[table_index]}
-        extra_fields = {key: value[table_index] for key, value in self.constants.ADDITIONAL_FIELDS.items()
-                        if value[table_index]}
-        field_dict.update(extra_fields)
-        fields = [(key, value) for key, value in field_dict.items()]
-        source_fields = [item for _, item in fields]
-        consolidated_fields = [item for item, _ in fields]
+        # The table's plan has the target table fields to query, in the same order as the consolidated field
+        # names that are used as column headers in the resulting data frame.
+
+        source_fields = list(self.plan.select)
+        consolidated_fields = list(self.plan.columns)
 
         # Query the db and return the results as a Pandas dataframe
 
@@ -45,72 +42,66 @@ class AggRacesDataHandler(AdderDataHandler):
         db_data = self.db.query_db(sql_query)
         self.data = pd.DataFrame(db_data, columns=consolidated_fields)
 
+    def set_up_data(self):
+        super().set_up_data()
+        self.remapped_data = None       # Built from self.data by remap_times() the first time a row is asked for
+
+    def remap_times(self, columns=None):
+        """ Returns self.data with the fractional and final times moved into the time_<yards> columns for the
+            distance they were taken at, reindexed to columns (by default, the consolidated table's).
+
+            race_general_results gives each fraction's time and distance in numbered columns; these are melted into
+            one long (row, distance, time) frame along with the final time at the race distance and pivoted back out
+            by distance. The final time goes last, so it replaces any fraction reported at the finish distance
+            (horse_pps reports one). Times at distances with no time_<yards> column are reported together and left
+            out.
+        """
+        if columns is None: columns = list(self.plan.table_structure)
+        slots = [('distance_' + fraction, 'time_' + fraction) for fraction in TIME_FRACTIONS
+                 if 'distance_' + fraction in self.data and 'time_' + fraction in self.data]
+        if 'time_finish' in self.data: slots.append(('distance', 'time_finish'))
+        remapped = self.data.reindex(columns=columns)
+        if not slots or remapped.empty:
+            return remapped
+
+        times = pd.concat([pd.DataFrame({'row': np.arange(len(self.data)),
+                                         'distance': pd.to_numeric(self.data[distance_field], errors='coerce').values,
+                                         'time': self.data[time_field].values})
+                           for distance_field, time_field in slots], ignore_index=True)
+        times = times[times['distance'].notna()]
+        times['column'] = 'time_' + times['distance'].astype('int64').astype(str)
+        times = times.drop_duplicates(['row', 'column'], keep='last')
+
+        unknown = times[~times['column'].isin(columns)]
+        if len(unknown):
+            counts = unknown['distance'].astype('int64').value_counts().sort_index()
+            print(f'{self.table}: {len(unknown)} times at distances with no time column left out '
+                  f'(yards: count) {counts.to_dict()}')
+            times = times[times['column'].isin(columns)]
+
+        for column, group in times.groupby('column', sort=False):
+            values = remapped[column].to_numpy(dtype=object, copy=True)
+            values[group['row'].to_numpy()] = group['time'].to_numpy()
+            remapped[column] = pd.Series(values, index=remapped.index).infer_objects()
+        return remapped
+
     def get_row_data(self, i: int) -> pd.Series:
-        """ get_trimmed_row_data() returns a single row of race data from the dataframe with
+        """ get_row_data() returns a single row of race data from the dataframe with
                 (1) unused columns dropped; and
-                (2) columns renamed with field names appropriate for entry into the consolidated_db
+                (2) the fractional and final times in the time_<yards> columns for the consolidated_db
+            The whole dataframe is remapped by remap_times() when the first row is asked for.
         """
-
-        def get_fraction_mapping(row_data: pd.Series) -> dict:
-            mapping = dict()
-            fractions = ['fraction_1', 'fraction_2', 'fraction_3', 'fraction_4', 'fraction_5']
-            for fraction in fractions:
-                try:
-                    fraction_distance = int(row_data['distance_' + fraction])
-                    original_field = 'time_' + fraction
-                    new_field = 'time_' + str(fraction_distance)
-                    mapping[original_field] = new_field
-                except KeyError as e:
-                    if self.verbose: print(f'KeyError in get_fraction_mapping(): {e}')
-                    pass
-            return mapping
-
-        def get_finish_mapping(row_data: pd.Series) -> dict:
-            mapping = dict()
-            finish_distance = int(row_data['distance'])
-            original_field = 'time_finish'
-            new_field = 'time_' + str(finish_distance)
-            mapping[original_field] = new_field
-            return mapping
-
-        # Pull the row data, generate the index mappings, and rename the index
-        row_data = self.data.iloc[i]
-        fraction_mappings = get_fraction_mapping(row_data)
-        finish_mappings = get_finish_mapping(row_data)
-        row_data.rename(fraction_mappings, inplace=True)
-        row_data.rename(finish_mappings, inplace=True)
-
-        return row_data
-
-    def add_times(self, row_data):
-        # todo delete this
-        """ Puts the correct time values in the distance_time column of the row_data.
-
-            For horse_pps, this is already done in the source data, but for race_general results, we have to
-            consulte the fraction-distance field to determine what distance_time column to modify. For both table
-            types, we have to set the final time distance_time column manually.
+        if self.remapped_data is None:
+            self.remapped_data = self.remap_times()
+        return self.remapped_data.iloc[i]
+
+    def projected_data(self, columns, distances_to_process):
+        """ Returns the rows of races at distances_to_process as a dataframe indexed by race_id, laid out like
+            get_row_data() with the columns reindexed to columns (the consolidated table's). Blank race entries
+            are dropped.
         """
-        final_distance = row_data['distance']
-        final_distance_field = 'time_' + str(final_distance)
-
-        if self.table == 'horse_pps':
-            row_data[final_distance_field] = row_data['time_finish']
-            row_data.drop(labels='time_finish', inplace=True)
-        elif self.table == 'race_general_results':
-            fractions = ['fraction_1', 'fraction_2', 'fraction_3', 'fraction_4', 'fraction_5']
-            for fraction in fractions:
-                fraction_distance = row_data['distance_' + fraction]
-                fraction_time = row_data['time_' + fraction]
-                row_data[str(fraction_distance) + '_time'] = fraction_time
-                row_data[final_distance_field] = row_data['time_finish']
-                row_data.drop(labels='time_finish', inplace=True)
-        elif self.table == 'race_info':
-            # There is no final-time information in the race_table data.
-            pass
-        else:
-            raise NotImplementedError(f'Table type {self.table} not implemented in add_times()')
-
-        return row_data
+        keep = ~self.data.index.str.startswith('NoneNone') & self.data['distance'].isin(distances_to_process).values
+        return self.remap_times(columns)[keep]
 
 
 class RaceAggregator(RaceProcessor):
@@ -119,7 +110,8 @@ class RaceAggregator(RaceProcessor):
     # add_to_consolidated_data().
 
     def __init__(self, db_handler, db_consolidated_handler, db_consolidated_races_handler=None, include_horse=False,
-                 verbose=False):
+                 verbose=False,
+                 profile=False, progress_bar=False, telemetry_interval=5.0, profile_dir='logs'):
         self.db = db_handler
         self.consolidated_db = db_consolidated_handler
         self.consolidated_races_db = db_consolidated_races_handler
@@ -143,28 +135,55 @@ class RaceAggregator(RaceProcessor):
         # State variables to hold data being processed
 
 
-        # Set up dict to track the unresolvable issues that were found
-        self.unfixed_data = {}
+        # Unresolvable issues are streamed to an IssueLog set up by add_to_consolidated_data()
+        self.unfixed_data = None
+
+        # Per-stage timings for add_to_consolidated_data(), written to profile_dir. profile=True also dumps a cProfile
+        # of each run there.
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.profiler = None
+
+        # Throughput telemetry written every telemetry_interval seconds; progress_bar=True also shows a progress bar
+        self.progress_bar = progress_bar
+        self.telemetry_interval = telemetry_interval
+        self.telemetry = None
+
+        # Writes to the consolidated table are journaled for the length of each run
+        self.journal = None
+
+        # Discrepancies that need a person are queued for review for the length of each run
+        self.review_queue = None
+
+        # Set up the race conditions stores shared by the fixers. Nothing is loaded until a fixer needs the text.
+        self.source_conditions = RaceConditionsStore(self.db)
+        self.consolidated_conditions = RaceConditionsStore(self.consolidated_db, fields=RACE_CONDITIONS_FIELDS,
+                                                           follow_writes=True)
+
+        # Parsed facts from the conditions text, persisted in the consolidated database. Filled in by
+        # add_to_consolidated_data() before any fixers run.
+        self.parsed_conditions = ParsedConditionsTable(self.consolidated_db.db)
+        conditions = {
+            'source_conditions': self.source_conditions,
+            'consolidated_conditions': self.consolidated_conditions,
+            'parsed_conditions': self.parsed_conditions,
+        }
 
         # Set up data fixers
         # todo ADD THESE
 
         self.fixers = {
-            'distance': FixerDistance('distance', self.db, self.consolidated_db),
-            'purse': FixerPurse('purse', self.db, self.consolidated_db),
-            'race_type': FixerRaceType('race_type', self.db, self.consolidated_db),
+            'distance': FixerDistance('distance', self.db, self.consolidated_db, **conditions),
+            'purse': FixerPurse('purse', self.db, self.consolidated_db, **conditions),
+            'race_type': FixerRaceType('race_type', self.db, self.consolidated_db, **conditions),
         }
 
     def add_to_consolidated_data(self):
-        # Setup progress bar
         print(f'Consolidating data from table {self.table}')
-        bar = Bar(f'Processing {self.table} data', max=len(self.db.data),
-                  suffix='%(percent).3f%% - %(index)d/%(max)d - %(eta)s secs.')
 
         # Generate a list of the columns to check by pulling a row from the dataframe and extracting the
         # column names (this will be a pandas index since the resulting row is returned as a pandas series
-        # with the column names serving as the index). Then we strip off the non-race_id columns from that list
-        # and set up the issue-tracking dictionary.
+        # with the column names serving as the index). Then we strip off the non-race_id columns from that list.
 
         dummy_row = self.db.data.iloc[0]
         columns = dummy_row.index.tolist()
@@ -176,91 +195,81 @@ class RaceAggregator(RaceProcessor):
             else ['date', 'track', 'race_num']
         columns_to_check = [item for item in columns if item not in race_id_fields]
 
-        # Create dict keys for the conflict-tracking dictionary
-        for column in columns_to_check:
-            self.unfixed_data[column] = list()
-        self.unfixed_data['other'] = list()
         # Clean up unused variables
         try:
-            del column
             del columns_to_check
         except Exception as e:
             print(f'Issue deleting column variable: {e}')
 
 
-        distances_to_process = [440, 660, 880, 990, 1100, 1210, 1320,1430, 1540, 1650, 1760,
-                                1800, 1830, 1870, 1980, 2310, 2640, 3080, 3520]
+        # Parse all the race conditions text in scope in one pass, the first time a fixer needs it, so the fixers
+        # only do lookups
+        self.parsed_conditions.build_later(
+            lambda: self.source_conditions.texts() | self.consolidated_conditions.texts())
 
         columns = self.consolidated_db.data.columns
 
-
-        # Loop through each row of dataframe and process that race info
-        for i in range(len(self.db.data)):
-            # Advance progress bar
-            bar.next()
-
-            # Set state with current race information
-            self.set_current_info(i)
-
-            # Check if the race entry is blank; if so, skip it.
-            if self.race_entry_blank():
-                continue
-
-            # Pull the data for the row we're working on, which will be needed either to update/check
-            # values for the existing data or to add a new entry to the table..
-            row_data = self.db.get_row_data(i)
-            row_data = row_data.reindex(columns)
-
-            # Skip race if we're not processing that distance
-            if row_data['distance'] not in distances_to_process:
-                continue
-
-            # Check if race is in the consolidated db; if not, add the race to the db.
-            # The race is added in exception handling, which will be triggered if the race lookup
-            # in the consolidated dataframe fails.
-
-            if self.race_entry_exists(self.current_race_id):
-
-                # Check if all the non-race_id fields are blank; if so, add our data to the entry.
-                if self.consolidated_db.fields_blank(self.get_current_race_id(), columns, number='all'):
-                    self.consolidated_db.update_race_values(columns, row_data[columns].tolist(),
-                                                            self.get_current_race_id(as_sql=True))
-                else:   # Resolve partial data
-                        # Generate boolean masks for what data is missing in consolidated and new data
-                        # todo I think this slicing using columns is unneccessary now that we're reindexing using the
-                        # todo consolidated columns--probably can remove these next two lines without changing behavior
-                    self.new_row_data = row_data[columns]
-                    self.consolidated_row_data = self.consolidated_db.data.loc[self.get_current_race_id(include_horse=self.include_horse), columns]
-
-                    missing_row_data = [self.db.is_blank(item) for item in self.new_row_data]
-                    missing_consolidated_data = [self.db.is_blank(item) for item in self.consolidated_row_data]
-
-                    # Check to make sure the row sizes match, which we expect
-                    # todo TAKE THIS OUT FOR PRODUCTION
-                    assert len(missing_row_data) == len(missing_consolidated_data)
-
-                    # If there's an entry that already has data in it, compare each data entry, see where
-                    # discrepancies are, resolve them, and then update the consolidated db entry.
-                    self.resolve_data(zip(missing_row_data, missing_consolidated_data),
-                                      zip(self.new_row_data, self.consolidated_row_data),
-                                      columns)
-                # If some of the non-race_id fields are not blank, we have to resolve those against our new data
-
-            else:    # Add the race if there isn't already an entry in the consolidated db
-                self.consolidated_db.add_blank_entry(self.get_current_race_id(as_tuple=True, include_horse=self.include_horse),
-                                                     include_horse=self.include_horse)
-                self.consolidated_db.update_race_values(columns,
-                                                        row_data.tolist(),
-                                                        self.get_current_race_id(as_sql=True, include_horse=self.include_horse))
-
-        with open(f'logs/races_unfixed_data_{self.table} {datetime.datetime.now().strftime("%Y-%m-%d %H:%M")}.txt', 'w') as file:
-            for key in self.unfixed_data.keys():
-                file.write(f'\n**********\n{key} ({len(self.unfixed_data[key])}):\t')
-                for item in self.unfixed_data[key]:
-                    file.write(f'{item}, ')
-                file.write('\n')
-
-        bar.finish()
+        # Set up the log for any issues we can't resolve
+        with IssueLog('races_unfixed_data', self.table) as self.unfixed_data, self.tracked_run():
+            # Loop through each row of dataframe and process that race info
+            for i in range(len(self.db.data)):
+                self.telemetry.next_row()
+
+                # Set state with current race information
+                self.set_current_info(i)
+
+                # Check if the race entry is blank; if so, skip it.
+                if self.race_entry_blank():
+                    continue
+
+                # Pull the data for the row we're working on, which will be needed either to update/check
+                # values for the existing data or to add a new entry to the table..
+                row_data = self.db.get_row_data(i)
+                row_data = row_data.reindex(columns)
+
+                # Skip race if we're not processing that distance
+                if row_data['distance'] not in RACE_DISTANCES_TO_PROCESS:
+                    continue
+
+                # Check if race is in the consolidated db; if not, add the race to the db.
+                # The race is added in exception handling, which will be triggered if the race lookup
+                # in the consolidated dataframe fails.
+
+                if self.race_entry_exists(self.current_race_id):
+
+                    # Check if all the non-race_id fields are blank; if so, add our data to the entry.
+                    if self.consolidated_db.fields_blank(self.get_current_race_id(), columns, number='all'):
+                        self.consolidated_db.update_race_values(columns, row_data[columns].tolist(),
+                                                                self.get_current_race_id(as_sql=True))
+                    else:   # Resolve partial data
+                            # Generate boolean masks for what data is missing in consolidated and new data
+                            # todo I think this slicing using columns is unneccessary now that we're reindexing using the
+                            # todo consolidated columns--probably can remove these next two lines without changing behavior
+                        self.new_row_data = row_data[columns]
+                        self.consolidated_row_data = self.consolidated_db.data.loc[self.get_current_race_id(include_horse=self.include_horse), columns]
+
+                        missing_row_data = [self.db.is_blank(item) for item in self.new_row_data]
+                        missing_consolidated_data = [self.db.is_blank(item) for item in self.consolidated_row_data]
+
+                        # Check to make sure the row sizes match, which we expect
+                        # todo TAKE THIS OUT FOR PRODUCTION
+                        assert len(missing_row_data) == len(missing_consolidated_data)
+
+                        # If there's an entry that already has data in it, compare each data entry, see where
+                        # discrepancies are, resolve them, and then update the consolidated db entry.
+                        self.resolve_data(zip(missing_row_data, missing_consolidated_data),
+                                          zip(self.new_row_data, self.consolidated_row_data),
+                                          columns)
+                    # If some of the non-race_id fields are not blank, we have to resolve those against our new data
+
+                else:    # Add the race if there isn't already an entry in the consolidated db
+                    self.consolidated_db.add_blank_entry(self.get_current_race_id(as_tuple=True, include_horse=self.include_horse),
+                                                         include_horse=self.include_horse)
+                    self.consolidated_db.update_race_values(columns,
+                                                            row_data.tolist(),
+                                                            self.get_current_race_id(as_sql=True, include_horse=self.include_horse))
+
+        print(self.unfixed_data.summary())
 
     def race_entry_exists(self, race_id):
         """Checks whether the consolidated dataframe has an entry for a given race"""
@@ -283,22 +292,21 @@ class RaceAggregator(RaceProcessor):
                          'race_conditions_text_4', 'race_conditions_text_5', 'race_conditions_text_6',]
         if column in keys_to_ignore: return
 
-        def print_mismatch(pause=False):
+        def print_mismatch():
             print(f'\nData mismatch {self.current_race_id}: {column}. New data: {new_data}. Consolidated data: {existing_data}')
-            if pause: input("Press enter to continue")
 
         def update_to_new_data():
             self.consolidated_db.update_race_values([column], [new_data], self.get_current_race_id(as_sql=True))
 
         def add_to_unfixed_data():
-            self.unfixed_data[column].append(self.current_race_id)
+            self.unfixed_data.record(self.current_race_id, column, new_data, existing_data)
 
         def distances():
             # If we find a discrepancy in the distances, delete the race and note the race_id in the tracking
             # dictionary. There probably isn't a simple way to resolve these discrepancies without manually going
             # through and working out what is driving the issue. Further research may reveal patterns in the
             # discrepancies that we can code a solution to.
-            self.unfixed_data['distance'].append(self.current_race_id)
+            self.unfixed_data.record(self.current_race_id, 'distance', new_data, existing_data)
             # self.consolidated_db.delete_entry(self.get_current_race_id(as_tuple=True))
 
         def fix_surface():
@@ -316,8 +324,9 @@ class RaceAggregator(RaceProcessor):
                 # todo Something
                 pass
             else:
-                print_mismatch(pause=True)
+                print_mismatch()
                 add_to_unfixed_data()
+                self.review_queue.submit(column, new_data, existing_data, 'unexpected_surface_change', 'fix_surface')
             # todo: [T/t]
 
         # Run the appropriate discrepancy resolver depending on the column involved.
@@ -378,7 +387,7 @@ class RaceAggregator(RaceProcessor):
 
         else:
             print('Other type of discrepancy')
-            self.unfixed_data['other'].append(self.current_race_id)
+            self.unfixed_data.record(self.current_race_id, column, new_data, existing_data)
             print(f'Data mismatch: {column}. New data: {new_data}. Consolidated data: {existing_data}')
             print('')
 
@@ -395,6 +404,263 @@ class RaceAggregator(RaceProcessor):
 
 
 
+class MergedRace:
+    # The MergedRace class stands in for the consolidated races handler while RaceMerger folds the sources for one
+    # race together. The fixers and resolve_data() read and write the race being built through the usual handler
+    # methods, but the values only live in memory until RaceMerger writes the finished race.
+
+    def __init__(self, consolidated_handler):
+        self.handler = consolidated_handler
+        self.db = consolidated_handler.db
+        self.table = consolidated_handler.table
+        self.constants = consolidated_handler.constants
+        self.table_index = consolidated_handler.table_index
+        self.other = consolidated_handler.other
+        self.journal = None
+
+        self.values = dict()
+
+    @property
+    def data(self):
+        return self.handler.data
+
+    def start(self, values):
+        self.values = dict(values)
+
+    def get_value(self, field, race_id_sql):
+        return self.values.get(field)
+
+    def get_values(self, fields, race_id_sql):
+        return [self.values.get(field) for field in fields]
+
+    def fields_blank(self, race_id, fields, number='all'):
+        missing_items = [self.is_blank(self.values.get(field)) for field in fields]
+        return all(missing_items) if number == 'all' else any(missing_items)
+
+    def update_race_values(self, fields, values, race_id_sql):
+        if self.journal is not None:
+            key = self.journal.current_key(self.handler.plan.unique)
+            self.journal.record_update(key, list(fields), [self.values.get(field) for field in fields], list(values))
+        self.values.update(zip(fields, values))
+
+    def add_blank_entry(self, *race_id, include_horse=False):
+        pass
+
+    def is_blank(self, item):
+        return self.handler.is_blank(item)
+
+    def get_table_structure(self):
+        return self.handler.get_table_structure()
+
+    @property
+    def duplicates_suppressed(self):
+        return self.handler.duplicates_suppressed
+
+
+class MergedConditions:
+    # Race conditions text of the race being merged, for the fixers' consolidated_conditions. Has the same get()
+    # and texts() interface as RaceConditionsStore.
+
+    def __init__(self, merged_race):
+        self.merged_race = merged_race
+
+    def get(self, race_key):
+        texts = [self.merged_race.values.get(field) for field in RACE_CONDITIONS_FIELDS]
+        return ''.join(text for text in texts if isinstance(text, str))
+
+    def texts(self):
+        return set()
+
+
+class RaceMerger(RaceAggregator):
+    # The RaceMerger class consolidates all the race sources in a single pass. Each source is loaded once and laid
+    # out like the consolidated table, the sources are aligned on race_id, and every race is built in memory by
+    # folding its sources together in SOURCE_PRECEDENCE['default'] order, with the existing fixers settling any
+    # conflicts. Columns with their own precedence list just take the first source that has a value. Each race is
+    # then written to the consolidated table once: new races are inserted in batches and existing ones get a
+    # single UPDATE with only the values that changed.
+
+    def __init__(self, db_handlers, db_consolidated_handler, precedence=None, include_horse=False, verbose=False,
+                 profile=False, progress_bar=False, telemetry_interval=5.0, write_batch_size=1000,
+                 profile_dir='logs'):
+        """ db_handlers maps each source table to its AggRacesDataHandler. db_consolidated_handler is the handler
+            for the consolidated races table.
+        """
+        self.precedence = dict(SOURCE_PRECEDENCE, **(precedence or dict()))
+        self.sources = {table: db_handlers[table] for table in self.precedence['default'] if table in db_handlers}
+        self.consolidated = db_consolidated_handler
+        self.consolidated_db = MergedRace(db_consolidated_handler)
+        self.consolidated_races_db = None
+        self.db = next(iter(self.sources.values()))     # The source currently being folded in
+
+        self.table = 'merged'
+        self.include_horse = include_horse
+        self.verbose = verbose
+
+        self.unfixed_data = None
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self.progress_bar = progress_bar
+        self.telemetry_interval = telemetry_interval
+        self.telemetry = None
+        self.journal = None
+        self.review_queue = None
+
+        # Consolidated rows waiting to be inserted, and counts of what was written
+        self.write_batch_size = write_batch_size
+        self.pending_inserts = list()
+        self.race_ids = list()
+        self.write_counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+        # Parsed conditions are shared by every source; the consolidated side of each comparison is the race being
+        # merged, so its conditions come from the merged values
+        self.parsed_conditions = ParsedConditionsTable(self.consolidated.db)
+        self.consolidated_conditions = MergedConditions(self.consolidated_db)
+        self.source_conditions_stores = {table: RaceConditionsStore(handler)
+                                         for table, handler in self.sources.items()}
+
+        # One set of fixers per source, since the fixers read the source's table structure and conditions
+        self.source_fixers = dict()
+        for table, handler in self.sources.items():
+            conditions = {
+                'source_conditions': self.source_conditions_stores[table],
+                'consolidated_conditions': self.consolidated_conditions,
+                'parsed_conditions': self.parsed_conditions,
+            }
+            self.source_fixers[table] = {
+                'distance': FixerDistance('distance', handler, self.consolidated_db, **conditions),
+                'purse': FixerPurse('purse', handler, self.consolidated_db, **conditions),
+                'race_type': FixerRaceType('race_type', handler, self.consolidated_db, **conditions),
+            }
+        self.fixers = self.source_fixers[self.db.table]
+
+    def rows_to_process(self):
+        return len(self.race_ids)
+
+    def fixer_items(self):
+        return [(f'{table}/{column}', fixer) for table, fixers in self.source_fixers.items()
+                for column, fixer in fixers.items()]
+
+    def telemetry_gauges(self):
+        return super().telemetry_gauges() + [
+            ('merge_write_buffer_depth', 'Merged races waiting to be inserted', lambda: len(self.pending_inserts))]
+
+    def start_journal(self):
+        super().start_journal()
+        self.journal.instrument(self, 'apply_precedence', 'precedence')
+
+    def add_to_consolidated_data(self):
+        print(f'Merging race data from {", ".join(self.sources)}')
+        consolidated_conditions = RaceConditionsStore(self.consolidated, fields=RACE_CONDITIONS_FIELDS)
+        self.parsed_conditions.build_later(
+            lambda: set().union(consolidated_conditions.texts(),
+                                *[store.texts() for store in self.source_conditions_stores.values()]))
+
+        # Lay every source out like the consolidated table and line them up on race_id
+        columns = self.consolidated.data.columns.tolist()
+        # horse_pps repeats the race on every starter's row. Collapse those to one row per race, taking each
+        # column from the first row that has it, which is what the per-row passes end up with.
+        projected = {table: handler.projected_data(columns, RACE_DISTANCES_TO_PROCESS)
+                     for table, handler in self.sources.items()}
+        projected = {table: data.groupby(level=0, sort=False).first() if data.index.has_duplicates else data
+                     for table, data in projected.items()}
+        self.race_ids = sorted(set().union(*[data.index for data in projected.values()]))
+
+        race_id_fields = ['date', 'track', 'race_num']
+        resolve_columns = [column for column in columns
+                           if column not in race_id_fields and column not in self.precedence]
+        precedence_columns = [column for column in columns if column in self.precedence and column != 'default']
+        existing_ids = set(self.consolidated.data.index)
+
+        with IssueLog('races_unfixed_data', self.table) as self.unfixed_data, self.tracked_run():
+            for race_id in self.race_ids:
+                self.telemetry.next_row()
+                rows = {table: data.loc[race_id] for table, data in projected.items() if race_id in data.index}
+                first_row = next(iter(rows.values()))
+                self.current_date, self.current_track, self.current_race_num = \
+                    first_row['date'], first_row['track'], first_row['race_num']
+                self.current_race_id = race_id
+
+                existing = self.consolidated.data.loc[race_id, columns] if race_id in existing_ids else None
+                self.consolidated_db.start(existing.to_dict() if existing is not None
+                                           else {column: None for column in columns})
+
+                with self.profiler.stage('merge_sources'):
+                    for table, row_data in rows.items():
+                        self.fold_source(table, row_data, resolve_columns)
+                    for column in precedence_columns:
+                        self.apply_precedence(column, rows)
+
+                with self.profiler.stage('db_write/merged_race'):
+                    self.write_race(race_id, existing, first_row, columns)
+
+            with self.profiler.stage('db_write/merged_race'):
+                self.flush_inserts(columns)
+
+        print(self.unfixed_data.summary())
+        print(f'Merged {len(self.race_ids)} races: {self.write_counts["inserted"]} inserted, '
+              f'{self.write_counts["updated"]} updated, {self.write_counts["unchanged"]} unchanged')
+
+    def fold_source(self, table, row_data, columns):
+        """Folds one source's row into the race being merged, sending conflicts to that source's fixers."""
+        self.db = self.sources[table]
+        self.fixers = self.source_fixers[table]
+
+        merged = self.consolidated_db
+        if merged.fields_blank(self.current_race_id, columns, number='all'):
+            merged.update_race_values(columns, row_data[columns].tolist(), None)
+            return
+
+        self.new_row_data = row_data[columns]
+        self.consolidated_row_data = pd.Series(merged.get_values(columns, None), index=columns)
+        missing_row_data = [self.db.is_blank(item) for item in self.new_row_data]
+        missing_consolidated_data = [self.db.is_blank(item) for item in self.consolidated_row_data]
+        self.resolve_data(zip(missing_row_data, missing_consolidated_data),
+                          zip(self.new_row_data, self.consolidated_row_data),
+                          columns)
+
+    def apply_precedence(self, column, rows):
+        """Sets column to the value from the first source in its precedence list that has one."""
+        for table in self.precedence[column]:
+            if table in rows and not self.consolidated_db.is_blank(rows[table][column]):
+                self.db = self.sources[table]
+                self.consolidated_db.update_race_values([column], [rows[table][column]], None)
+                return
+        # None of the listed sources has a value; fall back to whatever the other sources had
+        for table, row_data in rows.items():
+            if not self.consolidated_db.is_blank(row_data[column]):
+                self.db = self.sources[table]
+                self.consolidated_db.update_race_values([column], [row_data[column]], None)
+                return
+
+    def write_race(self, race_id, existing, first_row, columns):
+        values = self.consolidated_db.values
+        for field in ['date', 'track', 'race_num']:
+            values[field] = first_row[field]
+
+        if existing is None:
+            self.pending_inserts.append([values[column] for column in columns])
+            if len(self.pending_inserts) >= self.write_batch_size:
+                self.flush_inserts(columns)
+            return
+
+        changed = [column for column in columns
+                   if not (self.consolidated.is_blank(values[column]) or values[column] == existing[column])]
+        if changed:
+            self.consolidated.update_race_values(changed, [values[column] for column in changed],
+                                                 self.get_current_race_id(as_sql=True))
+            self.write_counts['updated'] += 1
+        else:
+            self.write_counts['unchanged'] += 1
+
+    def flush_inserts(self, columns):
+        if self.pending_inserts:
+            self.consolidated.insert_rows(self.pending_inserts, columns)
+            self.write_counts['inserted'] += len(self.pending_inserts)
+            self.pending_inserts = list()
+
+
 class Trash:
     def __init__(self):
         self.errata_table = 'aggregation_notes'
@@ -1,5 +1,7 @@
+import db_handler as dbh
 from race_table import AggRacesDataHandler
 from race_table import RaceAggregator
+from race_table import RaceMerger
 
 # Constants
 from datapack import DataPack
@@ -16,43 +18,54 @@ data_pack = DataPack(CONSOLIDATED_TABLE_STRUCTURE=CONSOLIDATED_TABLE_STRUCTURE,
 # todo DELETE FOR PRODUCTION
 data_limit = 'LIMIT 5000'
 source_database = 'horses_test'
+consolidated_database = 'horses_consolidated_races'
 
-# Spin up the data handlers for the race aggregation tables
-consolidated_races_data_handler = AggRacesDataHandler('horses_consolidated_races', 'horses_consolidated_races',
-                                                      data_pack, include_horse=False, other='',
-                                                      initialize_db=True, initialize_table=True, verbose_db=False)
-
-# Spin up data handler and aggregator for the races_info table. Fire it up.
-race_info_data_handler = AggRacesDataHandler(source_database, 'race_info',
-                                             data_pack, include_horse=False, other=data_limit)
-race_info_adder = RaceAggregator(race_info_data_handler, consolidated_races_data_handler, include_horse=False)
-# race_info_adder.add_to_consolidated_data()
-
-# Reset consolidated data handler to reflect the just-added data
-consolidated_races_data_handler.set_up_data()
-
-# Spin up data handler and aggregator for the past performances table. Fire it up.
-horse_pps_data_handler = AggRacesDataHandler(source_database, 'horse_pps',
-                                             data_pack, include_horse=False, other=data_limit)
-horse_pps_adder = RaceAggregator(horse_pps_data_handler, consolidated_races_data_handler, include_horse=False)
-horse_pps_adder.add_to_consolidated_data()
-
-# Reset consolidated data handler to reflect the just-added data
-consolidated_races_data_handler.set_up_data()
-
-# Spin up data handler and aggregator for the race_results table. Fire it up.
-race_results_data_handler = AggRacesDataHandler(source_database, 'race_general_results',
-                                                data_pack, include_horse=False, other=data_limit)
-race_results_adder = RaceAggregator(race_results_data_handler, consolidated_races_data_handler, include_horse=False)
-race_results_adder.add_to_consolidated_data()
+# Set to True to dump a cProfile of each aggregation run to profile_dir alongside the stage timings
+profile = False
+profile_dir = 'logs'
 
+# Telemetry goes to logs/telemetry_<table>.prom either way; set to True to also show a progress bar when run by hand
+progress_bar = False
 
+# Source tables in the order they're consolidated. Later sources are checked against what the earlier ones added.
+# race_info is left out, as it always has been. Pass it to consolidate_races() or merge_races() to fold it in.
+RACE_SOURCE_TABLES = ['horse_pps', 'race_general_results']
 
 
+def consolidate_races(table, source_database=source_database, data_limit=data_limit, profile=profile,
+                      progress_bar=progress_bar, profile_dir=profile_dir):
+    """Adds one source table's races to the consolidated races table."""
+    # Spin up the data handler for the race aggregation table. It's loaded fresh so it reflects earlier sources.
+    consolidated_races_data_handler = AggRacesDataHandler(consolidated_database, 'horses_consolidated_races',
+                                                          data_pack, include_horse=False, other='',
+                                                          initialize_db=True, initialize_table=True, verbose_db=False)
 
+    # Spin up data handler and aggregator for the source table. Fire it up.
+    source_data_handler = AggRacesDataHandler(source_database, table, data_pack, include_horse=False, other=data_limit)
+    adder = RaceAggregator(source_data_handler, consolidated_races_data_handler, include_horse=False, profile=profile,
+                           progress_bar=progress_bar, profile_dir=profile_dir)
+    adder.add_to_consolidated_data()
 
 
+def merge_races(tables=RACE_SOURCE_TABLES, source_database=source_database, data_limit=data_limit, profile=profile,
+                progress_bar=progress_bar, profile_dir=profile_dir):
+    """Consolidates the races from all of tables in a single pass, writing each race once."""
+    consolidated_races_data_handler = AggRacesDataHandler(consolidated_database, 'horses_consolidated_races',
+                                                          data_pack, include_horse=False, other='',
+                                                          initialize_db=True, initialize_table=True, verbose_db=False)
+    source_data_handlers = {table: AggRacesDataHandler(source_database, table, data_pack, include_horse=False,
+                                                       other=data_limit)
+                            for table in tables}
+    merger = RaceMerger(source_data_handlers, consolidated_races_data_handler, include_horse=False, profile=profile,
+                        progress_bar=progress_bar, profile_dir=profile_dir)
+    merger.add_to_consolidated_data()
 
 
+def main():
+    dbh.configure_logging()
+    for table in RACE_SOURCE_TABLES:
+        consolidate_races(table)
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+# Deferred review queue for discrepancies that need a person to settle.
+#
+# The fixers and processors don't stop and wait for an answer when they find something they can't settle on their
+# own. They submit it to a ReviewQueue and carry on. Each item records the consolidated row (by its UNIQUE key), the
+# column, the new and existing values, why it needs review, the values the resolver recommends writing (if any) next
+# to the values they'd replace, and what a reviewer needs to see to decide, such as the race conditions text. Each
+# run writes its own directory under logs/review/, one file per consolidated table and source.
+#
+# Decisions are made afterwards, one at a time or in bulk, and appended to logs/review/decisions.jsonl. apply writes
+# the accepted values to the consolidated database in batched UPDATEs, leaves alone any row whose values have
+# changed since the item was queued, and records the writes in the change journal under the resolver 'review'. Run
+# from the repository root:
+#     python review_queue.py list
+#     python review_queue.py show --column surface
+#     python review_queue.py review --column distance          # accept, reject or enter values item by item
+#     python review_queue.py decide accept --resolver FixerRaceType --reason recommended_update
+#     python review_queue.py apply
+
+import argparse
+import datetime
+import glob
+import json
+import math
+import os
+import uuid
+from collections import Counter, defaultdict
+
+import journal
+from journal import ChangeJournal
+from issue_log import to_json_value
+
+
+REVIEW_DIR = os.path.join('logs', 'review')
+DECISIONS_FILE = 'decisions.jsonl'
+RESOLVER = 'review'
+
+# The consolidated tables' UNIQUE keys, in order. Races have no horse_name.
+KEY_COLUMNS = ['track', 'date', 'race_num', 'horse_name']
+
+
+class ReviewQueue:
+    # The ReviewQueue class appends the discrepancies from one source table that need a person to this run's review
+    # queue for a consolidated table. key_function() returns the fields of the consolidated row the discrepancy is in,
+    # as for a ChangeJournal, and race_id_function() the race_id it's reported under. Items are buffered and flushed
+    # every buffer_size items; only the per-column counts are kept in memory.
+
+    def __init__(self, table, source_table, key_function, race_id_function=None, source_function=None,
+                 review_dir=REVIEW_DIR, buffer_size=100):
+        self.table = table
+        self.source_table = source_table
+        self.key_function = key_function
+        self.race_id_function = race_id_function or (lambda: None)
+        self.source_function = source_function or (lambda: source_table)
+        self.buffer_size = buffer_size
+
+        directory = os.path.join(review_dir, journal.run_id())
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{table}.{source_table}.jsonl')
+        self.file = open(self.path, 'a')
+
+        self.buffer = list()
+        self.counts = Counter()
+
+    def current_key(self):
+        fields = self.key_function()
+        return {column: str(fields[column])[:10] if column == 'date' else fields.get(column)
+                for column in KEY_COLUMNS if column != 'horse_name' or fields.get(column) is not None}
+
+    def submit(self, column, new_value, existing_value, reason, resolver, proposed=None, current=None, context=None):
+        """ Queues a discrepancy in column of the current row for review. proposed ({field: value}) is what the
+            resolver recommends writing, if anything, and current the values those fields have now (column's is
+            existing_value). context holds anything else the reviewer should see.
+        """
+        self.buffer.append(json.dumps({
+            'id': uuid.uuid4().hex,
+            'run': journal.run_id(),
+            'table': self.table,
+            'source': self.source_function(),
+            'race_id': self.race_id_function(),
+            'key': self.current_key(),
+            'column': column,
+            'new_value': new_value,
+            'existing_value': existing_value,
+            'reason': reason,
+            'resolver': resolver,
+            'proposed': proposed or dict(),
+            'current': dict({column: existing_value}, **(current or dict())),
+            'context': context or dict(),
+            'queued': datetime.datetime.now().isoformat(timespec='seconds'),
+        }, default=to_json_value))
+        self.counts[column] += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.file.flush()
+            self.buffer = list()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def summary(self):
+        lines = [f'Queued for review from {self.source_table} ({sum(self.counts.values())}), written to {self.path}:']
+        lines += [f'\t{column}: {count}' for column, count in self.counts.most_common()]
+        return '\n'.join(lines)
+
+
+def read_items(review_dir=REVIEW_DIR):
+    """Every item queued in review_dir, run by run."""
+    for path in sorted(glob.glob(os.path.join(review_dir, '*', '*.jsonl'))):
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def read_decisions(review_dir=REVIEW_DIR):
+    """ ({item id: latest decision}, {item id: application record}) from the decisions file. An item decided again
+        after it was applied counts as decided but not applied.
+    """
+    decisions, applied = dict(), dict()
+    path = os.path.join(review_dir, DECISIONS_FILE)
+    if os.path.exists(path):
+        with open(path) as file:
+            for line in file:
+                if not line.strip(): continue
+                record = json.loads(line)
+                if record['op'] == 'decide':
+                    decisions[record['id']] = record
+                    applied.pop(record['id'], None)
+                else:
+                    applied[record['id']] = record
+    return decisions, applied
+
+
+def append_decisions(records, review_dir=REVIEW_DIR):
+    os.makedirs(review_dir, exist_ok=True)
+    with open(os.path.join(review_dir, DECISIONS_FILE), 'a') as file:
+        for record in records:
+            file.write(json.dumps(record, default=to_json_value) + '\n')
+
+
+def decision(item, choice, values=None, note=None):
+    """ The decisions file record for choice ('accept', 'reject' or 'set') on item. accept writes the values the
+        resolver proposed; set writes values ({field: value}) the reviewer entered instead.
+    """
+    if choice == 'accept':
+        values = item['proposed']
+    elif choice == 'reject':
+        values = dict()
+    return {'op': 'decide', 'id': item['id'], 'decision': choice, 'values': values, 'note': note,
+            'decided': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def selected(items, table=None, column=None, reason=None, resolver=None):
+    return [item for item in items
+            if all(wanted is None or item[field] == wanted
+                   for field, wanted in [('table', table), ('column', column), ('reason', reason),
+                                         ('resolver', resolver)])]
+
+
+def pending_items(review_dir=REVIEW_DIR, **filters):
+    """The items with no decision yet, optionally only those whose table, column, reason or resolver match."""
+    decisions, _ = read_decisions(review_dir)
+    return selected([item for item in read_items(review_dir) if item['id'] not in decisions], **filters)
+
+
+def describe(item):
+    """The lines a reviewer sees for item."""
+    lines = [f'{item["race_id"]} ({item["table"]} from {item["source"]}): {item["column"]}',
+             f'    Reason: {item["reason"]} ({item["resolver"]})',
+             f'    New data: {item["new_value"]}    Existing data: {item["existing_value"]}']
+    if item['proposed']:
+        lines.append('    Proposed: ' + ', '.join(f'{field} {item["current"].get(field)} -> {value}'
+                                                 for field, value in item['proposed'].items()))
+    else:
+        lines.append('    No change proposed')
+    for name, value in item['context'].items():
+        if value is not None:
+            lines.append(f'    {name}: {value}')
+    return lines
+
+
+def blank(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def same_value(a, b):
+    """Whether a value read back from the database is the one that was queued, allowing for type differences."""
+    if blank(a) or blank(b):
+        return blank(a) and blank(b)
+    try:
+        return float(a) == float(b)
+    except (TypeError, ValueError):
+        return str(a).strip() == str(b).strip()
+
+
+def normalized_key(key):
+    """A key as it's matched against rows read back from the database."""
+    def normalized(column, value):
+        if value is None:
+            return None
+        if column == 'date':
+            return str(value)[:10]
+        if column == 'race_num':
+            return str(int(float(value)))
+        return str(value).strip().upper()
+    return tuple(normalized(column, value) for column, value in key.items())
+
+
+def key_condition(db, key):
+    return '(' + db.concatenate_field_value_pairs(list(key), list(key.values()), separator=' AND ') + ')'
+
+
+def apply_table(db, table, items, decisions, batch_size, change_journal, dry_run=False):
+    """ Writes the decided values for items (all in table) and journals them. Returns {item id: status}: applied,
+        stale (the row's values changed since the item was queued) or missing (the row is gone).
+    """
+    statuses = dict()
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        key_columns = list(batch[0]['key'])
+        fields = sorted({field for item in batch for field in decisions[item['id']]['values']})
+        where = ' OR '.join(key_condition(db, item['key']) for item in batch)
+        rows = dict()
+        for row in db.query_db(db.generate_query(table, key_columns + fields, where=where)):
+            rows[normalized_key(dict(zip(key_columns, row)))] = dict(zip(fields, row[len(key_columns):]))
+
+        updates = defaultdict(list)     # Format: (fields, values): items that write those values
+        for item in batch:
+            values = decisions[item['id']]['values']
+            row = rows.get(normalized_key(item['key']))
+            if row is None:
+                statuses[item['id']] = 'missing'
+            elif not all(same_value(row[field], item['current'][field])
+                         for field in values if field in item['current']):
+                statuses[item['id']] = 'stale'
+            else:
+                statuses[item['id']] = 'applied'
+                updates[(tuple(values), tuple(values.values()))].append((item, row))
+
+        for (fields_to_set, values), targets in updates.items():
+            if dry_run: continue
+            where = ' OR '.join(key_condition(db, item['key']) for item, row in targets)
+            db.update_db(db.generate_update_query(table, list(fields_to_set), list(values), where=where))
+            for item, row in targets:
+                change_journal.record_update(list(item['key'].values()), list(fields_to_set),
+                                             [row[field] for field in fields_to_set], list(values))
+    return statuses
+
+
+def apply_decisions(database, review_dir=REVIEW_DIR, batch_size=500, dry_run=False, journal_dir=journal.JOURNAL_DIR,
+          query_db=None):
+    """ Writes every accepted or set decision that hasn't been applied yet to the consolidated tables in database and
+        records the outcome of each in the decisions file. Returns a Counter of the outcomes.
+    """
+    import db_handler as dbh
+
+    decisions, applied = read_decisions(review_dir)
+    to_apply = defaultdict(list)
+    for item in read_items(review_dir):
+        record = decisions.get(item['id'])
+        if record is not None and record['values'] and item['id'] not in applied:
+            to_apply[item['table']].append(item)
+
+    db = query_db or dbh.QueryDB(database)
+    db.connect()
+    statuses = dict()
+    try:
+        for table, items in to_apply.items():
+            with ChangeJournal(table, RESOLVER, lambda: dict(), journal_dir=journal_dir) as change_journal:
+                change_journal.resolvers.append(RESOLVER)
+                statuses.update(apply_table(db, table, items, decisions, batch_size, change_journal, dry_run))
+    finally:
+        if query_db is None: db.close()
+
+    if not dry_run:
+        applied_at = datetime.datetime.now().isoformat(timespec='seconds')
+        append_decisions([{'op': 'apply', 'id': item_id, 'status': status, 'applied': applied_at}
+                          for item_id, status in statuses.items()], review_dir)
+    return Counter(statuses.values())
+
+
+def review(items, review_dir=REVIEW_DIR):
+    """Walks through items one at a time, asking for a decision on each and recording it as it's made."""
+    for position, item in enumerate(items, 1):
+        print(f'\n[{position}/{len(items)}] ' + '\n'.join(describe(item)))
+        options = '(a)ccept/(r)eject/(e)nter values/(s)kip/(q)uit: ' if item['proposed'] else \
+            '(r)eject/(e)nter values/(s)kip/(q)uit: '
+        response = input(options).lower()
+        if response == 'q':
+            return
+        elif response == 'a' and item['proposed']:
+            append_decisions([decision(item, 'accept')], review_dir)
+        elif response == 'r':
+            append_decisions([decision(item, 'reject', note=input('Note (optional): ') or None)], review_dir)
+        elif response == 'e':
+            values = dict()
+            for field in dict.fromkeys([item['column'], *item['proposed']]):
+                value = input(f'{field} [{item["proposed"].get(field, "leave as is")}]: ').strip()
+                if value:
+                    values[field] = value
+                elif field in item['proposed']:
+                    values[field] = item['proposed'][field]
+            if values:
+                append_decisions([decision(item, 'set', values)], review_dir)
+
+
+def main():
+    import horse_performances_master
+    parser = argparse.ArgumentParser(description='Work through the discrepancies queued for review')
+    parser.add_argument('--review-dir', default=REVIEW_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_filters(command_parser):
+        for option in ['--table', '--column', '--reason', '--resolver']:
+            command_parser.add_argument(option)
+
+    commands.add_parser('list', help='count the pending, decided and applied items')
+    show_parser = commands.add_parser('show', help='print the pending items')
+    add_filters(show_parser)
+    show_parser.add_argument('--limit', type=int, default=20)
+    review_parser = commands.add_parser('review', help='decide the pending items one at a time')
+    add_filters(review_parser)
+    decide_parser = commands.add_parser('decide', help='accept or reject every matching pending item')
+    decide_parser.add_argument('decision', choices=['accept', 'reject'])
+    add_filters(decide_parser)
+    decide_parser.add_argument('--note')
+    apply_parser = commands.add_parser('apply', help='write the accepted values to the consolidated tables')
+    apply_parser.add_argument('--database', default=horse_performances_master.consolidated_database)
+    apply_parser.add_argument('--batch-size', type=int, default=500)
+    apply_parser.add_argument('--dry-run', action='store_true', help="check for stale rows but don't write")
+    args = parser.parse_args()
+    filters = {name: getattr(args, name, None) for name in ['table', 'column', 'reason', 'resolver']}
+
+    if args.command == 'list':
+        decisions, applied = read_decisions(args.review_dir)
+        counts = Counter()
+        for item in read_items(args.review_dir):
+            if item['id'] in applied:
+                state = applied[item['id']]['status']
+            elif item['id'] in decisions:
+                state = 'decided: ' + decisions[item['id']]['decision']
+            else:
+                state = 'pending'
+            counts[(item['table'], item['column'], item['reason'], state)] += 1
+        for (table, column, reason, state), count in sorted(counts.items()):
+            print(f'    {table:<36}{column:<28}{reason:<28}{state:<12}{count:>8}')
+    elif args.command == 'show':
+        items = pending_items(args.review_dir, **filters)
+        for item in items[:args.limit]:
+            print('\n'.join(describe(item)))
+        print(f'{len(items)} pending items' + (f' ({args.limit} shown)' if len(items) > args.limit else ''))
+    elif args.command == 'review':
+        review(pending_items(args.review_dir, **filters), args.review_dir)
+    elif args.command == 'decide':
+        items = pending_items(args.review_dir, **filters)
+        if args.decision == 'accept':
+            items = [item for item in items if item['proposed']]
+        append_decisions([decision(item, args.decision, note=args.note) for item in items], args.review_dir)
+        print(f'{len(items)} items {args.decision}ed' +
+              (' (items with no proposed change need values entered with review)' if args.decision == 'accept' else ''))
+    elif args.command == 'apply':
+        counts = apply_decisions(args.database, args.review_dir, args.batch_size, args.dry_run)
+        print((', '.join(f'{count} {status}' for status, count in counts.items()) or 'Nothing to apply') +
+              (' (dry run, nothing written)' if args.dry_run else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# Compiles the constants in a DataPack into a SourcePlan for every table in its TABLE_TO_INDEX_MAPPINGS: the columns
+# to SELECT and what to call them, the table structure the fixers read, the consolidated table's dtypes and DDL, and
+# for each distance the renames and drops that line the call columns up with the distances they were taken at.
+# The data handlers used to rebuild all of this with dict comprehensions over the constants on every call.
+#
+# compile_schema() validates the constants and compiles the plans once per run. The compiled plans are also kept in
+# logs/schema_plans/, keyed by a hash of the constants and of this module's source, so a run with unchanged constants
+# and an unchanged compiler just loads them.
+
+import hashlib
+import json
+import os
+import pickle
+from types import MappingProxyType
+
+import db_handler as dbh
+
+
+SCHEMA_CACHE_DIR = os.path.join('logs', 'schema_plans')
+
+# Constants that are compiled into the plans; a DataPack doesn't have to carry the distance mappings
+PLANNED_CONSTANTS = ['CONSOLIDATED_TABLE_STRUCTURE', 'ADDITIONAL_FIELDS', 'TABLE_TO_INDEX_MAPPINGS', 'UNIQUE',
+                     'POSITION_DISTANCE_MAPPINGS', 'LEAD_OR_BEATEN_DISTANCE_MAPPINGS']
+
+
+class SchemaError(ValueError):
+    pass
+
+
+class SourcePlan:
+    # Everything the data handlers need from the constants for one table. The plans are shared by every handler for
+    # the table, so nothing in them can be changed: sequences are tuples and mappings are read-only.
+
+    def __init__(self, table, table_index, select, columns, table_structure, dtypes, unique, ddl,
+                 additional_columns, distance_renames, distance_drops):
+        self.table = table
+        self.table_index = table_index
+        self.select = tuple(select)                         # Source columns to query, in order
+        self.columns = tuple(columns)                       # ... and the consolidated names they're loaded as
+        self.table_structure = MappingProxyType(dict(table_structure))     # Format: consolidated col: source col
+        self.dtypes = MappingProxyType(dict(dtypes))        # Format: consolidated col: SQL datatype
+        self.unique = tuple(unique)
+        self.ddl = ddl                                      # CREATE TABLE for the consolidated table
+        self.additional_columns = tuple(additional_columns)
+        # Format: distance: {call column: distance column} and distance: (call columns with no distance column)
+        self.distance_renames = MappingProxyType({distance: MappingProxyType(dict(renames))
+                                                  for distance, renames in distance_renames.items()})
+        self.distance_drops = MappingProxyType({distance: tuple(drops) for distance, drops in distance_drops.items()})
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            raise AttributeError(f'SourcePlan for {self.table} is read-only')
+        super().__setattr__(name, value)
+
+    def __reduce__(self):
+        return SourcePlan, (self.table, self.table_index, self.select, self.columns, dict(self.table_structure),
+                            dict(self.dtypes), self.unique, self.ddl, self.additional_columns,
+                            {distance: dict(renames) for distance, renames in self.distance_renames.items()},
+                            dict(self.distance_drops))
+
+
+class SchemaPlans:
+    # The SourcePlans compiled from one DataPack, by table.
+
+    def __init__(self, fingerprint, plans):
+        self.fingerprint = fingerprint
+        self.plans = MappingProxyType(dict(plans))
+
+    def plan(self, table):
+        return self.plans[table]
+
+    def __reduce__(self):
+        return SchemaPlans, (self.fingerprint, dict(self.plans))
+
+
+def compiler_hash():
+    """Hash of this module's source, so plans compiled by an older version of it aren't loaded."""
+    with open(__file__, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def fingerprint(data_pack):
+    """Hash of the constants that go into the plans and of the code that compiles them."""
+    constants = {name: getattr(data_pack, name, None) for name in PLANNED_CONSTANTS}
+    constants['compiler'] = compiler_hash()
+    return hashlib.sha1(json.dumps(constants, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def validate(data_pack):
+    """ Checks that the constants line up with each other. Raises SchemaError listing every problem found, so a bad
+        edit to a constants file stops the run before anything is written.
+    """
+    problems = list()
+    structure = data_pack.CONSOLIDATED_TABLE_STRUCTURE
+    additional = getattr(data_pack, 'ADDITIONAL_FIELDS', dict())
+    width = max(len(value) for value in structure.values())
+
+    for name, fields in [('CONSOLIDATED_TABLE_STRUCTURE', structure), ('ADDITIONAL_FIELDS', additional)]:
+        for column, value in fields.items():
+            if len(value) != width:
+                problems.append(f'{name}[{column!r}] has {len(value)} entries; expected {width}')
+    for column in set(structure) & set(additional):
+        problems.append(f'{column!r} is in both CONSOLIDATED_TABLE_STRUCTURE and ADDITIONAL_FIELDS')
+    for table, index in data_pack.TABLE_TO_INDEX_MAPPINGS.items():
+        if not 0 < index < width:
+            problems.append(f'TABLE_TO_INDEX_MAPPINGS[{table!r}] is {index}; expected 1 to {width - 1}')
+    for column in getattr(data_pack, 'UNIQUE', list()):
+        if column not in structure:
+            problems.append(f'UNIQUE column {column!r} is not in CONSOLIDATED_TABLE_STRUCTURE')
+    for name in ['POSITION_DISTANCE_MAPPINGS', 'LEAD_OR_BEATEN_DISTANCE_MAPPINGS']:
+        for distance, mapping in getattr(data_pack, name, dict()).items():
+            for column, value in mapping.items():
+                if len(value) != width:
+                    problems.append(f'{name}[{distance}][{column!r}] has {len(value)} entries; expected {width}')
+                elif column not in structure:
+                    problems.append(f'{name}[{distance}][{column!r}] is not in CONSOLIDATED_TABLE_STRUCTURE')
+
+    if problems:
+        raise SchemaError('Schema constants are inconsistent:\n\t' + '\n\t'.join(problems))
+
+
+def compile_plan(data_pack, table, table_index):
+    """The SourcePlan for table, read from column table_index of the constants."""
+    structure = data_pack.CONSOLIDATED_TABLE_STRUCTURE
+    additional = getattr(data_pack, 'ADDITIONAL_FIELDS', dict())
+    unique = getattr(data_pack, 'UNIQUE', list())
+
+    fields = {key: value[table_index] for key, value in structure.items() if value[table_index]}
+    fields.update({key: value[table_index] for key, value in additional.items() if value[table_index]})
+    dtypes = {key: value[0] for key, value in structure.items()}
+    additional_columns = [key for key, value in additional.items() if value[table_index] is not None]
+
+    # The source data gives positions and margins by call. For each distance, the call columns that have a
+    # distance column are renamed to it and the rest are dropped. Renaming goes position mappings first, then
+    # margin mappings, over the columns as loaded.
+    distance_renames, distance_drops = dict(), dict()
+    position_mappings = getattr(data_pack, 'POSITION_DISTANCE_MAPPINGS', dict())
+    margin_mappings = getattr(data_pack, 'LEAD_OR_BEATEN_DISTANCE_MAPPINGS', dict())
+    for distance in set(position_mappings) | set(margin_mappings):
+        position_mapping = {value[table_index]: key for key, value in position_mappings.get(distance, dict()).items()}
+        margin_mapping = {value[table_index]: key for key, value in margin_mappings.get(distance, dict()).items()}
+        renames = dict()
+        for column in fields:
+            renamed = position_mapping.get(column, column)
+            renamed = margin_mapping.get(renamed, renamed)
+            if renamed != column:
+                renames[column] = renamed
+        distance_renames[distance] = renames
+        distance_drops[distance] = [column for column in additional_columns
+                                    if column not in position_mapping and column not in margin_mapping]
+
+    return SourcePlan(table, table_index, select=fields.values(), columns=fields.keys(), table_structure={
+        key: value[table_index] for key, value in structure.items()}, dtypes=dtypes, unique=unique,
+        ddl=dbh.create_table_sql(table, dtypes, unique, None), additional_columns=additional_columns,
+        distance_renames=distance_renames, distance_drops=distance_drops)
+
+
+_compiled = dict()      # Format: id(data_pack): (data_pack, SchemaPlans)
+
+
+def compile_schema(data_pack, cache_dir=SCHEMA_CACHE_DIR):
+    """ The SchemaPlans for data_pack. Compiled (and validated) the first time it's asked for in a run, or loaded
+        from cache_dir if the constants haven't changed since they were last compiled. cache_dir=None skips the
+        disk cache.
+    """
+    if id(data_pack) in _compiled:
+        return _compiled[id(data_pack)][1]
+
+    key = fingerprint(data_pack)
+    path = os.path.join(cache_dir, f'{key}.pickle') if cache_dir else None
+    schema = None
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'rb') as file:
+                schema = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            print(f'Unable to load schema plans from {path} ({e}); recompiling')
+
+    if schema is None:
+        validate(data_pack)
+        schema = SchemaPlans(key, {table: compile_plan(data_pack, table, index)
+                                   for table, index in data_pack.TABLE_TO_INDEX_MAPPINGS.items()})
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path + '.tmp', 'wb') as file:
+                pickle.dump(schema, file)
+            os.replace(path + '.tmp', path)
+
+    _compiled[id(data_pack)] = (data_pack, schema)
+    return schema
@@ -0,0 +1,103 @@
+import cProfile
+import datetime
+import functools
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class StageProfiler:
+    # The StageProfiler class keeps running totals and call counts for the stages of a processor's per-row loop.
+    # Stages are timed either by wrapping a method on an object with instrument() or by a with stage(name): block.
+    # Timing costs two perf_counter() calls per stage, so it's left on for every run. Stage times are inclusive:
+    # resolve_data includes the fix_discrepancy and database write calls made inside it.
+    #
+    # profile=True also runs cProfile over the whole run and dumps the stats next to the report for
+    # snakeviz/pstats.
+
+    def __init__(self, name, log_dir='logs', profile=False):
+        self.name = name
+        self.log_dir = log_dir
+        self.profile = profile
+
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.rows = 0
+        self.start_time = None
+        self.elapsed = 0.0
+
+        self.profiler = cProfile.Profile() if profile else None
+        self.instrumented = list()      # (obj, method_name) pairs to restore when the run is done
+
+    @contextmanager
+    def stage(self, stage_name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[stage_name] += time.perf_counter() - start
+            self.counts[stage_name] += 1
+
+    def instrument(self, obj, method_name, stage_name=None):
+        """Replaces obj.method_name with a timed wrapper for this run. restore() puts the original back."""
+        stage_name = stage_name or method_name
+        method = getattr(obj, method_name)
+        totals = self.totals
+        counts = self.counts
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                totals[stage_name] += time.perf_counter() - start
+                counts[stage_name] += 1
+
+        setattr(obj, method_name, timed)
+        self.instrumented.append((obj, method_name))
+
+    def restore(self):
+        for obj, method_name in reversed(self.instrumented):
+            try:
+                delattr(obj, method_name)
+            except AttributeError:
+                pass
+        self.instrumented = list()
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def stop(self, rows):
+        """Stops the clock and removes the timing wrappers, even if start() was never reached."""
+        try:
+            if self.profiler is not None:
+                self.profiler.disable()
+            self.elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+            self.rows = rows
+        finally:
+            self.restore()
+
+    def report(self):
+        rows_per_second = self.rows / self.elapsed if self.elapsed else 0.0
+        lines = [f'Stage timings for {self.name}: {self.rows} rows in {self.elapsed:.2f} s ({rows_per_second:.1f} rows/s)',
+                 f'{"stage":<45}{"total s":>12}{"calls":>12}{"us/call":>12}{"% of run":>10}']
+        for stage_name, total in sorted(self.totals.items(), key=lambda item: item[1], reverse=True):
+            count = self.counts[stage_name]
+            share = total / self.elapsed * 100 if self.elapsed else 0.0
+            lines.append(f'{stage_name:<45}{total:>12.3f}{count:>12}{total / count * 1e6:>12.1f}{share:>10.1f}')
+        return '\n'.join(lines)
+
+    def write(self):
+        """Writes the report (and the cProfile stats, if profiling) to log_dir. Returns the report path."""
+        os.makedirs(self.log_dir, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%dT%H%M%S')
+        path = os.path.join(self.log_dir, f'stage_timings_{self.name}_{timestamp}.txt')
+        with open(path, 'w') as file:
+            file.write(self.report() + '\n')
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.join(self.log_dir, f'profile_{self.name}_{timestamp}.prof'))
+        return path
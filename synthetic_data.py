@@ -0,0 +1,463 @@
+# Seeded synthetic source data in the shapes of race_info, race_general_results, horse_pps and race_horse_info.
+#
+# Races and starters are generated as logical tables keyed by the consolidated field names, then written to each
+# source table under that table's own column names (from the table structure constants). The sources overlap the
+# way the real ones do--not every race or starter shows up in every source--and carry the discrepancies the fixers
+# exist for: off-turf distance changes with matching conditions text, race-type code variants, and margins
+# reported to different precisions, plus a share of generic conflicts and blank cells.
+#
+# Data is generated in blocks of BLOCK_SIZE races, each with its own seed, so any number of races can be produced
+# in bounded memory and the same seed always gives the same rows. Write to a database:
+#     python -m synthetic_data --races 100000 --database horses_synthetic
+# or to columnar files, one directory per table:
+#     python -m synthetic_data --races 100000 --output-dir synthetic --format parquet
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from constants.constant_aggregated_races_table_structure import CONSOLIDATED_TABLE_STRUCTURE as RACES_STRUCTURE
+from constants.constant_aggregated_races_additional_fields import ADDITIONAL_FIELDS as RACES_ADDITIONAL_FIELDS
+from constants.constant_aggregated_races_table_to_index_mappings import TABLE_TO_INDEX_MAPPINGS as RACES_INDEXES
+from constants.constant_horse_performances_consolidated_table_structure import CONSOLIDATED_TABLE_STRUCTURE \
+    as PERFORMANCES_STRUCTURE
+from constants.constant_horse_performances_additional_fields import ADDITIONAL_FIELDS as PERFORMANCES_ADDITIONAL_FIELDS
+from constants.constant_horse_performances_table_to_index_mappings import TABLE_TO_INDEX_MAPPINGS \
+    as PERFORMANCES_INDEXES
+from constants.constant_horse_performances_distances_to_process import DISTANCES_TO_PROCESS
+from constants.constant_horse_performances_position_distance_mappings import POSITION_DISTANCE_MAPPINGS
+from constants.constant_horses_performances_lead_or_beaten_distance_mappings import LEAD_OR_BEATEN_DISTANCE_MAPPINGS
+from fixer_race_type import RACE_TYPES
+
+
+SCHEMAS = {
+    # Format: schema: (table structure, additional fields, table to index mappings)
+    'races': (RACES_STRUCTURE, RACES_ADDITIONAL_FIELDS, RACES_INDEXES),
+    'performances': (PERFORMANCES_STRUCTURE, PERFORMANCES_ADDITIONAL_FIELDS, PERFORMANCES_INDEXES),
+}
+
+SOURCE_TABLES = {
+    # Format: source_table: schemas whose fields it holds
+    'race_info': ['races'],
+    'race_general_results': ['races'],
+    'horse_pps': ['races', 'performances'],
+    'race_horse_info': ['performances'],
+}
+
+RACE_SOURCE_TABLES = ['race_info', 'horse_pps', 'race_general_results']
+PERFORMANCE_SOURCE_TABLES = ['race_horse_info', 'horse_pps']
+
+# Share of races (or, for horse_pps, starters) each source carries. race_general_results and race_horse_info
+# come from the same result charts, so they always cover the same races.
+SOURCE_COVERAGE = {
+    'race_info': 0.9,
+    'results': 0.95,
+    'horse_pps': 0.7,
+}
+
+BLOCK_SIZE = 10000
+
+TRACKS = ['AQU', 'BEL', 'SAR', 'CD', 'KEE', 'GP', 'SA', 'DMR', 'OP', 'PIM', 'LRL', 'MTH', 'PRX', 'TAM', 'FG',
+          'HOU', 'LS', 'WO', 'CT', 'PEN']
+RACES_PER_CARD = 12
+
+# Format: distance in yards: relative frequency. Most races are at the distances the pipeline processes; the rest
+# exercise the skip path.
+DISTANCE_WEIGHTS = {
+    1100: 9, 1210: 11, 1320: 18, 1430: 4, 1540: 6, 1650: 2, 1760: 12, 1830: 7, 1870: 9, 1980: 4,
+    880: 1, 990: 1, 2310: 0.5, 2640: 0.5,
+}
+TURF_SHARE = 0.2
+TIME_DISTANCES = [440, 660, 880, 990, 1100, 1210, 1320, 1430, 1540, 1650, 1760, 1800, 1830, 1870, 1980, 2310,
+                  2640, 3080, 3520]
+
+# Every call point (in yards) any distance mapping reports a position or margin at
+CALL_POINTS = sorted({int(field.split('_')[-1]) for mappings in POSITION_DISTANCE_MAPPINGS.values()
+                      for field in mappings})
+
+# Fields that are never blanked--the pipeline needs them to identify and lay out a row
+KEY_FIELDS = ['track', 'date', 'race_num', 'distance', 'planned_distance', 'horse_name', 'post_position',
+              'distance_fraction_1', 'distance_fraction_2', 'distance_fraction_3', 'distance_fraction_4',
+              'distance_fraction_5']
+
+NAME_WORDS = [
+    ['Golden', 'Silver', 'Midnight', 'Royal', 'Lucky', 'Wild', 'Brave', 'Quiet', 'Rapid', 'Bold', 'Dancing',
+     'Secret', 'Northern', 'Southern', 'Crimson', 'Flying', 'Iron', 'Lone', 'Proud', 'Sunny'],
+    ['River', 'Storm', 'Star', 'Legend', 'Dream', 'Spirit', 'Arrow', 'Thunder', 'Echo', 'Harbor', 'Comet', 'Flame',
+     'Meadow', 'Empire', 'Canyon', 'Breeze', 'Crown', 'Journey', 'Rebel', 'Shadow'],
+    ['', ' Run', ' Song', ' Dancer', ' Queen', ' King', ' Girl', ' Boy', ' Bay', ' Rose', ' Prince', ' Lady',
+     ' Cat', ' Jet', ' Gold', ' Rock', ' Bird', ' Road', ' Moon', ' Wind'],
+    ['', ' II', ' III', ' IV'],
+]
+
+NUMBER_WORDS = ['Zero', 'One', 'Two', 'Three', 'Four', 'Five', 'Six', 'Seven', 'Eight', 'Nine', 'Ten']
+MILE_FRACTION_WORDS = {0: '', 40: ' And Forty Yards', 70: ' And Seventy Yards', 110: ' And One Sixteenth',
+                       220: ' And One Eighth'}
+
+
+def additional_field_type(field):
+    if field.startswith('time_') or field.startswith('lead_or_beaten'):
+        return 'FLOAT'
+    return 'INT'
+
+
+def source_columns(table):
+    """ Returns {source column: ([consolidated fields], SQL type)} for every column the pipeline reads from table.
+
+        Some source columns feed more than one consolidated field (e.g., purse and final_purse).
+    """
+    columns = dict()
+    for schema in SOURCE_TABLES[table]:
+        structure, additional_fields, indexes = SCHEMAS[schema]
+        index = indexes[table]
+        fields = [(field, value[index], value[0]) for field, value in structure.items()]
+        fields += [(field, value[index], additional_field_type(field)) for field, value in additional_fields.items()]
+        for field, column, sql_type in fields:
+            if column:
+                columns.setdefault(column, ([], sql_type))[0].append(field)
+    return columns
+
+
+def fraction_distances(distance):
+    """Five distinct call distances for a race's fractional times, the ones before the finish first."""
+    before = [item for item in TIME_DISTANCES if item < distance]
+    after = [item for item in TIME_DISTANCES if item > distance]
+    return (before[-5:] + after)[:5]
+
+
+def distance_words(distance):
+    """Spells out a distance the way race conditions do, or returns None if it isn't a standard distance."""
+    if distance < 1760:
+        furlongs, remainder = divmod(distance, 220)
+        if remainder not in (0, 110) or not 1 <= furlongs <= 10:
+            return None
+        return NUMBER_WORDS[furlongs] + (' And One Half' if remainder else '') + ' Furlongs'
+    if distance - 1760 in MILE_FRACTION_WORDS:
+        return 'One Mile' + MILE_FRACTION_WORDS[distance - 1760]
+    return None
+
+
+def off_turf_distance(distance):
+    """The distance a turf race moves to on the main track: the next standard distance up, for these data."""
+    distances = sorted(DISTANCES_TO_PROCESS)
+    longer = [item for item in distances if item > distance]
+    return longer[0] if longer else distances[-1]
+
+
+def horse_names():
+    """Every name that can be built from NAME_WORDS, in a fixed order."""
+    sizes = [len(words) for words in NAME_WORDS]
+    names = list()
+    for i in range(np.prod(sizes)):
+        parts = list()
+        for words, size in zip(NAME_WORDS, sizes):
+            i, j = divmod(i, size)
+            parts.append(words[j])
+        names.append(parts[0] + ' ' + ''.join(parts[1:]))
+    return np.array(names)
+
+
+def rank_within_races(starts, sizes, scores):
+    """Ranks scores (1 = lowest) within each race, where the starters of a race are contiguous rows."""
+    race_of_row = np.repeat(np.arange(len(sizes)), sizes)
+    order = np.lexsort((scores, race_of_row))
+    ranks = np.empty(len(scores), dtype=int)
+    ranks[order] = np.arange(len(scores)) - np.repeat(starts, sizes) + 1
+    return ranks
+
+
+class SyntheticRaces:
+    # The SyntheticRaces class generates one block of races and their starters and lays them out as source
+    # tables. generate_block() is the entry point; everything it produces depends only on (seed, block).
+
+    def __init__(self, seed=0, conflict_rate=0.05, blank_rate=0.02, off_turf_rate=0.15, race_type_variant_rate=0.3,
+                 margin_precision_rate=0.3, coverage=None):
+        self.seed = seed
+        self.conflict_rate = conflict_rate
+        self.blank_rate = blank_rate
+        self.off_turf_rate = off_turf_rate                      # Share of turf races moved to the main track
+        self.race_type_variant_rate = race_type_variant_rate    # Share of races where a source uses a weaker code
+        self.margin_precision_rate = margin_precision_rate      # Share of horse_pps margins rounded to quarters
+        self.coverage = dict(SOURCE_COVERAGE, **(coverage or dict()))
+        self.names = horse_names()
+
+    def rng(self, block, stream):
+        return np.random.default_rng([self.seed, block, stream])
+
+    def generate_block(self, block, n_races=BLOCK_SIZE, tables=None):
+        """Returns {source table: dataframe with the table's own column names} for races in block."""
+        races = self.generate_races(block, n_races)
+        starters = self.generate_starters(block, races)
+        views = self.source_views(block, races, starters)
+        return {table: self.to_source_table(block, table, views[table]) for table in tables or SOURCE_TABLES}
+
+    def generate_races(self, block, n_races):
+        rng = self.rng(block, 0)
+        race_index = block * BLOCK_SIZE + np.arange(n_races)
+        cards = race_index // RACES_PER_CARD
+
+        races = pd.DataFrame(index=race_index)
+        races['track'] = np.array(TRACKS)[cards % len(TRACKS)]
+        races['date'] = (pd.Timestamp('2015-01-01') + pd.to_timedelta(cards // len(TRACKS), unit='D')).date
+        races['race_num'] = race_index % RACES_PER_CARD + 1
+
+        distances = np.array(list(DISTANCE_WEIGHTS.keys()))
+        weights = np.array(list(DISTANCE_WEIGHTS.values()), dtype=float)
+        races['planned_distance'] = rng.choice(distances, size=n_races, p=weights / weights.sum())
+        races['surface'] = np.where(rng.random(n_races) < TURF_SHARE, 'T', 'D')
+        races['track_condition'] = rng.choice(['FT', 'GD', 'SY', 'MY', 'FM'], size=n_races)
+        races['field_size'] = rng.integers(5, 13, size=n_races)
+        races['breed'] = 'TB'
+
+        race_types = np.array(list(RACE_TYPES.keys()))
+        races['race_type'] = rng.choice(race_types, size=n_races)
+        races['purse'] = rng.integers(10, 200, size=n_races) * 1000
+        races['claiming_price_base'] = np.where(np.isin(races['race_type'], ['CLM', 'MCL', 'WCL']),
+                                                rng.integers(5, 80, size=n_races) * 1000, 0)
+        races['standard_weight'] = rng.choice([118, 120, 122, 124], size=n_races)
+        for field in ['allowed_age_two', 'allowed_age_three', 'allowed_age_four', 'allowed_age_five',
+                      'allowed_age_older', 'allowed_fillies', 'allowed_mares', 'allowed_colts_geldings',
+                      'statebred_race']:
+            races[field] = rng.integers(0, 2, size=n_races)
+
+        # Turf races name the distance they'll be run at if they come off the turf; some of them do
+        alternate = races['planned_distance'].map(off_turf_distance)
+        alternate_words = alternate.map(distance_words)
+        has_clause = (races['surface'] == 'T') & alternate_words.notna()
+        races['off_turf'] = (has_clause & (rng.random(n_races) < self.off_turf_rate)).astype(int)
+        races['off_turf_dist_change'] = races['off_turf']
+        races['distance'] = np.where(races['off_turf'] == 1, alternate, races['planned_distance'])
+        races['race_conditions_text_1'] = [f'For Three Year Olds And Upward. Purse ${purse}.'
+                                           for purse in races['purse']]
+        races['race_conditions_text_2'] = np.where(
+            has_clause, 'If deemed inadvisable by management to run this race over the turf course, this race will '
+                        'be run on the main track at ' + alternate_words.fillna('') + '.', None)
+
+        # Final and fractional times. race_general_results reports fractions by call; horse_pps by distance.
+        races['time_finish'] = (races['distance'] / 220 * 12.2 + rng.normal(0, 1, size=n_races)).round(2)
+        fractions = np.array([fraction_distances(distance) for distance in races['distance']])
+        for i in range(5):
+            races[f'distance_fraction_{i + 1}'] = fractions[:, i]
+            races[f'time_fraction_{i + 1}'] = (fractions[:, i] / 220 * 12.0).round(2)
+        for distance in TIME_DISTANCES:
+            races[f'time_{distance}'] = np.where(races['distance'] > distance, round(distance / 220 * 12.0, 2), np.nan)
+
+        return races
+
+    def generate_starters(self, block, races):
+        rng = self.rng(block, 1)
+        sizes = races['field_size'].to_numpy()
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        starters = races.loc[races.index.repeat(sizes)].reset_index(names='race')
+        n_starters = len(starters)
+        starters['post_position'] = np.arange(n_starters) - np.repeat(starts, sizes) + 1
+
+        # Post positions are 13 names apart, so starters in the same race never share a name
+        name_index = (starters['race'] * 7 + starters['post_position'] * 13) % len(self.names)
+        starters['horse_name'] = self.names[name_index]
+        starters['horse_id'] = name_index
+        starters['state_bred'] = np.where(rng.random(n_starters) < 0.1, 's', '')
+        starters['days_since_last_race'] = rng.integers(7, 120, size=n_starters)
+        starters['weight'] = rng.integers(115, 125, size=n_starters)
+        starters['dead_heat_finish'] = 0
+        starters['meds_bute'] = rng.integers(0, 2, size=n_starters)
+        starters['meds_lasix'] = rng.integers(0, 2, size=n_starters)
+        starters['equip_blinkers'] = rng.integers(0, 2, size=n_starters)
+        starters['jockey_id'] = rng.integers(1, 500, size=n_starters)
+        starters['jockey'] = np.char.add('Jockey ', starters['jockey_id'].to_numpy().astype(str))
+        starters['trainer_id'] = rng.integers(1, 500, size=n_starters)
+        starters['trainer'] = np.char.add('Trainer ', starters['trainer_id'].to_numpy().astype(str))
+
+        # Positions and margins at each call point, consistent across sources. A horse's ability carries through
+        # the race with some noise at each call.
+        ability = rng.normal(0, 1, size=n_starters)
+        for point in CALL_POINTS:
+            ranks = rank_within_races(starts, sizes, ability + rng.normal(0, 0.7, size=n_starters))
+            gaps = rng.uniform(0.3, 2.5, size=n_starters)
+            margins = np.where(ranks == 1, rng.uniform(0, 3, size=n_starters), (ranks - 1) * gaps)
+            reached = point <= starters['distance'].to_numpy()
+            starters[f'position_{point}'] = np.where(reached, ranks, np.nan)
+            starters[f'lead_or_beaten_{point}'] = np.where(reached, margins.round(2), np.nan)
+        starters['favorite'] = (rank_within_races(starts, sizes, ability) == 1).astype(int)
+
+        return starters
+
+    def source_views(self, block, races, starters):
+        """Picks the rows each source carries and applies the source-specific discrepancies."""
+        rng = self.rng(block, 2)
+        n_races = len(races)
+        views = dict()
+
+        # race_info is published before the race: planned distance and surface, and BRIS race type codes
+        race_info = races[rng.random(n_races) < self.coverage['race_info']].copy()
+        race_info['distance'] = race_info['planned_distance']
+        race_info['surface'] = np.where(races.loc[race_info.index, 'off_turf'] == 1, 'T', race_info['surface'])
+        race_info['race_type'] = self.race_type_variants(rng, race_info['race_type'])
+        race_info['pps_bris_race_type'] = race_info['race_type']
+        race_info[['off_turf', 'off_turf_dist_change']] = None
+        views['race_info'] = race_info
+
+        results = rng.random(n_races) < self.coverage['results']
+        race_results = races[results].copy()
+        race_results['surface'] = np.where(race_results['off_turf'] == 1, 'D', race_results['surface'])
+        race_results['results_bris_race_type'] = self.race_type_variants(rng, race_results['race_type'])
+        views['race_general_results'] = race_results
+        views['race_horse_info'] = starters[np.repeat(results, races['field_size'])].copy()
+
+        horse_pps = starters[rng.random(len(starters)) < self.coverage['horse_pps']].copy()
+        horse_pps['race_type'] = self.race_type_variants(rng, horse_pps['race_type'])
+        horse_pps['pps_bris_race_type'] = horse_pps['race_type']
+        # Past performance lines often report margins to the nearest quarter length
+        rounded = rng.random(len(horse_pps)) < self.margin_precision_rate
+        for point in CALL_POINTS:
+            field = f'lead_or_beaten_{point}'
+            horse_pps.loc[rounded, field] = (horse_pps.loc[rounded, field] * 4).round() / 4
+        views['horse_pps'] = horse_pps
+
+        return views
+
+    def race_type_variants(self, rng, race_types):
+        """Swaps race_type_variant_rate of the best descriptors for one of the weaker codes other sources use."""
+        variants = race_types.copy()
+        swap = rng.random(len(race_types)) < self.race_type_variant_rate
+        picks = rng.integers(0, 100, size=len(race_types))
+        variants[swap] = [RACE_TYPES[race_type][pick % len(RACE_TYPES[race_type])]
+                          for race_type, pick in zip(race_types[swap], picks[swap])]
+        return variants
+
+    def add_conflicts(self, rng, data):
+        """Perturbs one field in conflict_rate of the rows, in the ways the sources tend to disagree."""
+        conflicted = rng.random(len(data)) < self.conflict_rate
+        kind = rng.integers(0, 3, size=len(data))
+
+        mask = conflicted & (kind == 0)
+        data.loc[mask, 'purse'] = (data.loc[mask, 'purse'] * 1.1).round()
+        mask = conflicted & (kind == 1)
+        data.loc[mask, 'field_size'] = data.loc[mask, 'field_size'] + 1
+        if 'weight' in data.columns:
+            mask = conflicted & (kind == 2)
+            data.loc[mask, 'weight'] = data.loc[mask, 'weight'] + 1
+        return data
+
+    def add_blanks(self, rng, data):
+        data = data.astype(object)
+        blankable = [column for column in data.columns if column not in KEY_FIELDS]
+        mask = rng.random((len(data), len(blankable))) < self.blank_rate
+        values = data[blankable].to_numpy()
+        values[mask] = None
+        data[blankable] = values
+        return data
+
+    def to_source_table(self, block, table, data):
+        """Lays data out under table's column names, with calls mapped to the table's call fields."""
+        rng = self.rng(block, 3 + list(SOURCE_TABLES).index(table))
+        data = self.add_conflicts(rng, data)
+        data = self.add_blanks(rng, data)
+        data['source_file'] = f'synthetic_{table}'
+        if 'performances' in SOURCE_TABLES[table]:
+            data = self.add_call_fields(table, data)
+
+        columns = dict()
+        for column, (fields, _) in source_columns(table).items():
+            fields = [field for field in fields if field in data.columns]
+            columns[column] = data[fields[0]] if fields else pd.Series(None, index=data.index, dtype=object)
+        return pd.DataFrame(columns).reset_index(drop=True)
+
+    def add_call_fields(self, table, data):
+        """Fills the source's call fields (e.g., position_1st_call) from the call points for each race distance."""
+        index = PERFORMANCES_INDEXES[table]
+        call_fields = {field for field, value in PERFORMANCES_ADDITIONAL_FIELDS.items() if value[index]}
+        calls = {field: np.full(len(data), None, dtype=object) for field in call_fields}
+        distances = data['distance'].to_numpy()
+        for mappings in [POSITION_DISTANCE_MAPPINGS, LEAD_OR_BEATEN_DISTANCE_MAPPINGS]:
+            for distance, points in mappings.items():
+                rows = distances == distance
+                for point, fields in points.items():
+                    if fields[index] in calls:
+                        calls[fields[index]][rows] = data[point].to_numpy()[rows]
+        return pd.concat([data.drop(columns=list(calls), errors='ignore'),
+                          pd.DataFrame(calls, index=data.index)], axis=1)
+
+
+def generate(n_races, seed=0, tables=None, **options):
+    """Yields {source table: dataframe} one block of races at a time, n_races in all."""
+    generator = SyntheticRaces(seed=seed, **options)
+    for block in range(-(-n_races // BLOCK_SIZE)):
+        yield generator.generate_block(block, min(BLOCK_SIZE, n_races - block * BLOCK_SIZE), tables)
+
+
+def write_source_table(db, table, table_data):
+    """Creates table in db (a QueryDB) if needed and appends table_data to it."""
+    schema = {column: sql_type for column, (_, sql_type) in source_columns(table).items()}
+    db.initialize_table(table, schema, unique_key=None, foreign_key=None)
+    rows = table_data.astype(object).where(table_data.notna(), None).values.tolist()
+    db.add_to_table(table, rows, list(table_data.columns))
+
+
+def create_source_tables(db, n_races, seed=0, tables=None, **options):
+    """Writes every source table for n_races synthetic races into db. Returns {table: row count}."""
+    counts = dict()
+    for block_tables in generate(n_races, seed, tables, **options):
+        for table, table_data in block_tables.items():
+            write_source_table(db, table, table_data)
+            counts[table] = counts.get(table, 0) + len(table_data)
+    return counts
+
+
+def write_source_files(directory, n_races, seed=0, tables=None, file_format='parquet', **options):
+    """Writes one file per table per block under directory/<table>/. Returns {table: row count}."""
+    counts = dict()
+    for block, block_tables in enumerate(generate(n_races, seed, tables, **options)):
+        for table, table_data in block_tables.items():
+            os.makedirs(os.path.join(directory, table), exist_ok=True)
+            path = os.path.join(directory, table, f'part-{block:05d}.{file_format}')
+            if file_format == 'parquet':
+                table_data.to_parquet(path, index=False)
+            else:
+                table_data.to_csv(path, index=False)
+            counts[table] = counts.get(table, 0) + len(table_data)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic race source tables')
+    parser.add_argument('--races', type=int, required=True, help='number of races to generate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tables', nargs='+', choices=list(SOURCE_TABLES), help='default: all source tables')
+    parser.add_argument('--database', help='MySQL database to write the tables to')
+    parser.add_argument('--sqlite-dir', help='directory for the SQLite stand-in used by the benchmarks')
+    parser.add_argument('--output-dir', help='directory to write columnar files to')
+    parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet')
+    parser.add_argument('--conflict-rate', type=float, default=0.05)
+    parser.add_argument('--blank-rate', type=float, default=0.02)
+    parser.add_argument('--off-turf-rate', type=float, default=0.15)
+    parser.add_argument('--race-type-variant-rate', type=float, default=0.3)
+    parser.add_argument('--margin-precision-rate', type=float, default=0.3)
+    args = parser.parse_args()
+
+    options = dict(conflict_rate=args.conflict_rate, blank_rate=args.blank_rate, off_turf_rate=args.off_turf_rate,
+                   race_type_variant_rate=args.race_type_variant_rate,
+                   margin_precision_rate=args.margin_precision_rate)
+    if args.output_dir:
+        counts = write_source_files(args.output_dir, args.races, args.seed, args.tables, args.format, **options)
+    elif args.database or args.sqlite_dir:
+        if args.sqlite_dir:
+            from benchmarks.sqlite_db import SQLiteQueryDB
+            db = SQLiteQueryDB(args.database or 'horses_synthetic', args.sqlite_dir)
+        else:
+            import db_handler as dbh
+            db = dbh.QueryDB(args.database, initialize_db=True)
+        db.connect()
+        counts = create_source_tables(db, args.races, args.seed, args.tables, **options)
+        db.close()
+    else:
+        parser.error('one of --database, --sqlite-dir or --output-dir is required')
+
+    for table, count in counts.items():
+        print(f'{table}: {count} rows')
+
+
+if __name__ == '__main__':
+    main()
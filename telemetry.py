@@ -0,0 +1,162 @@
+import functools
+import os
+import resource
+import sys
+import threading
+import time
+
+
+METRIC_PREFIX = 'race_aggregator'
+
+
+def resident_memory_bytes():
+    """Current resident set size of this process. Falls back to the peak RSS where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def format_labels(labels):
+    if not labels: return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+class TelemetrySampler:
+    # The TelemetrySampler class reports the progress of a processor's per-row loop for unattended runs. A
+    # background thread samples the counters every interval seconds and writes them to a file in Prometheus text
+    # format, replacing the previous sample (the layout node_exporter's textfile collector reads):
+    #   - rows processed and rows/s, queries sent and queries/s
+    #   - gauges registered with add_gauge() (e.g., the depth of a write buffer)
+    #   - per-label counters registered with add_counters() (e.g., fixer invocations), with their rates
+    #   - resident memory
+    # The loop only pays for next_row() (an integer increment) and the query counting wrappers; everything else
+    # happens on the sampler thread. progress_bar=True also shows the old progress.bar display. stop() takes the
+    # thread and the wrappers down even if the run fails part way, so call it from a finally block.
+
+    def __init__(self, name, total_rows, log_dir='logs', interval=5.0, progress_bar=False):
+        self.name = name
+        self.total_rows = total_rows
+        self.interval = interval
+        self.path = os.path.join(log_dir, f'telemetry_{name}.prom')
+
+        self.rows = 0
+        self.queries = 0
+        self.gauges = dict()        # Format: metric name: (help text, function returning a number)
+        self.counters = dict()      # Format: metric name: (help text, label name, function returning {label: count})
+        self.last_sample = None     # (time, rows, queries, {metric name: {label: count}}) for rates
+
+        self.bar = None
+        if progress_bar:
+            from progress.bar import Bar    # Only needed when run by hand
+            self.bar = Bar(f'Processing {name} data', max=total_rows,
+                           suffix='%(percent).3f%% - %(index)d/%(max)d - %(eta)s secs.')
+
+        os.makedirs(log_dir, exist_ok=True)
+        self.sample_lock = threading.Lock()     # The final sample in stop() can overlap one on the sampler thread
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f'telemetry-{name}', daemon=True)
+        self.instrumented = list()      # (obj, method_name) pairs to restore when the run is done
+
+    def next_row(self):
+        self.rows += 1
+        if self.bar is not None: self.bar.next()
+
+    def count_queries(self, query_db):
+        """Counts every query_db() and update_db() call made through query_db (a QueryDB) during the run."""
+        for method_name in ['query_db', 'update_db']:
+            method = getattr(query_db, method_name)
+
+            @functools.wraps(method)
+            def counted(*args, method=method, **kwargs):
+                self.queries += 1
+                return method(*args, **kwargs)
+
+            setattr(query_db, method_name, counted)
+            self.instrumented.append((query_db, method_name))
+
+    def add_gauge(self, metric, help_text, function):
+        self.gauges[metric] = (help_text, function)
+
+    def add_counters(self, metric, help_text, label, function):
+        self.counters[metric] = (help_text, label, function)
+
+    def start(self):
+        self.last_sample = (time.monotonic(), 0, 0, {metric: dict() for metric in self.counters})
+        self.thread.start()
+
+    def stop(self):
+        """ Stops the sampler thread, writes a final sample, and removes the query counting wrappers. Safe to call
+            whether or not start() was reached.
+        """
+        self.stopped.set()
+        try:
+            if self.thread.is_alive(): self.thread.join()
+            if self.last_sample is not None: self.write_sample()
+        finally:
+            for obj, method_name in reversed(self.instrumented):
+                try:
+                    delattr(obj, method_name)
+                except AttributeError:
+                    pass
+            self.instrumented = list()
+            if self.bar is not None: self.bar.finish()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write_sample()
+            except Exception as e:
+                # Telemetry must never take the run down with it
+                print(f'Telemetry sample for {self.name} failed: {e}')
+
+    def write_sample(self):
+        # Written to a temporary file and renamed over the last sample, so readers never see a partial one
+        with self.sample_lock:
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as file:
+                file.write(self.sample() + '\n')
+            os.replace(temp_path, self.path)
+
+    def sample(self):
+        """Returns one sample of every metric in Prometheus text format."""
+        now = time.monotonic()
+        rows, queries = self.rows, self.queries
+        counts = {metric: dict(function()) for metric, (_, _, function) in self.counters.items()}
+
+        last_time, last_rows, last_queries, last_counts = self.last_sample
+        elapsed = now - last_time
+        self.last_sample = (now, rows, queries, counts)
+
+        def rate(current, previous):
+            return (current - previous) / elapsed if elapsed > 0 else 0.0
+
+        table = {'table': self.name}
+        lines = list()
+
+        def add(metric, metric_type, help_text, values):
+            lines.append(f'# HELP {METRIC_PREFIX}_{metric} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{metric} {metric_type}')
+            for labels, value in values:
+                lines.append(f'{METRIC_PREFIX}_{metric}{format_labels(labels)} {value}')
+
+        add('rows_total', 'gauge', 'Rows in the source table', [(table, self.total_rows)])
+        add('rows_processed_total', 'counter', 'Rows processed so far', [(table, rows)])
+        add('rows_per_second', 'gauge', 'Rows processed per second since the last sample',
+            [(table, f'{rate(rows, last_rows):.3f}')])
+        add('queries_total', 'counter', 'Queries sent to the databases', [(table, queries)])
+        add('queries_per_second', 'gauge', 'Queries sent per second since the last sample',
+            [(table, f'{rate(queries, last_queries):.3f}')])
+        for metric, (help_text, function) in self.gauges.items():
+            add(metric, 'gauge', help_text, [(table, function())])
+        for metric, (help_text, label, _) in self.counters.items():
+            add(f'{metric}_total', 'counter', help_text,
+                [(dict(table, **{label: key}), count) for key, count in counts[metric].items()])
+            add(f'{metric}_per_second', 'gauge', f'{help_text}, per second since the last sample',
+                [(dict(table, **{label: key}), f'{rate(count, last_counts[metric].get(key, 0)):.3f}')
+                 for key, count in counts[metric].items()])
+        add('resident_memory_bytes', 'gauge', 'Resident memory of the process', [(table, resident_memory_bytes())])
+        return '\n'.join(lines)
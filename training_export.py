@@ -0,0 +1,211 @@
+# Exports the consolidated races joined to their performances as a training set: one row per starter, with the
+# race's columns alongside the performance's, written as Parquet shards partitioned by year and track.
+#
+# The join is streamed. Each partition is read in chunks of whole race days, sorted by date and race number, with
+# one query per table, and each chunk is joined, cast to compact dtypes and written as a shard before the next is
+# read. Memory depends on chunk_rows, not on how much history there is.
+#
+# manifest.json in the export directory records the shards, row counts and a fingerprint of each partition: the row
+# counts and highest ids of both tables for every race day in it. An incremental export only rewrites partitions
+# whose fingerprint changed or that the change journal shows were updated by a run since the last export. Run from
+# the repository root:
+#     python training_export.py                  # rewrite the partitions that changed since the last export
+#     python training_export.py --full           # rewrite everything
+#
+# Writing Parquet needs pyarrow (or fastparquet).
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+from collections import defaultdict
+
+import pandas as pd
+
+import db_handler as dbh
+import journal
+from constants.constant_aggregated_races_table_structure import CONSOLIDATED_TABLE_STRUCTURE as RACES_STRUCTURE
+from constants.constant_horse_performances_consolidated_table_structure import \
+    CONSOLIDATED_TABLE_STRUCTURE as PERFORMANCES_STRUCTURE
+
+
+EXPORT_DIR = os.path.join('exports', 'training')
+RACES_TABLE = 'horses_consolidated_races'
+PERFORMANCES_TABLE = 'horses_consolidated_performances'
+JOIN_KEY = ['track', 'date', 'race_num']
+
+# Race columns that the performances also have are exported as race_<column>
+RACE_COLUMNS = {column: column if column in JOIN_KEY or column not in PERFORMANCES_STRUCTURE else f'race_{column}'
+                for column in RACES_STRUCTURE}
+
+
+def compact_dtype(sql_dtype):
+    """The smallest pandas dtype that holds a column of sql_dtype, keeping missing values."""
+    sql_dtype = sql_dtype.upper()
+    if sql_dtype.startswith('VARCHAR'):
+        return 'category'
+    return {'TINYINT': 'Int8', 'SMALLINT': 'Int16', 'INT': 'Int32', 'FLOAT': 'float32',
+            'DATE': 'datetime64[ns]'}.get(sql_dtype, 'object')
+
+
+EXPORT_DTYPES = dict({RACE_COLUMNS[column]: compact_dtype(value[0]) for column, value in RACES_STRUCTURE.items()},
+                     **{column: compact_dtype(value[0]) for column, value in PERFORMANCES_STRUCTURE.items()})
+
+
+def partition_name(year, track):
+    return f'year={year}/track={re.sub(r"[^A-Za-z0-9_-]", "_", str(track))}'
+
+
+def race_days(db):
+    """ {partition: {(track, date): [races, max race id, performances, max performance id]}}, from one GROUP BY
+        query per table.
+    """
+    partitions = defaultdict(dict)
+    for position, table in [(0, RACES_TABLE), (2, PERFORMANCES_TABLE)]:
+        sql = db.generate_query(table, ['track', 'date', 'COUNT(*)', 'MAX(id)'], other='GROUP BY track, date')
+        for track, date, rows, max_id in db.query_db(sql):
+            if track is None or date is None: continue
+            day = partitions[partition_name(str(date)[:4], track)].setdefault((track, str(date)[:10]), [0, 0, 0, 0])
+            day[position:position + 2] = [rows, max_id]
+    return partitions
+
+
+def fingerprint(days):
+    return hashlib.sha1(json.dumps(sorted([*day, *counts] for day, counts in days.items())).encode()).hexdigest()
+
+
+def journaled_partitions(runs, journal_dir=journal.JOURNAL_DIR):
+    """ The partitions that the change journal shows were updated in runs, and whether a run rewrote values across
+        the whole table (so every partition has to be exported again). Inserts show up in the fingerprints.
+    """
+    partitions, everything = set(), False
+    for table in [RACES_TABLE, PERFORMANCES_TABLE]:
+        for record in journal.read_records(table, runs, journal_dir):
+            if record['op'] == 'rewrite':
+                everything = True
+            elif record['op'] == 'update':
+                # Both tables' UNIQUE keys start with track, date
+                track, date = record['key'][:2]
+                if track is not None and date is not None:
+                    partitions.add(partition_name(str(date)[:4], track))
+    return partitions, everything
+
+
+def date_chunks(days, chunk_rows):
+    """Splits a partition's race days, in date order, into runs of days with about chunk_rows performances each."""
+    chunk, rows = list(), 0
+    for track, date in sorted(days, key=lambda day: day[1]):
+        chunk.append(date)
+        rows += days[(track, date)][2]
+        if rows >= chunk_rows:
+            yield chunk
+            chunk, rows = list(), 0
+    if chunk:
+        yield chunk
+
+
+def read_chunk(db, track, dates):
+    """The races and performances at track on dates, joined into one row per starter and sorted by key."""
+    where = f"track = '{db.escape_and_clean(track)}' AND date BETWEEN '{dates[0]}' AND '{dates[-1]}'"
+    races = pd.DataFrame(db.query_db(db.generate_query(RACES_TABLE, list(RACE_COLUMNS), where=where)),
+                         columns=list(RACE_COLUMNS.values()))
+    performances = pd.DataFrame(db.query_db(db.generate_query(PERFORMANCES_TABLE, list(PERFORMANCES_STRUCTURE),
+                                                              where=where)),
+                                columns=list(PERFORMANCES_STRUCTURE))
+    for data in [races, performances]:
+        data['date'] = pd.to_datetime(data['date'])
+        data['race_num'] = pd.to_numeric(data['race_num'])
+
+    joined = performances.merge(races, on=JOIN_KEY, how='inner', sort=False)
+    joined = joined.sort_values(['date', 'race_num', 'horse_name'], kind='stable')
+    return joined.astype({column: dtype for column, dtype in EXPORT_DTYPES.items() if column in joined.columns})
+
+
+def export_partition(db, output_dir, name, days, chunk_rows):
+    """Writes one partition's shards to a fresh directory and swaps it in. Returns its manifest entry."""
+    track = next(iter(days))[0]
+    path = os.path.join(output_dir, name)
+    building = path + '.building'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+
+    shards, rows = list(), 0
+    for dates in date_chunks(days, chunk_rows):
+        chunk = read_chunk(db, track, dates)
+        if chunk.empty: continue
+        shard = f'part-{len(shards):05d}.parquet'
+        chunk.to_parquet(os.path.join(building, shard), index=False)
+        shards.append(shard)
+        rows += len(chunk)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(building, path)
+    return {'fingerprint': fingerprint(days), 'rows': rows, 'shards': shards,
+            'exported': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def export(db, output_dir=EXPORT_DIR, full=False, chunk_rows=50000, journal_dir=journal.JOURNAL_DIR):
+    """ Exports the partitions that changed since the last export to output_dir (every partition if full=True or
+        there's no manifest yet) and updates the manifest. Returns the names of the partitions written.
+    """
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    manifest = {'partitions': dict(), 'journal_runs': list()}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+
+    partitions = race_days(db)
+    runs = journal.list_runs(journal_dir)
+    new_runs = [run for run in runs if run not in manifest['journal_runs']]
+    if full or not manifest['partitions']:
+        journaled, everything = set(), True
+    elif new_runs:
+        journaled, everything = journaled_partitions(new_runs, journal_dir)
+    else:
+        journaled, everything = set(), False
+
+    changed = [name for name, days in sorted(partitions.items())
+               if everything or name in journaled or name not in manifest['partitions']
+               or manifest['partitions'][name]['fingerprint'] != fingerprint(days)]
+    removed = [name for name in manifest['partitions'] if name not in partitions]
+    print(f'Exporting {len(changed)} of {len(partitions)} partitions to {output_dir}')
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name in changed:
+        manifest['partitions'][name] = export_partition(db, output_dir, name, partitions[name], chunk_rows)
+    for name in removed:
+        shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+        del manifest['partitions'][name]
+
+    manifest.update({'journal_runs': runs, 'columns': EXPORT_DTYPES, 'join_key': JOIN_KEY,
+                     'exported': datetime.datetime.now().isoformat(timespec='seconds'),
+                     'rows': sum(partition['rows'] for partition in manifest['partitions'].values())})
+    with open(manifest_path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    print(f'Training set has {manifest["rows"]} rows in {len(manifest["partitions"])} partitions')
+    return changed
+
+
+def main():
+    import horse_performances_master
+    parser = argparse.ArgumentParser(description='Export the consolidated races and performances as a training set')
+    parser.add_argument('--database', default=horse_performances_master.consolidated_database)
+    parser.add_argument('--output', default=EXPORT_DIR)
+    parser.add_argument('--full', action='store_true', help='rewrite every partition, not just the changed ones')
+    parser.add_argument('--chunk-rows', type=int, default=50000, help='performances read and written at a time')
+    args = parser.parse_args()
+
+    db = dbh.QueryDB(args.database)
+    db.connect()
+    try:
+        export(db, args.output, full=args.full, chunk_rows=args.chunk_rows)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()